@@ -1,39 +1,193 @@
 import numpy as np #1.19.3
 import hashlib
+import os
+
+import openssl_aes
+
+# turn off black formatting
+# fmt: off
+S_BOX = np.array(
+    [0x63, 0x7c, 0x77, 0x7b, 0xf2, 0x6b, 0x6f, 0xc5, 0x30, 0x01, 0x67, 0x2b, 0xfe, 0xd7, 0xab, 0x76,
+    0xca, 0x82, 0xc9, 0x7d, 0xfa, 0x59, 0x47, 0xf0, 0xad, 0xd4, 0xa2, 0xaf, 0x9c, 0xa4, 0x72, 0xc0,
+    0xb7, 0xfd, 0x93, 0x26, 0x36, 0x3f, 0xf7, 0xcc, 0x34, 0xa5, 0xe5, 0xf1, 0x71, 0xd8, 0x31, 0x15,
+    0x04, 0xc7, 0x23, 0xc3, 0x18, 0x96, 0x05, 0x9a, 0x07, 0x12, 0x80, 0xe2, 0xeb, 0x27, 0xb2, 0x75,
+    0x09, 0x83, 0x2c, 0x1a, 0x1b, 0x6e, 0x5a, 0xa0, 0x52, 0x3b, 0xd6, 0xb3, 0x29, 0xe3, 0x2f, 0x84,
+    0x53, 0xd1, 0x00, 0xed, 0x20, 0xfc, 0xb1, 0x5b, 0x6a, 0xcb, 0xbe, 0x39, 0x4a, 0x4c, 0x58, 0xcf,
+    0xd0, 0xef, 0xaa, 0xfb, 0x43, 0x4d, 0x33, 0x85, 0x45, 0xf9, 0x02, 0x7f, 0x50, 0x3c, 0x9f, 0xa8,
+    0x51, 0xa3, 0x40, 0x8f, 0x92, 0x9d, 0x38, 0xf5, 0xbc, 0xb6, 0xda, 0x21, 0x10, 0xff, 0xf3, 0xd2,
+    0xcd, 0x0c, 0x13, 0xec, 0x5f, 0x97, 0x44, 0x17, 0xc4, 0xa7, 0x7e, 0x3d, 0x64, 0x5d, 0x19, 0x73,
+    0x60, 0x81, 0x4f, 0xdc, 0x22, 0x2a, 0x90, 0x88, 0x46, 0xee, 0xb8, 0x14, 0xde, 0x5e, 0x0b, 0xdb,
+    0xe0, 0x32, 0x3a, 0x0a, 0x49, 0x06, 0x24, 0x5c, 0xc2, 0xd3, 0xac, 0x62, 0x91, 0x95, 0xe4, 0x79,
+    0xe7, 0xc8, 0x37, 0x6d, 0x8d, 0xd5, 0x4e, 0xa9, 0x6c, 0x56, 0xf4, 0xea, 0x65, 0x7a, 0xae, 0x08,
+    0xba, 0x78, 0x25, 0x2e, 0x1c, 0xa6, 0xb4, 0xc6, 0xe8, 0xdd, 0x74, 0x1f, 0x4b, 0xbd, 0x8b, 0x8a,
+    0x70, 0x3e, 0xb5, 0x66, 0x48, 0x03, 0xf6, 0x0e, 0x61, 0x35, 0x57, 0xb9, 0x86, 0xc1, 0x1d, 0x9e,
+    0xe1, 0xf8, 0x98, 0x11, 0x69, 0xd9, 0x8e, 0x94, 0x9b, 0x1e, 0x87, 0xe9, 0xce, 0x55, 0x28, 0xdf,
+    0x8c, 0xa1, 0x89, 0x0d, 0xbf, 0xe6, 0x42, 0x68, 0x41, 0x99, 0x2d, 0x0f, 0xb0, 0x54, 0xbb, 0x16], np.uint8)
+# fmt: on
+
+# Inverse S-box, derived from S_BOX rather than typed out (S_BOX is a permutation of 0..255)
+INV_S_BOX = np.argsort(S_BOX).astype(np.uint8)
+
+# Key schedule round constants Rcon[i] = x^(i-1) in GF(2^8), 1-based as in FIPS-197
+# (only 10 are needed for all AES key lengths)
+RCON = [0x00, 0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1B, 0x36]
+
+# ShiftRows as a permutation of the 16 state bytes when the state is kept in
+# column-major order (i.e. the same order as the input/output byte stream)
+SHIFT_ROWS = np.array([r + 4 * ((c + r) % 4) for c in range(4) for r in range(4)])
+
+# Rotations of the rows within a column used by the batched MixColumns
+ROT_1 = [1, 2, 3, 0]
+ROT_2 = [2, 3, 0, 1]
+ROT_3 = [3, 0, 1, 2]
+
+
+def build_ttables(s_box):
+    # T-tables combine SubBytes, ShiftRows and MixColumns into lookups on 32-bit column words
+    # T0[x] is the column (2*S[x], S[x], S[x], 3*S[x]) packed big-endian, T1..T3 are its byte rotations
+    s = s_box.astype(np.uint32)
+    s2 = ((s << 1) ^ ((s >> 7) * 0x1B)) & 0xFF
+    s3 = s2 ^ s
+    t0 = (s2 << 24) | (s << 16) | (s << 8) | s3
+    t1 = (t0 >> 8) | (t0 << 24)
+    t2 = (t0 >> 16) | (t0 << 16)
+    t3 = (t0 >> 24) | (t0 << 8)
+    return tuple(t.astype(np.uint32) for t in (t0, t1, t2, t3))
+
+
+# Built once per process and shared by every AES instance
+T0, T1, T2, T3 = build_ttables(S_BOX)
+T0_LIST, T1_LIST, T2_LIST, T3_LIST = T0.tolist(), T1.tolist(), T2.tolist(), T3.tolist()
+S_BOX_LIST = S_BOX.tolist()
+
+# The same tables with each entry's big-endian bytes reinterpreted as a native word, so the batched
+# engine can XOR words while the state stays in byte-stream order regardless of platform endianness
+T0_STREAM, T1_STREAM, T2_STREAM, T3_STREAM = (t.astype(">u4").view(np.uint32) for t in (T0, T1, T2, T3))
+
+# State byte that feeds T0..T3 for each output column (ShiftRows picks row r from column c + r)
+TTABLE_ROW_0 = SHIFT_ROWS[0::4]
+TTABLE_ROW_1 = SHIFT_ROWS[1::4]
+TTABLE_ROW_2 = SHIFT_ROWS[2::4]
+TTABLE_ROW_3 = SHIFT_ROWS[3::4]
+
+# Block engines selectable with AES(..., engine=...):
+#   "reference": the step-by-step FIPS-197 implementation, one block at a time
+#   "numpy": every round applied to the whole batch of blocks with NumPy indexing
+#   "ttable": rounds done as T-table lookups and XORs on 32-bit words
+#   "openssl": the system's libcrypto through ctypes (see openssl_aes.py), AES-NI where available
+# The key derivation and key schedule are the same whatever the engine, only the block work moves
+ENGINES = ("reference", "numpy", "ttable", "openssl")
+
+# The default engine is the first of these that is available and passes the known-answer tests at import,
+# unless the AES_ENGINE environment variable names one
+ENGINE_PREFERENCE = ("openssl", "numpy", "reference")
+ENGINE_ENV = "AES_ENGINE"
+DEFAULT_ENGINE = None  # Set at the end of the module by select_engine()
+
+# FIPS-197 Appendix C known-answer vectors: (key, plaintext, ciphertext)
+FIPS197_VECTORS = [
+    ("000102030405060708090a0b0c0d0e0f",
+     "00112233445566778899aabbccddeeff", "69c4e0d86a7b0430d8cdb78070b4c55a"),
+    ("000102030405060708090a0b0c0d0e0f1011121314151617",
+     "00112233445566778899aabbccddeeff", "dda97ca4864cdfe06eaf70a0ec0d7191"),
+    ("000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f",
+     "00112233445566778899aabbccddeeff", "8ea2b7ca516745bfeafc49904b496089"),
+]
+
+
+def self_test(engine=None, quick=False):
+    # Checks an engine against the FIPS-197 vectors and, unless quick, against the reference engine
+    # on random blocks
+    # Failures raise AssertionError explicitly rather than through assert statements, which python -O
+    # strips: select_engine must never pick a broken engine
+    engine = engine or DEFAULT_ENGINE
+    for key, plaintext, ciphertext in FIPS197_VECTORS:
+        cipher = AES.from_key(bytes.fromhex(key), engine=engine)
+        if bytes(cipher.encrypt(bytes.fromhex(plaintext))).hex() != ciphertext:
+            raise AssertionError(
+                f"AES engine '{engine}' failed the FIPS-197 AES-{cipher.key_len} vector (single block).")
+        if cipher.encrypt_blocks(bytes.fromhex(plaintext * 3)).tobytes().hex() != ciphertext * 3:
+            raise AssertionError(f"AES engine '{engine}' failed the FIPS-197 AES-{cipher.key_len} vector (batch).")
+    if quick:
+        return True
+
+    rng = np.random.default_rng(197)
+    key = rng.integers(0, 256, 32, dtype=np.uint8).tobytes()
+    blocks = rng.integers(0, 256, (64, 16), dtype=np.uint8)
+    expected = AES.from_key(key, engine="reference").encrypt_blocks(blocks)
+    if not np.array_equal(AES.from_key(key, engine=engine).encrypt_blocks(blocks), expected):
+        raise AssertionError(f"AES engine '{engine}' does not match the reference engine.")
+    return True
+
 
 class AES:
-    def __init__(self, password_str, salt, key_len=256):
+    def __init__(self, password_str, salt, key_len=256, engine=None):
         self.block_size = 16
         self.salt = salt
         self.key_len = key_len
         self.password = password_str.encode("UTF-8")
         self.key, self.hmac_key = self.KeyGeneration(self.password, self.salt)
 
+        self._setup(engine)
+
+    @classmethod
+    def from_key(cls, key, engine=None, hmac_key=None):
+        # Builds a cipher straight from a raw 16/24/32-byte AES key, skipping the scrypt derivation
+        # (used for the known-answer tests and for keys derived per message from a session key)
+        cipher = cls.__new__(cls)
+        cipher.block_size = 16
+        cipher.salt = None
+        cipher.key_len = len(key) * 8
+        cipher.password = None
+        cipher.key = np.frombuffer(key, dtype=np.uint8).reshape((len(key) // 4, 4))
+        cipher.hmac_key = hmac_key
+        cipher._setup(engine)
+        return cipher
+
+    @classmethod
+    def from_round_keys(cls, round_keys, engine=None):
+        # Rebuilds a cipher from an already expanded (rounds + 1, 16) key schedule, e.g. in a worker
+        # process that received the round keys instead of the password
+        if not isinstance(round_keys, np.ndarray):
+            round_keys = np.frombuffer(round_keys, dtype=np.uint8)
+        round_keys = round_keys.astype(np.uint8).reshape(-1, 16)
+        cipher = cls.__new__(cls)
+        cipher.block_size = 16
+        cipher.salt = None
+        cipher.key_len = (len(round_keys) - 7) * 32
+        cipher.password = None
+        cipher.key = None
+        cipher.hmac_key = None
+        cipher._setup(engine, keys=[k.reshape((4, 4), order="F") for k in round_keys])
+        return cipher
+
+    def _setup(self, engine, keys=None):
+        engine = engine or DEFAULT_ENGINE
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown AES engine '{engine}', expected one of {ENGINES}")
+        self.engine = engine
+
         # AES number of rounds (key_len, rounds): (128, 10), (192,12), (256, 14)
         self.rounds = self.key_len // 32 + 6
 
-        # turn off black formatting
-        # fmt: off
-        self.S_box = np.array(
-            [0x63, 0x7c, 0x77, 0x7b, 0xf2, 0x6b, 0x6f, 0xc5, 0x30, 0x01, 0x67, 0x2b, 0xfe, 0xd7, 0xab, 0x76,
-            0xca, 0x82, 0xc9, 0x7d, 0xfa, 0x59, 0x47, 0xf0, 0xad, 0xd4, 0xa2, 0xaf, 0x9c, 0xa4, 0x72, 0xc0,
-            0xb7, 0xfd, 0x93, 0x26, 0x36, 0x3f, 0xf7, 0xcc, 0x34, 0xa5, 0xe5, 0xf1, 0x71, 0xd8, 0x31, 0x15,
-            0x04, 0xc7, 0x23, 0xc3, 0x18, 0x96, 0x05, 0x9a, 0x07, 0x12, 0x80, 0xe2, 0xeb, 0x27, 0xb2, 0x75,
-            0x09, 0x83, 0x2c, 0x1a, 0x1b, 0x6e, 0x5a, 0xa0, 0x52, 0x3b, 0xd6, 0xb3, 0x29, 0xe3, 0x2f, 0x84,
-            0x53, 0xd1, 0x00, 0xed, 0x20, 0xfc, 0xb1, 0x5b, 0x6a, 0xcb, 0xbe, 0x39, 0x4a, 0x4c, 0x58, 0xcf,
-            0xd0, 0xef, 0xaa, 0xfb, 0x43, 0x4d, 0x33, 0x85, 0x45, 0xf9, 0x02, 0x7f, 0x50, 0x3c, 0x9f, 0xa8,
-            0x51, 0xa3, 0x40, 0x8f, 0x92, 0x9d, 0x38, 0xf5, 0xbc, 0xb6, 0xda, 0x21, 0x10, 0xff, 0xf3, 0xd2,
-            0xcd, 0x0c, 0x13, 0xec, 0x5f, 0x97, 0x44, 0x17, 0xc4, 0xa7, 0x7e, 0x3d, 0x64, 0x5d, 0x19, 0x73,
-            0x60, 0x81, 0x4f, 0xdc, 0x22, 0x2a, 0x90, 0x88, 0x46, 0xee, 0xb8, 0x14, 0xde, 0x5e, 0x0b, 0xdb,
-            0xe0, 0x32, 0x3a, 0x0a, 0x49, 0x06, 0x24, 0x5c, 0xc2, 0xd3, 0xac, 0x62, 0x91, 0x95, 0xe4, 0x79,
-            0xe7, 0xc8, 0x37, 0x6d, 0x8d, 0xd5, 0x4e, 0xa9, 0x6c, 0x56, 0xf4, 0xea, 0x65, 0x7a, 0xae, 0x08,
-            0xba, 0x78, 0x25, 0x2e, 0x1c, 0xa6, 0xb4, 0xc6, 0xe8, 0xdd, 0x74, 0x1f, 0x4b, 0xbd, 0x8b, 0x8a,
-            0x70, 0x3e, 0xb5, 0x66, 0x48, 0x03, 0xf6, 0x0e, 0x61, 0x35, 0x57, 0xb9, 0x86, 0xc1, 0x1d, 0x9e,
-            0xe1, 0xf8, 0x98, 0x11, 0x69, 0xd9, 0x8e, 0x94, 0x9b, 0x1e, 0x87, 0xe9, 0xce, 0x55, 0x28, 0xdf,
-            0x8c, 0xa1, 0x89, 0x0d, 0xbf, 0xe6, 0x42, 0x68, 0x41, 0x99, 0x2d, 0x0f, 0xb0, 0x54, 0xbb, 0x16], np.uint8)
-        # fmt: on
-
-        self.keys = self.KeyExpansion(key=self.key, rounds=self.rounds)
+        self.S_box = S_BOX
+
+        if keys is None:
+            keys = self.KeyExpansion(key=self.key, rounds=self.rounds)
+        self.keys = keys
+
+        # Round keys flattened to 16 bytes in column-major order for the batched engine
+        self.round_keys = np.asarray([k.flatten(order="F") for k in self.keys], dtype=np.uint8)
+
+        # Round keys as big-endian 32-bit column words for the T-table engine
+        self.round_words_list = self.round_keys.view(">u4").astype(np.uint32).tolist()
+        self.round_words_native = self.round_keys.view(np.uint32)
+
+        # The first key_len bits of the schedule are the AES key itself, which is what OpenSSL takes
+        # (also when the cipher was rebuilt from round keys only)
+        self.native = None
+        if engine == "openssl":
+            self.native = openssl_aes.OpenSSLAES(self.round_keys.reshape(-1)[:self.key_len // 8].tobytes())
 
     def KeyGeneration(self, password, salt):
         n_bytes = self.key_len // 8
@@ -52,34 +206,26 @@ class AES:
         return (key, hmac_key)
 
     def KeyExpansion(self, key, rounds):
-        # Generating rcon by doubling rcon's previous value in GF(2^8)
-        # Only need 10 total rcon values for all AES key lengths (rcon list uses 1-based indexing)
-        rcon = [np.zeros(4, dtype="uint8") for _ in range(11)]
-        rcon[1][0] = 1
-        for i in range(2, 11):
-            rcon[i][0] = (rcon[i - 1][0] << 1) ^ (0x11B & -(rcon[i - 1][0] >> 7))
-
         # N is the length of the key in 32-bit words (i.e. 4-byte words)
         N = self.key_len // 32
         # R is the number of round keys needed: 11 round keys for AES-128, 13 keys for AES-192, and 15 keys for AES-256
         R = rounds + 1
 
-        # Expanded keys for R rounds in 32-bit words (i.e. 4-byte words)
-        keys = np.asarray([np.zeros(4, dtype="uint8") for _ in range(4 * R)])
+        # Expanded keys for R rounds in 32-bit words (i.e. 4-byte words), as lists of 4 byte values:
+        # a few hundred small operations, cheaper on Python ints than as NumPy calls
+        s = S_BOX_LIST
+        words = np.asarray(key, dtype=np.uint8).reshape(N, 4).tolist()
 
-        for i in range(4 * R):
-            if i < N:
-                keys[i] = key[i]
-            elif i % N == 0:
-                keys[i] = (
-                    keys[i - N] ^ self.S_box[np.roll(keys[i - 1], -1)] ^ rcon[i // N]
-                )
+        for i in range(N, 4 * R):
+            temp = words[i - 1]
+            if i % N == 0:
+                # RotWord, SubWord and the round constant
+                temp = [s[temp[1]] ^ RCON[i // N], s[temp[2]], s[temp[3]], s[temp[0]]]
             elif (N > 6) and (i % N == 4):
-                keys[i] = keys[i - N] ^ self.S_box[keys[i - 1]]
-            else:
-                keys[i] = keys[i - N] ^ keys[i - 1]
+                temp = [s[b] for b in temp]
+            words.append([a ^ b for a, b in zip(words[i - N], temp)])
 
-        keys = np.split(keys, R)
+        keys = np.split(np.asarray(words, dtype=np.uint8), R)
         keys = [np.transpose(i) for i in keys]
         return keys
 
@@ -128,6 +274,12 @@ class AES:
     def encrypt(self, plaintext):
         assert len(plaintext) == self.block_size, "Plaintext must be 128 bits."
 
+        if self.engine == "ttable":
+            return self.encrypt_ttable_block(plaintext)
+        if self.engine == "openssl":
+            block = np.frombuffer(bytes(plaintext), dtype=np.uint8)
+            return self.native.encrypt_blocks(block, np.empty(self.block_size, dtype=np.uint8))
+
         state = (np.frombuffer(plaintext, dtype=np.uint8).reshape((4, 4), order="F").copy())
 
         state = self.AddRoundKey(state=state, key=self.keys[0])
@@ -144,4 +296,112 @@ class AES:
 
         ciphertext = state.flatten(order="F")
 
-        return ciphertext
\ No newline at end of file
+        return ciphertext
+
+    def MixColumnsBlocks(self, state):
+        # Same GF(2^8) arithmetic as MixColumns, applied to every column of every block at once
+        # 'state' is an (N, 16) array, viewed as (N, 4 columns, 4 rows)
+        cols = state.reshape(-1, 4, 4)
+        b = (cols << 1) ^ ((cols >> 7) * np.uint8(0x1B))
+
+        # row r of the mixed column is b[r] ^ b[r+1] ^ col[r+1] ^ col[r+2] ^ col[r+3]
+        mixed = (
+            b ^ b[:, :, ROT_1]
+            ^ cols[:, :, ROT_1] ^ cols[:, :, ROT_2] ^ cols[:, :, ROT_3]
+        )
+        return mixed.reshape(-1, self.block_size)
+
+    def encrypt_blocks(self, blocks):
+        # Encrypts N blocks in one pass: 'blocks' is an (N, 16) uint8 array (or bytes of length N * 16)
+        # Every round is applied to the whole batch with NumPy indexing instead of block by block
+        if isinstance(blocks, np.ndarray):
+            state = blocks.astype(np.uint8, copy=False)
+        else:
+            state = np.frombuffer(blocks, dtype=np.uint8)
+        assert state.size % self.block_size == 0, "Input must be a whole number of 128-bit blocks."
+        state = state.reshape(-1, self.block_size)
+
+        if self.engine == "reference":
+            return np.asarray([self.encrypt(block.tobytes()) for block in state], dtype=np.uint8).reshape(-1, self.block_size)
+        if self.engine == "ttable":
+            return self.encrypt_ttable_blocks(state)
+        if self.engine == "openssl":
+            state = np.ascontiguousarray(state)
+            return self.native.encrypt_blocks(state, np.empty_like(state))
+
+        state = state ^ self.round_keys[0]
+
+        for i in range(1, self.rounds):
+            # SubBytes and ShiftRows commute, so both are a single lookup
+            state = self.S_box[state[:, SHIFT_ROWS]]
+            state = self.MixColumnsBlocks(state=state)
+            state ^= self.round_keys[i]
+
+        state = self.S_box[state[:, SHIFT_ROWS]]
+        state ^= self.round_keys[self.rounds]
+
+        return state
+
+    def encrypt_ttable_blocks(self, state):
+        # T-table rounds over an (N, 16) batch, 4 lookups per column word
+        # The state stays in byte-stream order and is viewed as native 32-bit words for the XORs
+        words = np.ascontiguousarray(state).view(np.uint32) ^ self.round_words_native[0]
+
+        for i in range(1, self.rounds):
+            state = words.view(np.uint8)
+            words = T0_STREAM[state.take(TTABLE_ROW_0, axis=1)]
+            words ^= T1_STREAM[state.take(TTABLE_ROW_1, axis=1)]
+            words ^= T2_STREAM[state.take(TTABLE_ROW_2, axis=1)]
+            words ^= T3_STREAM[state.take(TTABLE_ROW_3, axis=1)]
+            words ^= self.round_words_native[i]
+
+        # Last round has no MixColumns, so it is a plain S-box lookup
+        state = self.S_box[words.view(np.uint8)[:, SHIFT_ROWS]]
+        state ^= self.round_keys[self.rounds]
+        return state
+
+    def encrypt_ttable_block(self, plaintext):
+        # Single block T-table rounds on Python ints, which avoids NumPy call overhead for one block
+        keys = self.round_words_list
+        s0, s1, s2, s3 = (int.from_bytes(plaintext[i:i + 4], "big") ^ keys[0][i // 4] for i in range(0, 16, 4))
+
+        for i in range(1, self.rounds):
+            k = keys[i]
+            s0, s1, s2, s3 = (
+                T0_LIST[s0 >> 24] ^ T1_LIST[(s1 >> 16) & 0xFF] ^ T2_LIST[(s2 >> 8) & 0xFF] ^ T3_LIST[s3 & 0xFF] ^ k[0],
+                T0_LIST[s1 >> 24] ^ T1_LIST[(s2 >> 16) & 0xFF] ^ T2_LIST[(s3 >> 8) & 0xFF] ^ T3_LIST[s0 & 0xFF] ^ k[1],
+                T0_LIST[s2 >> 24] ^ T1_LIST[(s3 >> 16) & 0xFF] ^ T2_LIST[(s0 >> 8) & 0xFF] ^ T3_LIST[s1 & 0xFF] ^ k[2],
+                T0_LIST[s3 >> 24] ^ T1_LIST[(s0 >> 16) & 0xFF] ^ T2_LIST[(s1 >> 8) & 0xFF] ^ T3_LIST[s2 & 0xFF] ^ k[3],
+            )
+
+        s = S_BOX_LIST
+        k = keys[self.rounds]
+        out = b"".join(
+            (((s[a >> 24] << 24) | (s[(b >> 16) & 0xFF] << 16) | (s[(c >> 8) & 0xFF] << 8) | s[d & 0xFF]) ^ k[j]).to_bytes(4, "big")
+            for j, (a, b, c, d) in enumerate(((s0, s1, s2, s3), (s1, s2, s3, s0), (s2, s3, s0, s1), (s3, s0, s1, s2)))
+        )
+        return np.frombuffer(out, dtype=np.uint8)
+
+
+def available_engines():
+    # Engines that can run here ("openssl" needs libcrypto)
+    return tuple(e for e in ENGINES if e != "openssl" or openssl_aes.available())
+
+
+def select_engine():
+    forced = os.environ.get(ENGINE_ENV)
+    if forced:
+        if forced not in ENGINES:
+            raise ValueError(f"{ENGINE_ENV}={forced} is not one of {ENGINES}")
+        self_test(forced, quick=True)
+        return forced
+    for engine in ENGINE_PREFERENCE:
+        try:
+            self_test(engine, quick=True)
+            return engine
+        except (AssertionError, OSError, ValueError):
+            continue
+    raise RuntimeError("No AES engine passed its self-test.")
+
+
+DEFAULT_ENGINE = select_engine()
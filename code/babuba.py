@@ -1,33 +1,249 @@
+import argparse
 import asyncio
+import itertools
+import json
+import logging
+import struct
+
 import websockets
-import socket
 
 BACKEND_HOST = "127.0.0.1"
 BACKEND_PORT = 5000
 FRONTEND_PORT = 8000
 
-async def handle_websocket(websocket, path):
-    """Handle incoming WebSocket messages and forward to the backend server."""
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as backend_socket:
-        backend_socket.connect((BACKEND_HOST, BACKEND_PORT))
+# Backend connections shared by all WebSocket clients, and the requests each one may have in flight
+POOL_SIZE = 4
+MAX_IN_FLIGHT = 256
+# Requests a single WebSocket may have pipelined before the relay stops reading from it
+MAX_PIPELINE = 32
+REQUEST_TIMEOUT = 5.0
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Frames on backend connections: request id (4) | payload length (4) | payload, big-endian.
+# A response carries the id of its request, so responses may come back in any order.
+FRAME_HEADER = struct.Struct(">II")
+
+logger = logging.getLogger("securechat.relay")
+
+
+class BackendConnection:
+    """One backend connection multiplexing many pipelined requests"""
+
+    def __init__(self, reader, writer, max_in_flight=MAX_IN_FLIGHT):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}  # {request id: Future of the response payload}
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.ids = itertools.count(1)
+        self.closed = False
+        self.reader_task = asyncio.create_task(self.read_responses())
+
+    async def request(self, payload, timeout):
+        # Waiting for a slot is the backpressure: once max_in_flight requests are out, callers queue here
+        async with self.slots:
+            if self.closed:
+                raise ConnectionError("Backend connection closed")
+            request_id = next(self.ids) & 0xFFFFFFFF
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            try:
+                self.writer.write(FRAME_HEADER.pack(request_id, len(payload)) + payload)
+                await self.writer.drain()
+                return await asyncio.wait_for(future, timeout)
+            finally:
+                # A response arriving after the timeout finds no pending request and is dropped
+                self.pending.pop(request_id, None)
+
+    async def read_responses(self):
+        try:
+            while True:
+                request_id, length = FRAME_HEADER.unpack(await self.reader.readexactly(FRAME_HEADER.size))
+                if length > MAX_FRAME_SIZE:
+                    raise ConnectionError(f"Backend frame of {length} bytes exceeds the limit")
+                payload = await self.reader.readexactly(length)
+                future = self.pending.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result(payload)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.warning(f"Backend connection lost: {e}")
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Backend connection closed"))
+            self.writer.close()
+
+    async def close(self):
+        self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class BackendPool:
+    """Bounded pool of backend connections, opened on demand, each request goes to the least busy one"""
+
+    def __init__(self, host=BACKEND_HOST, port=BACKEND_PORT, size=POOL_SIZE, max_in_flight=MAX_IN_FLIGHT,
+                 timeout=REQUEST_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.connections = []
+        self.lock = asyncio.Lock()
+
+    async def connection(self):
+        self.connections = [c for c in self.connections if not c.closed]
+        idle = [c for c in self.connections if not c.pending]
+        if idle:
+            return idle[0]
+        if len(self.connections) >= self.size:
+            return min(self.connections, key=lambda c: len(c.pending))
+        async with self.lock:
+            # Open one more connection only when all of them are busy and the pool is not full
+            if len(self.connections) < self.size:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                self.connections.append(BackendConnection(reader, writer, self.max_in_flight))
+                return self.connections[-1]
+        return min(self.connections, key=lambda c: len(c.pending))
+
+    async def request(self, payload, timeout=None):
+        connection = await self.connection()
+        return await connection.request(payload, timeout if timeout is not None else self.timeout)
+
+    async def close(self):
+        for connection in self.connections:
+            await connection.close()
+        self.connections = []
+
+
+async def handle_websocket(websocket, pool, max_pipeline=MAX_PIPELINE):
+    """Forward a WebSocket's messages to the backend, answers go back in the order the messages came in"""
+    # Requests run concurrently; the bounded queue of their tasks keeps the replies in order and
+    # stops reading from the WebSocket once max_pipeline of them are outstanding
+    in_flight = asyncio.Queue(max_pipeline)
+
+    async def forward(message):
+        payload = message.encode("utf-8") if isinstance(message, str) else message
+        try:
+            response = await pool.request(payload)
+        except asyncio.TimeoutError:
+            return json.dumps({"type": "error", "message": "Backend timeout"})
+        except (OSError, ConnectionError) as e:
+            return json.dumps({"type": "error", "message": f"Backend unavailable: {e}"})
+        # Text in, text out, as before
+        return response.decode("utf-8", "replace") if isinstance(message, str) else response
+
+    async def reply():
+        while True:
+            task = await in_flight.get()
+            if task is None:
+                return
+            await websocket.send(await task)
+
+    async def put(item):
+        # False once the replier has stopped (closed WebSocket, failed request): nothing takes items out
+        # of the queue any more, so waiting for room in it would block forever
+        if replier.done():
+            return False
+        if not in_flight.full():
+            in_flight.put_nowait(item)
+            return True
+        putter = asyncio.create_task(in_flight.put(item))
+        await asyncio.wait((putter, replier), return_when=asyncio.FIRST_COMPLETED)
+        if putter.done():
+            return True
+        putter.cancel()
+        return False
+
+    replier = asyncio.create_task(reply())
+    try:
         async for message in websocket:
-            print(f"Message from frontend: {message}")
-            
-            # Forward the message to the backend server
-            backend_socket.sendall(message.encode('utf-8'))
-            
-            # Receive the response from the backend
-            response = backend_socket.recv(1024).decode('utf-8')
-            print(f"Response from backend: {response}")
-            
-            # Send the response back to the frontend
-            await websocket.send(response)
-
-async def start_server():
+            logger.debug(f"Message from frontend: {message}")
+            task = asyncio.create_task(forward(message))
+            if not await put(task):
+                task.cancel()
+                break
+        else:
+            if await put(None):
+                await asyncio.wait((replier,))
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        # Requests nobody will answer any more are cancelled, and the replier's error is reported here
+        replier.cancel()
+        while not in_flight.empty():
+            task = in_flight.get_nowait()
+            if task is None:
+                continue
+            if task.done() and not task.cancelled():
+                task.exception()  # Already failed with the replier: the error is reported below
+            task.cancel()
+        if replier.done() and not replier.cancelled():
+            error = replier.exception()
+            if error is not None and not isinstance(error, websockets.ConnectionClosed):
+                logger.error(f"Relaying replies failed: {error!r}")
+
+
+async def stand_in_backend(host=BACKEND_HOST, port=BACKEND_PORT, delay=0.0):
+    """Local backend speaking the relay's framing, for development and load tests.
+    Answers like babubaserver.py, after 'delay' seconds, requests of a connection are handled concurrently"""
+    answers = set()  # Answer tasks, referenced until done so they are not garbage-collected
+
+    async def serve(reader, writer):
+        async def answer(request_id, payload):
+            if delay:
+                await asyncio.sleep(delay)
+            response = f"Data received as:{payload.decode('utf-8', 'replace')}!".encode("utf-8")
+            writer.write(FRAME_HEADER.pack(request_id, len(response)) + response)
+
+        try:
+            while True:
+                request_id, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                task = asyncio.create_task(answer(request_id, await reader.readexactly(length)))
+                answers.add(task)
+                task.add_done_callback(answers.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(serve, host, port)
+
+
+async def start_server(backend_host=BACKEND_HOST, backend_port=BACKEND_PORT, port=FRONTEND_PORT,
+                       pool_size=POOL_SIZE, timeout=REQUEST_TIMEOUT, stand_in=False):
     """Start the WebSocket server."""
-    print(f"WebSocket server running on ws://127.0.0.1:{FRONTEND_PORT}")
-    async with websockets.serve(handle_websocket, "127.0.0.1", FRONTEND_PORT):
-        await asyncio.Future()  # Run forever
+    if stand_in:
+        await stand_in_backend(backend_host, backend_port)
+        logger.info(f"Stand-in backend on {backend_host}:{backend_port}")
+    pool = BackendPool(backend_host, backend_port, pool_size, timeout=timeout)
+    logger.info(f"WebSocket server running on ws://127.0.0.1:{port}")
+    try:
+        async with websockets.serve(lambda websocket: handle_websocket(websocket, pool), "127.0.0.1", port):
+            await asyncio.Future()  # Run forever
+    finally:
+        await pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket to backend relay")
+    parser.add_argument("--port", type=int, default=FRONTEND_PORT)
+    parser.add_argument("--backend-host", default=BACKEND_HOST)
+    parser.add_argument("--backend-port", type=int, default=BACKEND_PORT)
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE)
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="per-request backend timeout")
+    parser.add_argument("--stand-in", action="store_true", help="also run a local stand-in backend")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format="[%(asctime)s] [%(levelname)s] %(message)s")
+    asyncio.run(start_server(args.backend_host, args.backend_port, args.port, args.pool_size, args.timeout,
+                             args.stand_in))
+
 
 if __name__ == '__main__':
-    asyncio.run(start_server())
+    main()
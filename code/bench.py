@@ -0,0 +1,519 @@
+# Benchmarks: AES blocks, key schedule, scrypt, CTR payloads, seekable containers, the end-to-end message path
+# the chat server's message routing, JSON + base64 against binary frames, and the babuba relay
+# Usage: python bench.py [--suites crypto routing framing relay] [--quick] [--output bench.json] [--compare old.json]
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+import numpy as np
+import websockets
+
+import aes
+import babuba
+import client
+import container
+import crypto_pool
+import frames
+import gcm
+import handshake
+import history
+from aes import AES
+from ctr import CTR
+from server import SecureChatServer
+
+KB = 1024
+MB = 1024 * KB
+
+# CTR payload sizes, and the largest payload each engine is timed on
+# (the reference engine encrypts one block per Python call, about 1 ms each)
+CTR_SIZES = [1 * KB, 64 * KB, 1 * MB, 64 * MB]
+ENGINE_MAX_SIZE = {"reference": 1 * KB}
+
+# Largest payload the table-driven GHASH is timed on (about 10 MB/s)
+GCM_TABLES_MAX_SIZE = 1 * MB
+
+# Container file sizes, and the size of the slices read from them at random offsets
+CONTAINER_SIZES = [1 * MB, 64 * MB]
+CONTAINER_READ_SIZE = 4 * KB
+
+# Message sizes for the encrypt_file / decrypt_file_chunks round trip
+MESSAGE_SIZES = [64, 1 * KB, 64 * KB, 1 * MB]
+
+# Connected user counts for the routing benchmark, the routing cost should not grow with them
+ROUTING_USERS = [10, 100, 1000, 10000]
+
+# Ciphertext sizes for the JSON / binary frame comparison
+FRAME_SIZES = [64, 1 * KB, 16 * KB, 64 * KB]
+
+# Concurrent WebSocket clients for the relay load test, against babuba's stand-in backend
+RELAY_CLIENTS = [1, 10, 100]
+
+# Import-time budgets in ms, checked on the best of several fresh interpreters run with
+# python -X importtime, and modules each import must not pull in (the client loads NumPy and
+# the crypto modules on first use, so starting it stays cheap; asyncio is about 50 ms of its budget)
+STARTUP_BUDGET_MS = {"client": 120, "server": 250, "aes": 400}
+STARTUP_EXCLUDED = {"client": ("numpy", "aes", "crypto_pool")}
+
+SUITES = ("crypto", "routing", "framing", "relay", "startup")
+
+
+def percentile(samples, q):
+    return float(np.percentile(samples, q))
+
+
+def measure(func, repeat, min_time=0.0):
+    # Calls func 'repeat' times (or until min_time seconds passed) and returns the per-call latencies
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < repeat or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(name, samples, nbytes=None, **params):
+    result = {
+        "name": name,
+        "params": params,
+        "calls": len(samples),
+        "mean_us": float(np.mean(samples)) * 1e6,
+        "p50_us": percentile(samples, 50) * 1e6,
+        "p90_us": percentile(samples, 90) * 1e6,
+        "p99_us": percentile(samples, 99) * 1e6,
+    }
+    if nbytes is not None:
+        result["mb_per_s"] = nbytes / MB / percentile(samples, 50)
+    label = " ".join(f"{k}={v}" for k, v in params.items())
+    throughput = f" {result['mb_per_s']:10.2f} MB/s" if nbytes is not None else ""
+    print(f"{name:<22} {label:<36} p50 {result['p50_us']:12.1f} us  p99 {result['p99_us']:12.1f} us{throughput}")
+    return result
+
+
+def check_engines(engines):
+    # Fast-but-wrong engines must not be timed: every engine has to pass the FIPS-197 known-answer tests
+    for engine in engines:
+        try:
+            aes.self_test(engine)
+        except AssertionError as e:
+            sys.exit(f"Known-answer test failed, refusing to benchmark: {e}")
+    print(f"FIPS-197 known-answer tests passed for: {', '.join(engines)}")
+    try:
+        handshake.self_test()
+        for engine in engines:
+            gcm.self_test(engine)
+        client.self_test()
+    except AssertionError as e:
+        sys.exit(f"Known-answer test failed, refusing to benchmark: {e}")
+
+
+def bench_block(engines, repeat):
+    results = []
+    key = os.urandom(32)
+    block = os.urandom(16)
+    for engine in engines:
+        cipher = AES.from_key(key, engine=engine)
+        samples = measure(lambda: cipher.encrypt(block), repeat, min_time=0.2)
+        results.append(summarize("aes.encrypt", samples, 16, engine=engine))
+    return results
+
+
+def bench_key_schedule(repeat):
+    cipher = AES.from_key(os.urandom(32))
+    samples = measure(lambda: cipher.KeyExpansion(cipher.key, cipher.rounds), repeat, min_time=0.2)
+    return [summarize("aes.KeyExpansion", samples)]
+
+
+def bench_kdf(repeat):
+    cipher = AES.from_key(os.urandom(32))
+    samples = measure(lambda: cipher.KeyGeneration(b"password", os.urandom(16)), max(3, repeat // 10))
+    return [summarize("aes.KeyGeneration", samples)]
+
+
+def bench_ctr(engines, sizes, workers, repeat):
+    results = []
+    key = os.urandom(32)
+    nonce = os.urandom(10)
+    for size in sizes:
+        data = os.urandom(size)
+        out = bytearray(size)
+        # Fewer repetitions for the big payloads
+        size_repeat = max(3, repeat * 64 * KB // max(size, 64 * KB))
+        for engine in engines:
+            if size > ENGINE_MAX_SIZE.get(engine, size):
+                continue
+            mode = CTR(AES.from_key(key, engine=engine), nonce)
+            samples = measure(lambda: mode.encrypt_into(data, out, 0), size_repeat)
+            results.append(summarize("ctr.encrypt_into", samples, size, engine=engine, size=size, workers=0))
+
+            # Worker pool only pays off on large payloads
+            if size < 1 * MB:
+                continue
+            for n in workers:
+                pool = crypto_pool.EncryptionPool(n)
+                with pool.buffer(mode, size) as buffer:
+                    buffer.data[:] = data
+                    pool.encrypt_shared(buffer, 0)
+                    samples = measure(lambda: pool.encrypt_shared(buffer, 0), size_repeat)
+                pool.shutdown()
+                results.append(summarize("crypto_pool", samples, size, engine=engine, size=size, workers=n))
+    return results
+
+
+def bench_gcm(sizes, repeat):
+    # One-pass GCM against CTR followed by HMAC-SHA256 over the output, with the default engine;
+    # "gcm-tables" is the table-driven GHASH used when the engine has no native GCM
+    cipher = AES.from_key(os.urandom(32), hmac_key=os.urandom(32))
+    iv = os.urandom(gcm.IV_SIZE)
+    results = []
+    for size in sizes:
+        data = os.urandom(size)
+        size_repeat = repeat if size < 64 * MB else max(3, repeat // 10)
+        mode = CTR(cipher, iv[:10])
+        samples = measure(lambda: hmac.digest(cipher.hmac_key, mode.encrypt_buffer(data, 0), hashlib.sha256),
+                          size_repeat)
+        results.append(summarize("payload.encrypt", samples, size, mode="ctr+hmac", size=size))
+        samples = measure(lambda: gcm.GCM(cipher).encrypt(iv, data), size_repeat)
+        results.append(summarize("payload.encrypt", samples, size, mode="gcm", size=size))
+        if size <= GCM_TABLES_MAX_SIZE:
+            tables = gcm.GCM(cipher, native=False)
+            samples = measure(lambda: tables.encrypt(iv, data), max(3, size_repeat // 10))
+            results.append(summarize("payload.encrypt", samples, size, mode="gcm-tables", size=size))
+    return results
+
+
+def bench_container(sizes, repeat):
+    # A small slice read from a container (its one or two segments checked and decrypted) against
+    # decrypting the whole file in-process and across the crypto_pool workers
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.scsf")
+        output = os.path.join(directory, "bench.out")
+        for size in sizes:
+            with open(path, "wb") as file_out:
+                container.encrypt_container("password", io.BytesIO(os.urandom(size)), file_out)
+            size_repeat = repeat if size < 64 * MB else max(3, repeat // 10)
+            with container.ContainerReader("password", path) as reader:
+                offsets = np.random.randint(0, size - CONTAINER_READ_SIZE, size=max(repeat, 100)).tolist()
+                samples = measure(lambda: reader.read_range(offsets.pop(), CONTAINER_READ_SIZE), len(offsets))
+                results.append(summarize("container.read_range", samples, CONTAINER_READ_SIZE, size=size))
+                samples = measure(reader.read_all, size_repeat)
+                results.append(summarize("container.read_all", samples, size, size=size))
+            # The first parallel run starts the pool workers, it is not timed
+            container.decrypt_container("password", path, output, threshold=0)
+            for name, threshold in (("in-process", float("inf")), ("parallel", 0)):
+                samples = measure(lambda: container.decrypt_container("password", path, output, threshold=threshold),
+                                  max(3, size_repeat // 10))
+                results.append(summarize("container.decrypt", samples, size, mode=name, size=size))
+    return results
+
+
+def bench_messages(sizes, repeat):
+    results = []
+    for size in sizes:
+        message = os.urandom(size)
+        ciphertexts = []
+        size_repeat = max(3, repeat // 10)
+        samples = measure(lambda: ciphertexts.append(client.encrypt_file("password", 16, message)), size_repeat)
+        results.append(summarize("client.encrypt_file", samples, size, size=size))
+
+        ciphertexts = iter(ciphertexts)
+        samples = measure(lambda: client.decrypt_file_chunks("password", 16, next(ciphertexts)), size_repeat)
+        results.append(summarize("client.decrypt_file", samples, size, size=size))
+    return results
+
+
+def bench_session(sizes, repeat):
+    # Connection setup (one scrypt run and two X25519 operations per side), then the per-message
+    # cost and wire overhead once the session is up, to compare with client.encrypt_file above
+    def connect():
+        client_side = handshake.ClientHandshake("password")
+        server_side = handshake.ServerHandshake("password")
+        reply = server_side.reply(client_side.hello())
+        finish, channel = client_side.finish(reply)
+        return channel, server_side.finish(finish)
+
+    results = [summarize("handshake.connect", measure(connect, max(3, repeat // 10)))]
+    sender, receiver = connect()
+    for size in sizes:
+        message = os.urandom(size)
+        sealed = []
+        samples = measure(lambda: sealed.append(sender.seal(message)), repeat)
+        results.append(summarize("channel.seal", samples, size, size=size, overhead=handshake.MESSAGE_OVERHEAD))
+        sealed = iter(sealed)
+        samples = measure(lambda: receiver.open(next(sealed)), repeat)
+        results.append(summarize("channel.open", samples, size, size=size))
+    return results
+
+
+class FakeWebSocket:
+    # Stands in for a websockets connection: sending is free, so only the server's own work is timed
+    def __init__(self, index):
+        self.remote_address = ("127.0.0.1", index)
+        self.sent = 0
+
+    async def send(self, message, text=None):
+        self.sent += 1
+
+
+async def populate(server, users, binary=False):
+    connections = [FakeWebSocket(i) for i in range(users)]
+    for i, websocket in enumerate(connections):
+        await server.register(websocket, f"user{i}", "key", binary)
+    return connections
+
+
+def bench_routing(user_counts, repeat):
+    # Time of handle_message for a chat_message, as the number of connected users grows
+    async def run(users):
+        # Presence deltas are held back for the whole run, only routing is timed
+        server = SecureChatServer(presence_window=3600)
+        server.log_message = lambda *args, **kwargs: None
+        connections = await populate(server, users)
+        rng = np.random.default_rng(users)
+        samples = []
+        for _ in range(max(repeat, 200)):
+            sender, recipient = rng.integers(0, users, 2)
+            message = json.dumps({
+                "type": "chat_message", "recipient": f"user{recipient}", "encrypted_content": "AAAA"
+            })
+            start = time.perf_counter()
+            await server.handle_message(connections[sender], message)
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    results = []
+    for users in user_counts:
+        samples = asyncio.run(run(users))
+        results.append(summarize("server.route", samples, users=users))
+    return results
+
+
+def bench_framing(sizes, repeat):
+    # Server-side cost of one chat message, JSON with base64 ciphertext against a binary frame,
+    # both forwarded to a recipient using the same format
+    async def run(binary, message):
+        server = SecureChatServer(presence_window=3600)
+        server.log_message = lambda *args, **kwargs: None
+        sender, _ = await populate(server, 2, binary)
+        handle = server.handle_frame if binary else server.handle_message
+        samples = []
+        for _ in range(max(repeat, 200)):
+            start = time.perf_counter()
+            await handle(sender, message)
+            samples.append(time.perf_counter() - start)
+            # Let the writer tasks drain the queues, outside the timed section
+            await asyncio.sleep(0)
+        return samples
+
+    results = []
+    for size in sizes:
+        ciphertext = os.urandom(size)
+        json_message = json.dumps({
+            "type": "chat_message", "recipient": "user1",
+            "encrypted_content": base64.b64encode(ciphertext).decode("ascii"), "counter": 0
+        })
+        frame = frames.pack_header(frames.FRAME_CHAT, 2, size) + ciphertext
+        for fmt, message in (("json", json_message), ("binary", frame)):
+            samples = asyncio.run(run(fmt == "binary", message))
+            results.append(summarize("server.frame", samples, size, format=fmt, size=size, wire=len(message)))
+    return results
+
+
+def bench_stream(sizes, repeat):
+    # Cutting the client's TCP stream into length-prefixed frames, 1 MB of frames arriving in 64 KB reads
+    results = []
+    for size in sizes:
+        payload = os.urandom(size)
+        stream = b"".join(frames.stream_header(payload) + payload for _ in range(max(1, MB // size)))
+        reads = [stream[i:i + 64 * KB] for i in range(0, len(stream), 64 * KB)]
+
+        def decode():
+            decoder = frames.FrameDecoder()
+            for data in reads:
+                decoder.feed(data)
+
+        samples = measure(decode, repeat, min_time=0.2)
+        results.append(summarize("client.stream_decode", samples, len(stream), size=size))
+    return results
+
+
+def bench_relay(client_counts, requests):
+    # Latency of requests through the relay, every client pipelining 'requests' 64-byte messages
+    async def run(clients):
+        backend = await babuba.stand_in_backend("127.0.0.1", 0)
+        pool = babuba.BackendPool("127.0.0.1", backend.sockets[0].getsockname()[1])
+        relay = await websockets.serve(lambda websocket: babuba.handle_websocket(websocket, pool), "127.0.0.1", 0)
+        url = f"ws://127.0.0.1:{relay.sockets[0].getsockname()[1]}"
+        samples = []
+
+        async def client():
+            async with websockets.connect(url) as websocket:
+                sent = deque()
+
+                async def send_all():
+                    for _ in range(requests):
+                        sent.append(time.perf_counter())
+                        await websocket.send("x" * 64)
+
+                sender = asyncio.create_task(send_all())
+                # Replies come back in order, each one answers the oldest outstanding request
+                for _ in range(requests):
+                    await websocket.recv()
+                    samples.append(time.perf_counter() - sent.popleft())
+                await sender
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+        relay.close()
+        await relay.wait_closed()
+        await pool.close()
+        backend.close()
+        await backend.wait_closed()
+        return samples, elapsed
+
+    results = []
+    for clients in client_counts:
+        samples, elapsed = asyncio.run(run(clients))
+        result = summarize("relay.request", samples, clients=clients, requests=requests)
+        result["requests_per_s"] = len(samples) / elapsed
+        print(f"{'':<22} {'':<36} {result['requests_per_s']:.0f} requests/s")
+        results.append(result)
+    return results
+
+
+def import_times(module):
+    # Imports 'module' in a fresh interpreter, returns {module name: cumulative import time in seconds}
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():  # Skips the column header
+            times[name.strip()] = int(cumulative) * 1e-6
+    return times
+
+
+def bench_startup(budgets, runs):
+    # Exits with an error when an import goes over its budget or pulls in an excluded module
+    results = []
+    failures = []
+    for module, budget_ms in budgets.items():
+        runs_times = [import_times(module) for _ in range(runs)]
+        samples = [times[module] for times in runs_times]
+        result = summarize("startup.import", samples, module=module)
+        result["budget_ms"] = budget_ms
+        results.append(result)
+        best_ms = min(samples) * 1e3
+        if best_ms > budget_ms:
+            failures.append(f"import {module} took {best_ms:.1f} ms, the budget is {budget_ms} ms")
+        failures += [f"import {module} pulls in {name}" for name in STARTUP_EXCLUDED.get(module, ())
+                     if name in runs_times[0]]
+    if failures:
+        sys.exit("Startup budget exceeded:\n  " + "\n  ".join(failures))
+    print(f"Import times within budget: {', '.join(f'{m} {b} ms' for m, b in budgets.items())}")
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results, baseline_path):
+    # Prints the p50 ratio against a previous run, matched by name and parameters
+    with open(baseline_path) as f:
+        baseline = {
+            (r["name"], json.dumps(r["params"], sort_keys=True)): r for r in json.load(f)["results"]
+        }
+    print(f"\nCompared with {baseline_path} (p50 speed-up, >1 is faster):")
+    for r in results:
+        old = baseline.get((r["name"], json.dumps(r["params"], sort_keys=True)))
+        if old:
+            label = " ".join(f"{k}={v}" for k, v in r["params"].items())
+            print(f"{r['name']:<22} {label:<36} x{old['p50_us'] / r['p50_us']:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Secure chat benchmarks")
+    parser.add_argument("--suites", nargs="+", default=list(SUITES), choices=SUITES)
+    parser.add_argument("--engines", nargs="+", default=list(aes.available_engines()), choices=aes.ENGINES)
+    parser.add_argument("--workers", nargs="+", type=int, default=None,
+                        help="worker counts for the pool benchmark (default: 1 .. cpu count)")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--quick", action="store_true", help="fewer repetitions and no 64 MB payload")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="JSON file of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    sizes = CTR_SIZES
+    message_sizes = MESSAGE_SIZES
+    repeat = args.repeat
+    if args.quick:
+        sizes = [s for s in CTR_SIZES if s < 64 * MB]
+        message_sizes = [s for s in MESSAGE_SIZES if s < 1 * MB]
+        repeat = min(repeat, 10)
+    workers = args.workers or list(range(1, (os.cpu_count() or 1) + 1))
+
+    results = []
+    if "crypto" in args.suites:
+        check_engines(args.engines)
+        results += bench_block(args.engines, repeat)
+        results += bench_key_schedule(repeat)
+        results += bench_kdf(repeat)
+        results += bench_ctr(args.engines, sizes, workers, repeat)
+        results += bench_gcm(sizes, repeat)
+        results += bench_container([s for s in CONTAINER_SIZES if s <= max(sizes)], repeat)
+        results += bench_messages(message_sizes, repeat)
+        results += bench_session(message_sizes, repeat)
+    if "routing" in args.suites:
+        history.self_test()
+        results += bench_routing(ROUTING_USERS, repeat)
+    if "framing" in args.suites:
+        results += bench_framing(FRAME_SIZES, repeat)
+        results += bench_stream(FRAME_SIZES, repeat)
+    if "relay" in args.suites:
+        results += bench_relay(RELAY_CLIENTS, max(repeat, 100))
+    if "startup" in args.suites:
+        results += bench_startup(STARTUP_BUDGET_MS, min(repeat, 10))
+
+    report = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+    return report
+
+
+if __name__ == "__main__":
+    main()
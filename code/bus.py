@@ -0,0 +1,140 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+
+logger = logging.getLogger("securechat.bus")
+
+# Frames between shards: 4-byte big-endian length, then a UTF-8 JSON object
+FRAME_HEADER = struct.Struct(">I")
+
+
+class MessageBus:
+    """Carries routing messages (presence, forwarded chat messages) between server shards
+
+    Backends implement start/send/close; a broker-backed bus (Redis, NATS, ...) only has to
+    deliver each message to the handler of the target shard.
+    """
+
+    def __init__(self, shard_id, shards):
+        self.shard_id = shard_id
+        self.shards = shards
+        self.handler = None  # async callable taking a message dict
+
+    async def start(self, handler):
+        self.handler = handler
+
+    async def send(self, shard, message):
+        raise NotImplementedError
+
+    async def broadcast(self, message):
+        """Send to every other shard"""
+        for shard in range(self.shards):
+            if shard != self.shard_id:
+                await self.send(shard, message)
+
+    async def close(self):
+        pass
+
+
+class LocalHub:
+    """Connects LocalBus instances living in the same process"""
+
+    def __init__(self):
+        self.buses = {}
+
+
+class LocalBus(MessageBus):
+    """In-process bus, for running several shards in one event loop (tests, development)"""
+
+    def __init__(self, shard_id, shards, hub):
+        super().__init__(shard_id, shards)
+        self.hub = hub
+        self.tasks = set()  # Deliveries in flight, referenced until done so they are not garbage-collected
+
+    async def start(self, handler):
+        await super().start(handler)
+        self.hub.buses[self.shard_id] = self
+
+    async def send(self, shard, message):
+        target = self.hub.buses.get(shard)
+        if target is not None:
+            # Round-trip through JSON so shards never share mutable objects, like the socket backends
+            task = asyncio.create_task(target.handler(json.loads(json.dumps(message))))
+            self.tasks.add(task)
+            task.add_done_callback(self.delivered)
+
+    def delivered(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Handling a bus message from shard {self.shard_id} failed: {task.exception()!r}")
+
+    async def close(self):
+        self.hub.buses.pop(self.shard_id, None)
+
+
+class UnixSocketBus(MessageBus):
+    """Bus between shard processes on one machine, one Unix socket per shard in 'directory'"""
+
+    def __init__(self, shard_id, shards, directory):
+        super().__init__(shard_id, shards)
+        self.directory = directory
+        self.server = None
+        self.peers = {}  # {shard: StreamWriter}
+        self.locks = {}  # {shard: Lock} so two senders don't open two connections
+
+    def path(self, shard):
+        return os.path.join(self.directory, f"shard-{shard}.sock")
+
+    async def start(self, handler):
+        await super().start(handler)
+        path = self.path(self.shard_id)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self.serve_peer, path=path)
+
+    async def serve_peer(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                (length,) = FRAME_HEADER.unpack(header)
+                message = json.loads(await reader.readexactly(length))
+                await self.handler(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def connection(self, shard):
+        writer = self.peers.get(shard)
+        if writer is not None and not writer.is_closing():
+            return writer
+        lock = self.locks.setdefault(shard, asyncio.Lock())
+        async with lock:
+            writer = self.peers.get(shard)
+            if writer is None or writer.is_closing():
+                _, writer = await asyncio.open_unix_connection(self.path(shard))
+                self.peers[shard] = writer
+        return writer
+
+    async def send(self, shard, message):
+        data = json.dumps(message).encode("utf-8")
+        try:
+            writer = await self.connection(shard)
+            writer.write(FRAME_HEADER.pack(len(data)) + data)
+            await writer.drain()
+        except (FileNotFoundError, ConnectionError):
+            # The peer shard is down or not started yet: the message is lost (at-most-once delivery)
+            self.peers.pop(shard, None)
+
+    async def close(self):
+        for writer in self.peers.values():
+            writer.close()
+        self.peers.clear()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            path = self.path(self.shard_id)
+            if os.path.exists(path):
+                os.unlink(path)
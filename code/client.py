@@ -1,96 +1,245 @@
 # Client (client.py)
-import socket
-import threading
-from aes import AES
-from ctr import CTR
+import asyncio
+import collections
 import getpass
+import json
 import secrets
-import argparse
-import concurrent.futures
 import hmac
 import hashlib
+import time
+
+from frames import FrameDecoder, stream_header
+
+# The crypto modules (and NumPy and libcrypto behind them) are imported where they are first needed,
+# so importing this module, e.g. for parallel() or to start a client, stays cheap
 
 # from cryptography.fernet import Fernet
 
 blocksize = 16
 passwd = ""
 
+# Payloads at least this large are split across worker processes, smaller ones are encrypted in-process
+# (handing a few MB to the workers costs more than encrypting them with the batched engine). Sized for the
+# NumPy engines: with a native (OpenSSL) cipher payloads always stay in-process, see parallel()
+PARALLEL_THRESHOLD = 8 * 1024 * 1024
 
-class ChatClient:
-    def __init__(self, username, host='0.0.0.0', port=5555):
-        self.username = username
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect((host, port))
+# Messages (or a read's worth of them) at least this large are sealed / opened in the executor, smaller
+# ones on the event loop, where they take tens of microseconds, less than the hop to a thread
+EXECUTOR_THRESHOLD = 64 * 1024
 
-        # Generate encryption key
-        # self.fernet_key = Fernet.generate_key()
-        # self.cipher_suite = Fernet(self.fernet_key)
+# Bytes asked of the socket per read, a read may hold many frames or part of one
+READ_SIZE = 256 * 1024
 
-        # Send key to server
-        passwd = getpass.getpass("Enter password: ")
-        self.client.send(passwd.encode("utf-8"))
-        print("Connected to server and sent encryption key")
+# Simulated clients doing their handshake at the same time
+CONNECT_CONCURRENCY = 64
 
 
-    def receive_messages(self):
-        while True:
-            try:
-                encrypted_message = self.client.recv(1024)
-                if encrypted_message:
-                    # Decrypt the message
-                    decrypted_message = decrypt_file_chunks(passwd, blocksize, encrypted_message)
-                    print(decrypted_message.decode())
-            except Exception as e:
-                print(f"Error receiving message: {str(e)}")
-                break
-
-    def send_message(self, message):
-        try:
-            full_message = f"{self.username}: {message}"
-            message_bytes = full_message.encode()
+class ChatClient:
+    """Chat connection on asyncio streams: the session handshake, then length-prefixed sealed messages.
+    Many of them can share one event loop, there is no thread per connection"""
+
+    def __init__(self, username, passwd, host='0.0.0.0', port=5555, on_message=None, executor=None, salt=None):
+        self.username = username
+        self.passwd = passwd
+        self.host = host
+        self.port = port
+        # Called with every decrypted message (bytes), prints it by default
+        self.on_message = on_message or (lambda message: print(message.decode("utf-8", "replace")))
+        self.executor = executor  # None is the event loop's default thread pool
+        self.salt = salt  # See handshake.ClientHandshake
+        self.reader = None
+        self.writer = None
+        self.channel = None
+        self.send_lock = asyncio.Lock()
+
+    async def connect(self):
+        # Establish the session: the password is not sent, both sides prove they know it and agree on
+        # per-direction keys. scrypt and X25519 run in the executor, the loop keeps serving other connections
+        from handshake import ClientHandshake, REPLY_SIZE
+
+        loop = asyncio.get_running_loop()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        handshake = await loop.run_in_executor(self.executor, ClientHandshake, self.passwd, self.salt)
+        self.writer.write(handshake.hello())
+        reply = await self.reader.readexactly(REPLY_SIZE)
+        finish, self.channel = await loop.run_in_executor(self.executor, handshake.finish, reply)
+        self.writer.write(finish)
+        await self.writer.drain()
+
+    async def send(self, data):
+        # The lock keeps messages on the wire in the order of their counters
+        async with self.send_lock:
+            if len(data) >= EXECUTOR_THRESHOLD:
+                sealed = await asyncio.get_running_loop().run_in_executor(self.executor, self.channel.seal, data)
+            else:
+                sealed = self.channel.seal(data)
+            self.writer.writelines((stream_header(sealed), sealed))
+            await self.writer.drain()
 
-            # print(f"Debug - Message length: {len(message_bytes)} bytes")
+    async def send_message(self, message):
+        await self.send(f"{self.username}: {message}".encode())
 
-            encrypted_message = encrypt_file(passwd, blocksize, message_bytes)
+    def open_all(self, messages):
+        # In counter order: the channel rejects a message older than the last one it opened
+        return [self.channel.open(message) for message in messages]
 
-            if encrypted_message is not None:
-                # print(f"Debug - Encrypted message length: {len(encrypted_message)} bytes")
-                self.client.send(encrypted_message)
+    async def receive_messages(self):
+        # Reads whatever arrived, cuts it into frames and decrypts them, batches of large ones in the executor
+        decoder = FrameDecoder()
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return
+            messages = decoder.feed(data)
+            if not messages:
+                continue
+            if sum(map(len, messages)) >= EXECUTOR_THRESHOLD:
+                messages = await loop.run_in_executor(self.executor, self.open_all, messages)
             else:
-                print("Encryption failed - encrypted_message is None")
-        except Exception as e:
-            print(f"Error sending message: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+                messages = self.open_all(messages)
+            for message in messages:
+                self.on_message(message)
 
-    def start(self):
-        # Start receiving messages in a separate thread
-        receive_thread = threading.Thread(target=self.receive_messages)
-        receive_thread.daemon = True
-        receive_thread.start()
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def start(self):
+        await self.connect()
+        print("Connected to server and established a session")
+        receiver = asyncio.create_task(self.receive_messages())
+        loop = asyncio.get_running_loop()
 
-        # Main loop for sending messages
+        # Main loop for sending messages, input() blocks so it runs in a thread
         try:
-            while True:
-                message = input("")
+            while not receiver.done():
+                message = await loop.run_in_executor(None, input, "")
                 if message.lower() == 'quit':
                     break
-                self.send_message(message)
-        except KeyboardInterrupt:
+                await self.send_message(message)
+        except (EOFError, KeyboardInterrupt):
             print("\nDisconnecting from server...")
         finally:
-            self.client.close()
+            if receiver.done() and receiver.exception():
+                print(f"Error receiving message: {receiver.exception()}")
+            receiver.cancel()
+            await self.close()
+
+
+async def stand_in_server(host='127.0.0.1', port=5555, passwd="password", executor=None):
+    """Local server speaking the client's protocol, for development and load tests:
+    it accepts sessions and sends every message back to its sender"""
+    from handshake import FINISH_SIZE, HELLO_SIZE, ServerHandshake
+
+    async def serve(reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            handshake = ServerHandshake(passwd)
+            hello = await reader.readexactly(HELLO_SIZE)
+            writer.write(await loop.run_in_executor(executor, handshake.reply, hello))
+            channel = handshake.finish(await reader.readexactly(FINISH_SIZE))
+            decoder = FrameDecoder()
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    return
+                for message in decoder.feed(data):
+                    sealed = channel.seal(channel.open(message))
+                    writer.writelines((stream_header(sealed), sealed))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(serve, host, port)
 
 
-def parallel(func, chunks, salt, IV, count_start):
-    # Because we're using multiprocessing, CTR counter needs to be pre-computed
-    counters = range(count_start, len(chunks) + count_start)
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        results = executor.map(func, chunks, counters)
-        return salt + IV + b"".join(results)
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] if ordered else 0.0
 
 
-def decrypt_file_chunks(passwd, block_size, file_in):
+async def simulate(host='127.0.0.1', port=5555, clients=1000, messages=10, size=64, interval=0.1,
+                   passwd="password", stand_in=False):
+    """Headless load test: 'clients' connections from this process, each sending 'messages' messages of
+    'size' bytes every 'interval' seconds; the server is expected to echo them (as stand_in_server does)"""
+    server = await stand_in_server(host, port, passwd) if stand_in else None
+    salt = secrets.token_bytes(16)  # Shared by the simulated clients, the process runs scrypt once
+    connecting = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    latencies = []
+    stats = {"connected": 0, "failed": 0, "received": 0}
+
+    async def run_client(index):
+        sent = collections.deque()
+
+        def on_message(message):
+            latencies.append(time.perf_counter() - sent.popleft())
+            stats["received"] += 1
+
+        client = ChatClient(f"sim{index}", passwd, host, port, on_message=on_message, salt=salt)
+        try:
+            async with connecting:
+                await client.connect()
+            stats["connected"] += 1
+            receiver = asyncio.create_task(client.receive_messages())
+            payload = secrets.token_bytes(size)
+            for _ in range(messages):
+                sent.append(time.perf_counter())
+                await client.send(payload)
+                await asyncio.sleep(interval)
+            # Give the last echoes a moment before hanging up
+            for _ in range(100):
+                if not sent:
+                    break
+                await asyncio.sleep(0.01)
+            receiver.cancel()
+        except (OSError, ConnectionError, ValueError, asyncio.IncompleteReadError):
+            stats["failed"] += 1
+        finally:
+            await client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(i) for i in range(clients)))
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    return {
+        **stats,
+        "clients": clients,
+        "seconds": elapsed,
+        "messages_per_s": stats["received"] / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1e3,
+        "p99_ms": percentile(latencies, 99) * 1e3,
+    }
+
+
+def parallel(mode, data, count_start, threshold=PARALLEL_THRESHOLD):
+    # Small payloads: one keystream call and one XOR in this process. So are payloads of any size with a
+    # native cipher: the pool copies them into shared memory and back out, which costs more than OpenSSL's
+    # whole pass (one core, 64 MB: 945 MB/s in-process against 531 MB/s pooled, 1 MB: 3757 against 756)
+    if len(data) < threshold or getattr(mode.cipher, "native", None) is not None:
+        return mode.encrypt_buffer(data, count_start)
+
+    # Large payloads: the shared worker pool encrypts one contiguous counter range per worker,
+    # passing the data and the expanded round keys through shared memory
+    import crypto_pool
+    return crypto_pool.get_pool().encrypt(mode, data, count_start)
+
+
+def decrypt_file_chunks(passwd, block_size, file_in, session=False):
+    from ctr import CTR
+    from session import message_cipher
+
+    # session: True if the sender used session keys (salt field holds the session salt)
+    if len(file_in) < 4 * block_size:
+        raise ValueError("Ciphertext is truncated.")
     salt = file_in[0:block_size]
 
     # Extract nonce from the first 10 bytes of the second block of the ciphertext
@@ -103,18 +252,20 @@ def decrypt_file_chunks(passwd, block_size, file_in):
     # Extract the HMAC value from the last 2 blocks of the ciphertext
     hmac_val = file_in[-2 * block_size:]
 
-    # Start AES cipher
-    cipher = AES(password_str=passwd, salt=salt, key_len=256)
+    # Start AES cipher (key derivations are cached per password and salt)
+    cipher = message_cipher(passwd, salt, nonce, session=session)
 
     # Compare HMAC values (remove the HMAC value from the ciphertext before comparing)
-    assert hmac.compare_digest(
+    # Raises ValueError rather than asserting, so the check also runs under python -O
+    if not hmac.compare_digest(
         hmac_val,
         hmac.digest(
             key=cipher.hmac_key,
             msg=file_in[: -2 * block_size],
             digest=hashlib.sha256,
         ),
-    ), "HMAC check failed."
+    ):
+        raise ValueError("HMAC check failed.")
 
     # Start CTR mode
     mode = CTR(cipher, nonce)
@@ -122,22 +273,20 @@ def decrypt_file_chunks(passwd, block_size, file_in):
     # Strip the salt, IV and HMAC from the ciphertext
     file_in = file_in[2 * block_size: -2 * block_size]
 
-    # Preparing file_in chunks to be passed into multiprocessing
-    # Stripping the IV which is the first block of the ciphertext
-    chunks = [
-        file_in[i: i + block_size] for i in range(0, len(file_in), block_size)
-    ]
-
-    file_out = parallel(mode.decrypt, chunks, b"", b"", counter)
+    file_out = parallel(mode, file_in, counter)
     return file_out
 
 
-def encrypt_file(passwd, block_size, file_in):
+def encrypt_file(passwd, block_size, file_in, session=None):
+    # session: optional SessionKey, per-message keys are then derived with HKDF instead of scrypt
+    from aes import AES
+    from ctr import CTR
+
     try:
         # print(f"Debug - Starting encryption of {len(file_in)} bytes")
 
-        # Generate salt and nonce
-        salt = secrets.token_bytes(block_size)
+        # Generate salt and nonce (in session mode the session salt is sent instead)
+        salt = session.salt if session is not None else secrets.token_bytes(block_size)
         nonce = secrets.token_bytes(10)
         counter = 0
 
@@ -147,25 +296,21 @@ def encrypt_file(passwd, block_size, file_in):
         # print(f"Debug - IV length: {len(IV)}")
 
         # Initialize cipher
-        cipher = AES(password_str=passwd, salt=salt, key_len=256)
+        if session is not None:
+            cipher = session.cipher(nonce)
+        else:
+            cipher = AES(password_str=passwd, salt=salt, key_len=256)
         mode = CTR(cipher, nonce)
 
-        # Prepare chunks
-        chunks = []
-        for i in range(0, len(file_in), block_size):
-            chunk = file_in[i:i + block_size]
-            if len(chunk) < block_size:
-                padding = bytes([block_size - len(chunk)] * (block_size - len(chunk)))
-                chunk = chunk + padding
-            chunks.append(chunk)
-
-        # print(f"Debug - Number of chunks: {len(chunks)}")
+        # Pad the last partial block with the number of padding bytes
+        pad_len = -len(file_in) % block_size
+        file_in = file_in + bytes([pad_len] * pad_len)
 
         try:
-            file_out = parallel(mode.encrypt, chunks, salt, IV, counter)
-            # print(f"Debug - Parallel encryption complete, output length: {len(file_out)}")
+            file_out = salt + IV + parallel(mode, file_in, counter)
+            # print(f"Debug - Encryption complete, output length: {len(file_out)}")
         except Exception as e:
-            # print(f"Debug - Parallel encryption failed: {str(e)}")
+            # print(f"Debug - Batched encryption failed: {str(e)}")
             import traceback
             print(traceback.format_exc())
             return None
@@ -187,8 +332,81 @@ def encrypt_file(passwd, block_size, file_in):
         return None
 
 
-if __name__ == "__main__":
+def encrypt_payload(passwd, data, mode=None, block_size=16, session=None):
+    # Payload starting with a mode byte: stream.MODE_GCM (the default) encrypts and authenticates in one
+    # pass, stream.MODE_CTR_HMAC is the encrypt_file format behind the byte
+    import stream
+
+    mode = stream.MODE_GCM if mode is None else mode
+    if mode == stream.MODE_CTR_HMAC:
+        file_out = encrypt_file(passwd, block_size, data, session=session)
+        return None if file_out is None else bytes([mode]) + file_out
+    encryptor = stream.payload_encryptor(passwd, mode, block_size, session)
+    return encryptor.update(data) + encryptor.finalize()
+
+
+def decrypt_payload(passwd, data, block_size=16, session=False):
+    # Decrypts a payload from encrypt_payload, whichever its mode; nothing is returned unless it is authentic
+    # (GCM decrypts and checks the tag in the same pass, the output is dropped if the check fails)
+    # Raises ValueError for a tampered, truncated or unknown payload
+    import stream
+
+    if not data:
+        raise ValueError("Ciphertext is truncated.")
+    if data[0] == stream.MODE_CTR_HMAC:
+        return decrypt_file_chunks(passwd, block_size, data[1:], session=session)
+    decryptor = stream.PayloadDecryptor(passwd, block_size, session)
+    plaintext = decryptor.update(data)
+    return plaintext + decryptor.finalize()
+
+
+def self_test():
+    # Payload round trip in both modes, and every single-byte change to a payload has to be rejected
+    import stream
+
+    # Raises AssertionError explicitly, so it still checks something under python -O
+    message = b"32-byte payload self-test text.."
+    for mode in stream.MODES:
+        payload = encrypt_payload("self-test", message, mode=mode)
+        if decrypt_payload("self-test", payload) != message:
+            raise AssertionError(f"Payload round trip failed (mode {mode}).")
+        for position in (1, len(payload) // 2, len(payload) - 1):
+            tampered = bytearray(payload)
+            tampered[position] ^= 1
+            try:
+                decrypt_payload("self-test", bytes(tampered))
+            except ValueError:
+                continue
+            raise AssertionError(f"Tampered payload accepted (mode {mode}, byte {position}).")
+    return True
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Secure chat client")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--headless", type=int, default=0, metavar="CLIENTS",
+                        help="simulate this many clients instead of chatting, for load tests")
+    parser.add_argument("--messages", type=int, default=10, help="messages per simulated client")
+    parser.add_argument("--size", type=int, default=64, help="message size of the simulated clients")
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between a simulated client's messages")
+    parser.add_argument("--stand-in", action="store_true", help="also run a local echoing stand-in server")
+    args = parser.parse_args()
+
+    if args.headless:
+        host = "127.0.0.1" if args.stand_in else args.host
+        result = asyncio.run(simulate(host, args.port, args.headless, args.messages, args.size, args.interval,
+                                      stand_in=args.stand_in))
+        print(json.dumps(result, indent=2))
+        return
+
     username = input("Enter your username: ")
-    client = ChatClient(username)
-    print(f"Connected as {username}. Type your messages (type 'quit' to exit)")
-    client.start()
\ No newline at end of file
+    client = ChatClient(username, getpass.getpass("Enter password: "), args.host, args.port)
+    print(f"Connecting as {username}. Type your messages (type 'quit' to exit)")
+    asyncio.run(client.start())
+
+
+if __name__ == "__main__":
+    main()
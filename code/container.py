@@ -0,0 +1,296 @@
+# Seekable encrypted container for large files: any byte range can be authenticated and decrypted
+# without touching the rest, and a whole file can be decrypted on several cores.
+#
+#   header   magic (4) | version (1) | mode (1) | segment size (4) | length (8) | salt (16) | nonce (10)
+#            | header HMAC (32)
+#   body     AES-CTR ciphertext of the whole file, unpadded, counter 0 at its first byte
+#   index    one HMAC-SHA256 per segment of 'segment size' bytes (the last segment may be shorter)
+#
+# The body is a single CTR stream, so the ciphertext of byte 'offset' sits at HEADER_SIZE + offset and
+# uses counter offset // 16. Segment i's HMAC covers nonce | i | its ciphertext, which pins it to its
+# place in this file; the header HMAC covers the length, so segment count and index size follow from
+# an authenticated value and dropping or reordering segments is detected.
+import argparse
+import getpass
+import hashlib
+import hmac
+import mmap
+import os
+import secrets
+import struct
+
+import numpy as np
+
+from ctr import CTR
+from stream import MODE_CTR_HMAC
+
+MAGIC = b"SCSF"
+VERSION = 1
+HEADER = struct.Struct(">4sBBIQ16s10s")
+MAC_SIZE = 32
+HEADER_SIZE = HEADER.size + MAC_SIZE
+SEGMENT_INDEX = struct.Struct(">Q")
+
+# 64 KB segments: a random read authenticates at most 64 KB more than it returns on each side,
+# and the index costs 32 bytes per segment (0.05%)
+SEGMENT_SIZE = 64 * 1024
+
+# Containers at least this large are decrypted across the crypto_pool workers, smaller ones in-process.
+# Workers map the files, so nothing is copied, but with a native (OpenSSL) cipher the in-process pass is
+# fast enough that the dispatch only pays off for large files (one core, 64 MB: 592 MB/s in-process,
+# 597 MB/s pooled; the split is there for the cores beyond the first)
+PARALLEL_THRESHOLD = 8 * 1024 * 1024
+NATIVE_PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+
+def _segment_mac(hmac_key, nonce, index, ciphertext):
+    mac = hmac.new(hmac_key, nonce + SEGMENT_INDEX.pack(index), hashlib.sha256)
+    mac.update(ciphertext)
+    return mac.digest()
+
+
+def _segment_count(length, segment_size):
+    return -(-length // segment_size)
+
+
+def encrypt_container(passwd, file_in, file_out, segment_size=SEGMENT_SIZE, session=None):
+    """Encrypts the binary stream file_in into the seekable stream file_out, returns the plaintext length;
+    raises ValueError if segment_size is not a positive multiple of the block size"""
+    # session: optional SessionKey, as for client.encrypt_file
+    from aes import AES
+
+    if segment_size <= 0 or segment_size % 16:
+        raise ValueError("Segment size must be a multiple of the block size.")
+    salt = session.salt if session is not None else secrets.token_bytes(16)
+    nonce = secrets.token_bytes(10)
+    if session is not None:
+        cipher = session.cipher(nonce)
+    else:
+        cipher = AES(password_str=passwd, salt=salt, key_len=256)
+    mode = CTR(cipher, nonce)
+
+    # The header holds the length, so it is written last over this placeholder
+    start = file_out.tell()
+    file_out.write(bytes(HEADER_SIZE))
+    plaintext = bytearray(segment_size)
+    ciphertext = np.empty(segment_size, dtype=np.uint8)
+    macs = []
+    length = 0
+    while True:
+        n = file_in.readinto(plaintext)
+        if not n:
+            break
+        # readinto may return short reads on pipes: top the segment up so only the last one is short
+        while n < segment_size:
+            more = file_in.readinto(memoryview(plaintext)[n:])
+            if not more:
+                break
+            n += more
+        mode.encrypt_into(memoryview(plaintext)[:n], ciphertext, length // 16)
+        file_out.write(ciphertext[:n].data)
+        macs.append(_segment_mac(cipher.hmac_key, nonce, len(macs), ciphertext[:n].data))
+        length += n
+        if n < segment_size:
+            break
+    file_out.write(b"".join(macs))
+
+    end = file_out.tell()
+    header = HEADER.pack(MAGIC, VERSION, MODE_CTR_HMAC, segment_size, length, salt, nonce)
+    file_out.seek(start)
+    file_out.write(header + hmac.digest(cipher.hmac_key, header, hashlib.sha256))
+    file_out.seek(end)
+    return length
+
+
+class ContainerReader:
+    """Verified random access to a container, from a path (memory-mapped) or a bytes-like object;
+    raises ValueError for a truncated, tampered or foreign file, or a wrong password"""
+
+    def __init__(self, passwd, source, session=False):
+        # session: True if the container was written with a SessionKey
+        from session import message_cipher
+
+        self.file = None
+        self.map = None
+        if isinstance(source, (str, os.PathLike)):
+            self.path = os.fspath(source)
+            self.file = open(self.path, "rb")
+            if os.fstat(self.file.fileno()).st_size:
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            source = self.map if self.map is not None else b""
+        else:
+            self.path = None
+        self.view = memoryview(source)
+
+        try:
+            if len(self.view) < HEADER_SIZE:
+                raise ValueError("Container is truncated.")
+            header = bytes(self.view[:HEADER.size])
+            magic, version, mode, self.segment_size, self.length, salt, self.nonce = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Not a container file.")
+            if mode != MODE_CTR_HMAC:
+                raise ValueError(f"Unsupported container mode {mode}.")
+
+            self.cipher = message_cipher(passwd, salt, self.nonce, session=session)
+            expected = hmac.digest(self.cipher.hmac_key, header, hashlib.sha256)
+            if not hmac.compare_digest(self.view[HEADER.size:HEADER_SIZE], expected):
+                raise ValueError("HMAC check failed.")
+
+            self.segments = _segment_count(self.length, self.segment_size)
+            self.index_offset = HEADER_SIZE + self.length
+            if len(self.view) != self.index_offset + self.segments * MAC_SIZE:
+                raise ValueError("Container is truncated.")
+        except BaseException:
+            self.close()
+            raise
+        self.mode = CTR(self.cipher, self.nonce)
+
+    def verify_segment(self, index):
+        # Raises ValueError if segment 'index' does not match its HMAC in the index
+        start = index * self.segment_size
+        stop = min(start + self.segment_size, self.length)
+        expected = self.view[self.index_offset + index * MAC_SIZE:self.index_offset + (index + 1) * MAC_SIZE]
+        actual = _segment_mac(self.cipher.hmac_key, self.nonce, index,
+                              self.view[HEADER_SIZE + start:HEADER_SIZE + stop])
+        if not hmac.compare_digest(expected, actual):
+            raise ValueError(f"HMAC check failed for segment {index}.")
+
+    def read_range(self, offset, length):
+        """Plaintext of bytes [offset, offset + length), shorter at the end of the file; only the segments
+        the range touches are authenticated and decrypted. Raises ValueError if one of them was tampered with"""
+        if offset < 0 or length < 0:
+            raise ValueError("Offset and length must not be negative")
+        stop = min(offset + length, self.length)
+        if offset >= stop:
+            return b""
+        for index in range(offset // self.segment_size, (stop - 1) // self.segment_size + 1):
+            self.verify_segment(index)
+
+        # CTR starts at a block boundary, the bytes before 'offset' in that block are dropped
+        start = offset - offset % 16
+        out = np.empty(stop - start, dtype=np.uint8)
+        self.mode.decrypt_into(self.view[HEADER_SIZE + start:HEADER_SIZE + stop], out, start // 16)
+        return out[offset - start:].tobytes()
+
+    def read_all(self):
+        return self.read_range(0, self.length)
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _decrypt_segments(input_path, output_path, round_keys, hmac_key, nonce, engine, segment_size, length,
+                      first, stop):
+    # Runs in a worker (or in-process for small files): checks segments [first, stop) of the container,
+    # then XORs their plaintext straight into the pre-sized output file. Both files are mapped, so only
+    # paths and key material are pickled, and no plaintext is written before its segments are verified
+    mode = CTR(_worker_cipher(round_keys, hmac_key, engine), nonce)
+    start = first * segment_size
+    end = min(stop * segment_size, length)
+    with open(input_path, "rb") as file_in, \
+            mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ) as src_map, \
+            open(output_path, "r+b") as file_out, \
+            mmap.mmap(file_out.fileno(), length) as out:
+        with memoryview(src_map) as view:
+            index_offset = HEADER_SIZE + length
+            for index in range(first, stop):
+                seg_start = index * segment_size
+                seg_stop = min(seg_start + segment_size, length)
+                expected = bytes(view[index_offset + index * MAC_SIZE:index_offset + (index + 1) * MAC_SIZE])
+                actual = _segment_mac(hmac_key, nonce, index, view[HEADER_SIZE + seg_start:HEADER_SIZE + seg_stop])
+                if not hmac.compare_digest(expected, actual):
+                    raise ValueError(f"HMAC check failed for segment {index}.")
+            src = np.frombuffer(src_map, dtype=np.uint8, count=end - start, offset=HEADER_SIZE + start)
+            dst = np.frombuffer(out, dtype=np.uint8, count=end - start, offset=start)
+            mode.decrypt_into(src, dst, start // 16)
+            # Views into the maps have to be gone before the maps can be closed
+            del src, dst
+    return end - start
+
+
+def _worker_cipher(round_keys, hmac_key, engine):
+    from aes import AES
+
+    cipher = AES.from_round_keys(round_keys, engine=engine)
+    cipher.hmac_key = hmac_key
+    return cipher
+
+
+def decrypt_container(passwd, input_path, output_path, session=False, threshold=None):
+    """Decrypts a whole container file to output_path, large ones split across the crypto_pool workers
+    in contiguous runs of segments. Raises ValueError if any segment fails its HMAC check, the output is
+    removed then"""
+    with ContainerReader(passwd, input_path, session) as reader:
+        cipher = reader.cipher
+        job = (reader.path, output_path, cipher.round_keys.tobytes(), cipher.hmac_key, reader.nonce,
+               cipher.engine, reader.segment_size, reader.length)
+        segments = reader.segments
+        length = reader.length
+    if threshold is None:
+        threshold = PARALLEL_THRESHOLD if cipher.native is None else NATIVE_PARALLEL_THRESHOLD
+
+    with open(output_path, "wb") as file_out:
+        file_out.truncate(length)
+    if not length:
+        return 0
+    try:
+        if length < threshold:
+            _decrypt_segments(*job, 0, segments)
+        else:
+            from crypto_pool import get_pool
+
+            pool = get_pool()
+            executor = pool.start()
+            per_worker = -(-segments // pool.workers)
+            futures = [
+                executor.submit(_decrypt_segments, *job, first, min(first + per_worker, segments))
+                for first in range(0, segments, per_worker)
+            ]
+            for future in futures:
+                future.result()
+    except BaseException:
+        os.remove(output_path)
+        raise
+    return length
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encrypt, decrypt or read a range of a container file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    encrypt = commands.add_parser("encrypt")
+    encrypt.add_argument("input")
+    encrypt.add_argument("output")
+    encrypt.add_argument("--segment-size", type=int, default=SEGMENT_SIZE)
+    decrypt = commands.add_parser("decrypt")
+    decrypt.add_argument("input")
+    decrypt.add_argument("output")
+    read = commands.add_parser("read", help="write bytes [offset, offset + length) to stdout")
+    read.add_argument("input")
+    read.add_argument("offset", type=int)
+    read.add_argument("length", type=int)
+    args = parser.parse_args()
+
+    password = getpass.getpass("Password: ")
+    if args.command == "encrypt":
+        with open(args.input, "rb") as source, open(args.output, "wb") as target:
+            encrypt_container(password, source, target, args.segment_size)
+    elif args.command == "decrypt":
+        decrypt_container(password, args.input, args.output)
+    else:
+        import sys
+
+        with ContainerReader(password, args.input) as container:
+            sys.stdout.buffer.write(container.read_range(args.offset, args.length))
@@ -0,0 +1,169 @@
+# Long-lived worker pool for encrypting large payloads with AES-CTR on several cores
+import argparse
+import atexit
+import concurrent.futures
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from aes import AES
+from ctr import CTR
+
+# Number of CTR objects each worker keeps, keyed by their round keys
+WORKER_CIPHER_CACHE_SIZE = 8
+
+# Per-process cache in the workers: {(round_keys, nonce, engine): CTR}
+_worker_modes = {}
+
+
+def _worker_mode(round_keys, nonce, engine):
+    cache_key = (round_keys, nonce, engine)
+    mode = _worker_modes.get(cache_key)
+    if mode is None:
+        if len(_worker_modes) >= WORKER_CIPHER_CACHE_SIZE:
+            _worker_modes.pop(next(iter(_worker_modes)))
+        mode = CTR(AES.from_round_keys(round_keys, engine=engine), nonce)
+        _worker_modes[cache_key] = mode
+    return mode
+
+
+def _encrypt_range(shm_name, keys_len, nonce_len, engine, offset, length, counter):
+    # Runs in a worker: XORs the keystream for one contiguous counter range into the shared buffer
+    # The segment layout is [round keys | nonce | data], so only names and offsets are pickled
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        header = bytes(shm.buf[:keys_len + nonce_len])
+        mode = _worker_mode(header[:keys_len], header[keys_len:], engine)
+
+        start = keys_len + nonce_len + offset
+        data = np.ndarray((length,), dtype=np.uint8, buffer=shm.buf, offset=start)
+        mode.encrypt_into(data, data, counter)
+        del data
+    finally:
+        shm.close()
+    return length
+
+
+class SharedBuffer:
+    # A shared memory segment laid out as [round keys | nonce | data]
+    # Callers can fill 'data' directly (e.g. with file.readinto) to avoid copying the payload at all
+
+    def __init__(self, mode, size):
+        self.round_keys = mode.cipher.round_keys.tobytes()
+        self.nonce = mode.nonce
+        self.engine = mode.cipher.engine
+        self.size = size
+        self.header_len = len(self.round_keys) + len(self.nonce)
+
+        # SharedMemory refuses a size of 0
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.header_len + size))
+        self.shm.buf[:self.header_len] = self.round_keys + self.nonce
+        self.data = self.shm.buf[self.header_len:self.header_len + size]
+
+    def close(self):
+        self.data.release()
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EncryptionPool:
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+
+    def start(self):
+        # Workers are started on first use and then reused for every payload
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def buffer(self, mode, size):
+        return SharedBuffer(mode, size)
+
+    def encrypt_shared(self, buffer, counter):
+        # Encrypts buffer.data in place, one contiguous block-aligned counter range per worker
+        if buffer.size == 0:
+            return buffer.data
+        executor = self.start()
+        block_size = 16
+        nblocks = -(-buffer.size // block_size)
+        slice_len = -(-nblocks // self.workers) * block_size
+
+        futures = [
+            executor.submit(
+                _encrypt_range, buffer.shm.name, len(buffer.round_keys), len(buffer.nonce), buffer.engine,
+                offset, min(slice_len, buffer.size - offset), counter + offset // block_size,
+            )
+            for offset in range(0, buffer.size, slice_len)
+        ]
+        for future in futures:
+            future.result()
+        return buffer.data
+
+    def encrypt(self, mode, data, counter):
+        # Convenience wrapper for callers holding bytes: one copy in, one copy out
+        with self.buffer(mode, len(data)) as buffer:
+            buffer.data[:] = data
+            self.encrypt_shared(buffer, counter)
+            return bytes(buffer.data)
+
+    def decrypt(self, mode, data, counter):
+        return self.encrypt(mode, data, counter)
+
+
+_pool = None
+
+
+def get_pool():
+    # Process-wide pool, started lazily on the first large payload
+    global _pool
+    if _pool is None:
+        _pool = EncryptionPool()
+        atexit.register(_pool.shutdown)
+    return _pool
+
+
+def benchmark(size_mb=64, max_workers=None, repeat=3):
+    # Throughput of the pool for 1 .. max_workers workers on a 'size_mb' MB payload
+    max_workers = max_workers or os.cpu_count() or 1
+    mode = CTR(AES.from_key(os.urandom(32)), os.urandom(10))
+    size = size_mb * 1024 * 1024
+    results = {}
+
+    for workers in range(1, max_workers + 1):
+        pool = EncryptionPool(workers)
+        with pool.buffer(mode, size) as buffer:
+            buffer.data[:] = os.urandom(size)
+            # Warm-up run so process start-up is not timed
+            pool.encrypt_shared(buffer, 0)
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                pool.encrypt_shared(buffer, 0)
+                best = min(best, time.perf_counter() - start)
+        pool.shutdown()
+        results[workers] = size_mb / best
+        print(f"{workers:3d} worker(s): {results[workers]:8.1f} MB/s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encryption pool throughput against number of workers")
+    parser.add_argument("--size", type=int, default=64, help="payload size in MB")
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.size, args.max_workers, args.repeat)
@@ -1,8 +1,23 @@
+import numpy as np
+
+# encrypt_into builds and encrypts counter blocks this many at a time (64 KB of keystream),
+# so its scratch memory does not grow with the size of the buffer
+KEYSTREAM_BLOCKS = 4096
+
+
+def as_uint8(buffer):
+    # Flat uint8 view of any contiguous buffer (bytes, bytearray, memoryview, mmap, NumPy array), without copying
+    if isinstance(buffer, np.ndarray):
+        return buffer.reshape(-1).view(np.uint8)
+    return np.frombuffer(buffer, dtype=np.uint8)
+
+
 class CTR:
     def __init__(self, cipher, nonce):
         # Nonce will be half of the block_size of the cipher
         self.cipher = cipher
         self.nonce = nonce
+        self.nonce_array = np.frombuffer(nonce, dtype=np.uint8)
 
     def encrypt(self, data_block, counter):
         try:
@@ -10,12 +25,13 @@ class CTR:
             counter_bytes = counter.to_bytes(6, byteorder="big")
             IV = self.nonce + counter_bytes
 
-            if len(data_block) != self.cipher.block_size:
-            #    print(f"Debug - Block size mismatch: got {len(data_block)}, expected {self.cipher.block_size}")
-                data_block = data_block.ljust(self.cipher.block_size, b'\0')
-
             encrypted_block = self.cipher.encrypt(IV)
             result = self._xor(encrypted_block, data_block)
+
+            if len(data_block) < self.cipher.block_size:
+            #    print(f"Debug - Block size mismatch: got {len(data_block)}, expected {self.cipher.block_size}")
+                # Same as zero-padding the block before the XOR, without copying it
+                result += bytes(encrypted_block[len(data_block):])
             #print(f"Debug - Block encryption complete, output size: {len(result)}")
             return result
         except Exception as e:
@@ -27,12 +43,78 @@ class CTR:
     def _xor(self, data_1, data_2):
         try:
             # Ensure both inputs are the same length
+            # XOR of the whole span as one big integer instead of byte by byte
             min_len = min(len(data_1), len(data_2))
-            return bytes(a ^ b for a, b in zip(data_1[:min_len], data_2[:min_len]))
+            value = int.from_bytes(bytes(data_1[:min_len]), "big") ^ int.from_bytes(bytes(data_2[:min_len]), "big")
+            return value.to_bytes(min_len, "big")
         except Exception as e:
             print(f"XOR error: {str(e)}")
             return None
 
     def decrypt(self, cipher_block, counter):
         # Decryption is the same as encryption, but using cipher_block instead
-        return self.encrypt(cipher_block, counter)
\ No newline at end of file
+        return self.encrypt(cipher_block, counter)
+
+    def counter_blocks(self, counter, nblocks, out=None):
+        # Builds the nonce|counter input blocks for 'nblocks' consecutive counter values,
+        # optionally into a preallocated (nblocks, block_size) array
+        counter_len = self.cipher.block_size - len(self.nonce)
+        blocks = np.empty((nblocks, self.cipher.block_size), dtype=np.uint8) if out is None else out
+        blocks[:, :len(self.nonce)] = self.nonce_array
+        counters = np.arange(counter, counter + nblocks, dtype=">u8")
+        blocks[:, len(self.nonce):] = counters.view(np.uint8).reshape(nblocks, 8)[:, 8 - counter_len:]
+        return blocks
+
+    def keystream(self, start, nblocks):
+        # Keystream for counters start .. start + nblocks - 1, as one flat uint8 array
+        if nblocks <= 0:
+            return np.empty(0, dtype=np.uint8)
+        return self.cipher.encrypt_blocks(self.counter_blocks(start, nblocks)).reshape(-1)
+
+    def encrypt_into(self, src, dst, counter):
+        # Encrypts src into the preallocated, writable buffer dst starting at 'counter'
+        # src and dst may be the same buffer (in-place encryption); nothing is allocated per block
+        # The buffer does not need to be a multiple of the block size, the keystream is truncated
+        src = as_uint8(src)
+        dst = as_uint8(dst)
+        assert len(dst) >= len(src), "Output buffer is too small."
+
+        block_size = self.cipher.block_size
+        counter_len = block_size - len(self.nonce)
+        native = getattr(self.cipher, "native", None)
+        # OpenSSL's CTR mode increments the whole 16-byte block, which is the same as nonce|counter
+        # as long as the counter does not wrap around; it then does the keystream and XOR in one pass
+        if native is not None and counter + -(-len(src) // block_size) <= 256 ** counter_len:
+            native.ctr_xor(self.nonce + counter.to_bytes(counter_len, "big"), src, dst[:len(src)])
+            return len(src)
+
+        step = KEYSTREAM_BLOCKS * block_size
+        blocks = np.empty((min(KEYSTREAM_BLOCKS, -(-len(src) // block_size)), block_size), dtype=np.uint8)
+
+        for start in range(0, len(src), step):
+            stop = min(start + step, len(src))
+            nblocks = -(-(stop - start) // block_size)
+            self.counter_blocks(counter + start // block_size, nblocks, out=blocks[:nblocks])
+            keystream = self.cipher.encrypt_blocks(blocks[:nblocks]).reshape(-1)
+            np.bitwise_xor(src[start:stop], keystream[:stop - start], out=dst[start:stop])
+        return len(src)
+
+    def decrypt_into(self, src, dst, counter):
+        return self.encrypt_into(src, dst, counter)
+
+    def encrypt_buffer(self, data, counter):
+        # Encrypts a whole buffer starting at 'counter', returning bytes
+        out = np.empty(len(data), dtype=np.uint8)
+        self.encrypt_into(data, out, counter)
+        return out.tobytes()
+
+    def decrypt_buffer(self, data, counter):
+        return self.encrypt_buffer(data, counter)
+
+    def encrypt_chunks(self, chunks, counter):
+        # Same output as b"".join(map(self.encrypt, chunks, counters)) for whole blocks
+        # Only the last chunk may be shorter than the block size, and it is not padded
+        return self.encrypt_buffer(b"".join(chunks), counter)
+
+    def decrypt_chunks(self, chunks, counter):
+        return self.encrypt_chunks(chunks, counter)
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import websockets
+
+logger = logging.getLogger("securechat.fanout")
+
+# What to do when a connection's outgoing queue is full:
+#   "drop": the new message is dropped
+#   "coalesce": a queued message with the same key is replaced by the new one, otherwise the new one is dropped
+#   "disconnect": the connection is closed as a slow consumer
+OVERFLOW_POLICIES = ("drop", "coalesce", "disconnect")
+
+
+class Outbox:
+    """Bounded outgoing queue of one connection, drained by its own writer task"""
+
+    def __init__(self, websocket, fanout):
+        self.websocket = websocket
+        self.fanout = fanout
+        self.queue = deque()  # [key, payload] pairs
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.create_task(self.writer())
+
+    def put(self, payload, key=None):
+        """Queue a payload, returns False if it was dropped"""
+        if self.closed:
+            return False
+
+        # Coalescing keys only keep the latest queued message of their kind (e.g. presence)
+        if key is not None and self.fanout.policy == "coalesce":
+            for item in self.queue:
+                if item[0] == key:
+                    item[1] = payload
+                    return True
+
+        if len(self.queue) >= self.fanout.max_queue:
+            if self.fanout.metrics is not None:
+                self.fanout.metrics.inc("queue_overflows")
+            if self.fanout.policy == "disconnect":
+                self.fanout.dropped(self, close=True)
+            return False
+
+        self.queue.append([key, payload])
+        self.ready.set()
+        return True
+
+    async def writer(self):
+        try:
+            while True:
+                await self.ready.wait()
+                metrics = self.fanout.metrics
+                while self.queue:
+                    _, payload = self.queue.popleft()
+                    if metrics is None:
+                        await self.send(payload)
+                    else:
+                        start = time.perf_counter()
+                        await self.send(payload)
+                        metrics.observe("send_seconds", time.perf_counter() - start)
+                self.ready.clear()
+        except websockets.ConnectionClosed:
+            self.fanout.dropped(self)
+
+    async def send(self, payload):
+        # Payloads are UTF-8 encoded JSON shared by every recipient, sent as text frames,
+        # or a tuple of fragments making up one binary message (header, ciphertext)
+        if isinstance(payload, bytes):
+            await self.websocket.send(payload, text=True)
+        else:
+            await self.websocket.send(payload)
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
+class FanOut:
+    """Delivers messages to many connections without one slow client delaying the others"""
+
+    def __init__(self, max_queue=256, policy="drop", on_disconnect=None, metrics=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}', expected one of {OVERFLOW_POLICIES}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.on_disconnect = on_disconnect  # async callable taking a list of websockets
+        self.metrics = metrics  # Optional metrics.Metrics: send latency and queue overflows
+        self.outboxes = {}  # {websocket: Outbox}
+        self.dead = set()
+        self.reaper = None
+        self.closing = set()  # Slow-consumer close tasks, referenced until done so they are not garbage-collected
+
+    def add(self, websocket):
+        if websocket not in self.outboxes:
+            self.outboxes[websocket] = Outbox(websocket, self)
+
+    def remove(self, websocket):
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            outbox.close()
+        self.dead.discard(websocket)
+
+    def send(self, websocket, payload, key=None):
+        """Queue a payload for one connection, returns False if it was not queued"""
+        outbox = self.outboxes.get(websocket)
+        return outbox is not None and outbox.put(payload, key)
+
+    def broadcast(self, payload, exclude=None, key=None):
+        """Queue the same payload object for every connection, returns the number of connections it was queued for"""
+        queued = 0
+        for websocket, outbox in self.outboxes.items():
+            if websocket != exclude and outbox.put(payload, key):
+                queued += 1
+        return queued
+
+    def queue_depths(self):
+        """{websocket: number of queued messages}"""
+        return {websocket: len(outbox.queue) for websocket, outbox in self.outboxes.items()}
+
+    def dropped(self, outbox, close=False):
+        # Connections found dead (or too slow) are collected and cleaned up together in one task,
+        # so cleanup never runs inside a broadcast and never triggers another broadcast per connection
+        outbox.closed = True
+        outbox.queue.clear()
+        if close:
+            task = asyncio.create_task(outbox.websocket.close(code=1008, reason="slow consumer"))
+            self.closing.add(task)
+            task.add_done_callback(self.close_done)
+        self.dead.add(outbox.websocket)
+        if self.reaper is None:
+            self.reaper = asyncio.create_task(self.reap())
+
+    def close_done(self, task):
+        self.closing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Closing a slow consumer failed: {task.exception()!r}")
+
+    async def reap(self):
+        await asyncio.sleep(0)
+        dead, self.dead = list(self.dead), set()
+        self.reaper = None
+        if self.on_disconnect is not None and dead:
+            await self.on_disconnect(dead)
@@ -0,0 +1,94 @@
+# Binary chat frames, sent as WebSocket binary messages by clients that ask for them at registration.
+# A frame is a fixed header followed by the raw ciphertext, which the server forwards without decoding:
+#   type (1) | flags (1) | reserved (2) | peer id (4) | length (4) | counter (8), big-endian
+# In a CHAT frame the peer id is the recipient (client -> server) or the sender (server -> client),
+# in an ACK frame it is the id the message got in the history and 'flags' holds the status.
+import base64
+import struct
+
+FRAME_HEADER = struct.Struct(">BBHIIQ")
+HEADER_SIZE = FRAME_HEADER.size
+
+FRAME_CHAT = 1
+FRAME_ACK = 2
+
+# "error": the server failed routing the message, the ACK's message id is 0 then
+ACK_STATUS = {"delivered": 0, "stored": 1, "dropped": 2, "error": 3}
+
+
+def pack_header(frame_type, peer_id, length, counter=0, flags=0):
+    return FRAME_HEADER.pack(frame_type, flags, 0, peer_id, length, counter)
+
+
+def parse_frame(data):
+    """Returns (type, flags, peer id, counter, body); the body is a memoryview into 'data', not a copy"""
+    if len(data) < HEADER_SIZE:
+        raise ValueError("Truncated frame header")
+    frame_type, flags, _, peer_id, length, counter = FRAME_HEADER.unpack_from(data)
+    if len(data) != HEADER_SIZE + length:
+        raise ValueError("Frame length does not match its header")
+    return frame_type, flags, peer_id, counter, memoryview(data)[HEADER_SIZE:]
+
+
+def ack_frame(status, message_id, counter):
+    return pack_header(FRAME_ACK, message_id, 0, counter, ACK_STATUS[status])
+
+
+def as_text(content):
+    # Ciphertext from binary frames is kept as bytes; JSON clients get it base64-encoded, as they send it
+    return content if isinstance(content, str) else base64.b64encode(content).decode("ascii")
+
+
+def as_bytes(content):
+    return base64.b64decode(content) if isinstance(content, str) else content
+
+
+def wire_size(message):
+    # Bytes of a WebSocket message on the wire: text frames are UTF-8, so non-ASCII text is longer than len()
+    if isinstance(message, str) and not message.isascii():
+        return len(message.encode("utf-8"))
+    return len(message)
+
+
+# Length-prefixed framing for byte streams (the TCP chat client and its server):
+#   payload length (4, big-endian) | payload
+STREAM_HEADER = struct.Struct(">I")
+MAX_STREAM_FRAME = 16 * 1024 * 1024
+
+
+def stream_header(payload):
+    return STREAM_HEADER.pack(len(payload))
+
+
+class FrameDecoder:
+    """Splits a byte stream into length-prefixed frames, whatever way TCP cut it into reads"""
+
+    def __init__(self, max_size=MAX_STREAM_FRAME):
+        self.max_size = max_size
+        self.buffer = bytearray()  # Only the bytes of an incomplete frame are kept between reads
+
+    def feed(self, data):
+        """Returns the frames completed by 'data' (possibly none), raises ValueError for an oversized frame"""
+        # Frames are cut straight out of the read when nothing is buffered, so a read holding whole
+        # frames is never copied into the buffer; the buffer is compacted once per read, not per frame
+        if self.buffer:
+            self.buffer += data
+            data = self.buffer
+        view = memoryview(data)
+        frames = []
+        offset = 0
+        while len(data) - offset >= STREAM_HEADER.size:
+            (length,) = STREAM_HEADER.unpack_from(data, offset)
+            if length > self.max_size:
+                raise ValueError(f"Stream frame of {length} bytes exceeds the limit")
+            end = offset + STREAM_HEADER.size + length
+            if end > len(data):
+                break
+            frames.append(bytes(view[offset + STREAM_HEADER.size:end]))
+            offset = end
+        view.release()
+        if data is self.buffer:
+            del self.buffer[:offset]
+        else:
+            self.buffer += data[offset:]
+        return frames
@@ -0,0 +1,251 @@
+# Galois/Counter Mode (NIST SP 800-38D) on aes.AES: CTR encryption and GHASH authentication in one pass
+# over the data, instead of CTR followed by a separate HMAC-SHA256 pass.
+# With the "openssl" engine the whole mode runs in libcrypto (see openssl_aes.GCMStream); otherwise the
+# keystream comes from ctr.CTR and GHASH uses 8-bit multiplication tables built once per key.
+import hmac
+import struct
+
+import numpy as np
+
+import openssl_aes
+from ctr import CTR, as_uint8
+
+BLOCK_SIZE = 16
+TAG_SIZE = 16
+IV_SIZE = 12  # Recommended IV length, any other length goes through GHASH to form the first counter block
+
+# GF(2^128) reduction constant: GCM bit order puts x^0 in the most significant bit of a block
+R = 0xE1 << 120
+
+# NIST GCM test cases (McGrew & Viega, "The Galois/Counter Mode of Operation", tests 1-6 and 13-16):
+# (key, iv, plaintext, aad, ciphertext, tag)
+GCM_PLAINTEXT = ("d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72"
+                 "1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b391aafd255")
+GCM_AAD = "feedfacedeadbeeffeedfacedeadbeefabaddad2"
+GCM_VECTORS = [
+    ("00000000000000000000000000000000", "000000000000000000000000", "", "", "",
+     "58e2fccefa7e3061367f1d57a4e7455a"),
+    ("00000000000000000000000000000000", "000000000000000000000000", "00000000000000000000000000000000", "",
+     "0388dace60b6a392f328c2b971b2fe78", "ab6e47d42cec13bdf53a67b21257bddf"),
+    ("feffe9928665731c6d6a8f9467308308", "cafebabefacedbaddecaf888", GCM_PLAINTEXT, "",
+     "42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e"
+     "21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091473f5985", "4d5c2af327cd64a62cf35abd2ba6fab4"),
+    ("feffe9928665731c6d6a8f9467308308", "cafebabefacedbaddecaf888", GCM_PLAINTEXT[:120], GCM_AAD,
+     "42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e"
+     "21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091", "5bc94fbc3221a5db94fae95ae7121a47"),
+    ("feffe9928665731c6d6a8f9467308308", "cafebabefacedbad", GCM_PLAINTEXT[:120], GCM_AAD,
+     "61353b4c2806934a777ff51fa22a4755699b2a714fcdc6f83766e5f97b6c7423"
+     "73806900e49f24b22b097544d4896b424989b5e1ebac0f07c23f4598", "3612d2e79e3b0785561be14aaca2fccb"),
+    ("feffe9928665731c6d6a8f9467308308",
+     "9313225df88406e555909c5aff5269aa6a7a9538534f7da1e4c303d2a318a728"
+     "c3c0c95156809539fcf0e2429a6b525416aedbf5a0de6a57a637b39b", GCM_PLAINTEXT[:120], GCM_AAD,
+     "8ce24998625615b603a033aca13fb894be9112a5c3a211a8ba262a3cca7e2ca7"
+     "01e4a9a4fba43c90ccdcb281d48c7c6fd62875d2aca417034c34aee5", "619cc5aefffe0bfa462af43c1699d050"),
+    ("0000000000000000000000000000000000000000000000000000000000000000", "000000000000000000000000",
+     "", "", "", "530f8afbc74536b9a963b4f1c4cb738b"),
+    ("0000000000000000000000000000000000000000000000000000000000000000", "000000000000000000000000",
+     "00000000000000000000000000000000", "", "cea7403d4d606b6e074ec5d3baf39d18",
+     "d0d1c8a799996bf0265b98b5d48ab919"),
+    ("feffe9928665731c6d6a8f9467308308feffe9928665731c6d6a8f9467308308", "cafebabefacedbaddecaf888",
+     GCM_PLAINTEXT, "",
+     "522dc1f099567d07f47f37a32a84427d643a8cdcbfe5c0c97598a2bd2555d1aa"
+     "8cb08e48590dbb3da7b08b1056828838c5f61e6393ba7a0abcc9f662898015ad", "b094dac5d93471bdec1a502270e3cc6c"),
+    ("feffe9928665731c6d6a8f9467308308feffe9928665731c6d6a8f9467308308", "cafebabefacedbaddecaf888",
+     GCM_PLAINTEXT[:120], GCM_AAD,
+     "522dc1f099567d07f47f37a32a84427d643a8cdcbfe5c0c97598a2bd2555d1aa"
+     "8cb08e48590dbb3da7b08b1056828838c5f61e6393ba7a0abcc9f662", "76fc6ece0f4e1768cddf8853bb2d551b"),
+]
+
+
+def gf_mult(x, y):
+    # Bit-by-bit GF(2^128) product (SP 800-38D algorithm 1), the definition the tables are checked against
+    z = 0
+    v = y
+    for i in range(127, -1, -1):
+        if (x >> i) & 1:
+            z ^= v
+        v = (v >> 1) ^ R if v & 1 else v >> 1
+    return z
+
+
+def ghash_tables(h):
+    # Multiplication by H is linear, so X * H is the XOR over the 16 bytes of X of (that byte alone) * H:
+    # tables[i][b] is the product for byte value b at byte position i, 16 lookups per block.
+    # The 128 single-bit products are H * x^k, each one multiplication by x (a shift) from the previous
+    products = []
+    v = h
+    for _ in range(128):
+        products.append(v)
+        v = (v >> 1) ^ R if v & 1 else v >> 1
+
+    tables = []
+    for i in range(16):
+        table = [0] * 256
+        for bit in range(8):
+            # Byte value bit 'bit' of byte i is x^(8i + 7 - bit)
+            product = products[8 * i + 7 - bit]
+            m = 1 << bit
+            for b in range(m):
+                table[m | b] = table[b] ^ product
+        tables.append(table)
+    return tables
+
+
+class GHASH:
+    """Running GHASH over data fed in any piece sizes; pad() closes a zero-padded section (AAD, ciphertext)"""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.y = 0
+        self.partial = b""
+
+    def update(self, data):
+        data = self.partial + bytes(data)
+        whole = len(data) - len(data) % BLOCK_SIZE
+        self.partial = data[whole:]
+        (t0, t1, t2, t3, t4, t5, t6, t7, t8, t9, t10, t11, t12, t13, t14, t15) = self.tables
+        y = self.y
+        for hi, lo in struct.iter_unpack(">QQ", memoryview(data)[:whole]):
+            b = (y ^ (hi << 64 | lo)).to_bytes(16, "big")
+            y = (t0[b[0]] ^ t1[b[1]] ^ t2[b[2]] ^ t3[b[3]] ^ t4[b[4]] ^ t5[b[5]] ^ t6[b[6]] ^ t7[b[7]] ^
+                 t8[b[8]] ^ t9[b[9]] ^ t10[b[10]] ^ t11[b[11]] ^ t12[b[12]] ^ t13[b[13]] ^ t14[b[14]] ^ t15[b[15]])
+        self.y = y
+
+    def pad(self):
+        if self.partial:
+            self.update(bytes(BLOCK_SIZE - len(self.partial)))
+
+
+class _Stream:
+    def update(self, data):
+        """Encrypts or decrypts the next piece of the message, returns bytes of the same length"""
+        src = as_uint8(data)
+        out = np.empty(len(src), dtype=np.uint8)
+        self.update_into(src, out)
+        return out.tobytes()
+
+
+class GCMStream(_Stream):
+    """One message: update() / update_into() as the data comes, then finalize().
+    Decrypted output is unauthenticated until finalize(tag) has returned"""
+
+    def __init__(self, gcm, iv, aad=b"", decrypt=False):
+        self.decrypt = decrypt
+        j0 = gcm.j0(iv)
+        self.tag_mask = int.from_bytes(bytes(gcm.cipher.encrypt(j0)), "big")
+        # Counter blocks are J0 with its last 32 bits incremented (mod 2^32), starting at J0 + 1
+        self.ctr = CTR(gcm.cipher, j0[:12])
+        self.counter = int.from_bytes(j0[12:], "big") + 1
+        self.ghash = GHASH(gcm.tables)
+        self.ghash.update(aad)
+        self.ghash.pad()
+        self.aad_len = len(aad)
+        self.length = 0
+        self.tail = np.empty(0, dtype=np.uint8)  # Unused keystream of the last partial block
+
+    def update_into(self, src, dst):
+        # src and dst are flat uint8 arrays, dst may be src
+        if self.decrypt:
+            self.ghash.update(src)
+        n = min(len(self.tail), len(src))
+        if n:
+            np.bitwise_xor(src[:n], self.tail[:n], out=dst[:n])
+            self.tail = self.tail[n:]
+        whole = (len(src) - n) // BLOCK_SIZE * BLOCK_SIZE
+        if whole:
+            self.ctr.encrypt_into(src[n:n + whole], dst[n:n + whole], self.counter % 2 ** 32)
+            self.counter += whole // BLOCK_SIZE
+        rest = len(src) - n - whole
+        if rest:
+            keystream = self.ctr.keystream(self.counter % 2 ** 32, 1)
+            self.counter += 1
+            np.bitwise_xor(src[n + whole:], keystream[:rest], out=dst[n + whole:len(src)])
+            self.tail = keystream[rest:]
+        if not self.decrypt:
+            self.ghash.update(dst[:len(src)])
+        self.length += len(src)
+
+    def finalize(self, tag=None):
+        """Encryption returns the tag; decryption checks 'tag' and raises ValueError on a mismatch"""
+        self.ghash.pad()
+        self.ghash.update(struct.pack(">QQ", self.aad_len * 8, self.length * 8))
+        computed = (self.ghash.y ^ self.tag_mask).to_bytes(TAG_SIZE, "big")
+        if not self.decrypt:
+            return computed
+        if tag is None or not hmac.compare_digest(computed, bytes(tag)):
+            raise ValueError("GCM tag check failed.")
+        return None
+
+
+class NativeGCMStream(_Stream):
+    """The same interface on OpenSSL's GCM, for ciphers of the "openssl" engine"""
+
+    def __init__(self, key, iv, aad=b"", decrypt=False):
+        self.stream = openssl_aes.GCMStream(key, iv, aad, decrypt)
+
+    def update_into(self, src, dst):
+        self.stream.update_into(src.ctypes.data, dst.ctypes.data, len(src))
+
+    def finalize(self, tag=None):
+        return self.stream.finalize(tag)
+
+
+class GCM:
+    def __init__(self, cipher, native=True):
+        # native=False keeps the table-driven implementation even for an "openssl" engine cipher
+        self.cipher = cipher
+        self.native = getattr(cipher, "native", None) if native else None
+        self._tables = None
+
+    @property
+    def tables(self):
+        # Built on first use: H = E_K(0^128), about 4000 table entries per key
+        if self._tables is None:
+            self._tables = ghash_tables(int.from_bytes(bytes(self.cipher.encrypt(bytes(BLOCK_SIZE))), "big"))
+        return self._tables
+
+    def j0(self, iv):
+        # Pre-counter block: IV | 0^31 | 1 for a 96-bit IV, otherwise GHASH(IV | padding | length of IV)
+        iv = bytes(iv)
+        if len(iv) == IV_SIZE:
+            return iv + b"\x00\x00\x00\x01"
+        ghash = GHASH(self.tables)
+        ghash.update(iv)
+        ghash.pad()
+        ghash.update(struct.pack(">QQ", 0, len(iv) * 8))
+        return ghash.y.to_bytes(BLOCK_SIZE, "big")
+
+    def stream(self, iv, aad=b"", decrypt=False):
+        if self.native is not None:
+            return NativeGCMStream(self.native.key, iv, aad, decrypt)
+        return GCMStream(self, iv, aad, decrypt)
+
+    def encrypt(self, iv, plaintext, aad=b""):
+        """Returns (ciphertext, tag)"""
+        stream = self.stream(iv, aad)
+        ciphertext = stream.update(plaintext)
+        return ciphertext, stream.finalize()
+
+    def decrypt(self, iv, ciphertext, tag, aad=b""):
+        """Returns the plaintext, raises ValueError if the tag does not match"""
+        stream = self.stream(iv, aad, decrypt=True)
+        plaintext = stream.update(ciphertext)
+        stream.finalize(tag)
+        return plaintext
+
+
+def self_test(engine=None):
+    # NIST GCM vectors, through the native path when the engine has one and always through the tables
+    from aes import AES
+
+    for key, iv, plaintext, aad, ciphertext, tag in GCM_VECTORS:
+        cipher = AES.from_key(bytes.fromhex(key), engine=engine)
+        iv, plaintext, aad = bytes.fromhex(iv), bytes.fromhex(plaintext), bytes.fromhex(aad)
+        for native in (True, False):
+            gcm = GCM(cipher, native=native)
+            result = gcm.encrypt(iv, plaintext, aad)
+            assert (result[0].hex(), result[1].hex()) == (ciphertext, tag), \
+                f"GCM failed a NIST vector (AES-{cipher.key_len}, {len(iv)}-byte IV, native={native})."
+            assert gcm.decrypt(iv, bytes.fromhex(ciphertext), bytes.fromhex(tag), aad) == plaintext, \
+                f"GCM decryption failed a NIST vector (AES-{cipher.key_len}, native={native})."
+    return True
@@ -0,0 +1,219 @@
+# Session establishment for a chat connection: the password is never sent, both ends prove they know it.
+# One scrypt derivation per connection, then an ephemeral X25519 exchange whose shared secret is mixed with
+# the password key into per-direction AES and HMAC keys. After that a message is only
+#   counter (8) | ciphertext | tag (16)
+# where the per-direction message counter is also the CTR nonce, so no salt, IV or KDF work per message.
+#
+#   client -> server  HELLO   version (1) | salt (16) | client public key (32)
+#   server -> client  REPLY   server public key (32) | server confirmation (32)
+#   client -> server  FINISH  client confirmation (32)
+#
+# The confirmations are HMACs of the transcript under keys derived from the password key and the shared
+# secret: a peer with the wrong password (or a tampered HELLO/REPLY) fails there, before any message.
+import hashlib
+import hmac
+import secrets
+import struct
+
+from session import SessionKey, hkdf_sha256
+
+VERSION = 1
+SALT_SIZE = 16
+KEY_SIZE = 32
+CONFIRM_SIZE = 32
+HELLO_SIZE = 1 + SALT_SIZE + KEY_SIZE
+REPLY_SIZE = KEY_SIZE + CONFIRM_SIZE
+FINISH_SIZE = CONFIRM_SIZE
+
+# HKDF 'info' prefix of the session keys, the transcript hash is appended to it
+SESSION_KEY_INFO = b"secure-chat session keys"
+
+# Message header (counter) and the truncated HMAC-SHA256 tag closing every message
+MESSAGE_HEADER = struct.Struct(">Q")
+TAG_SIZE = 16
+MESSAGE_OVERHEAD = MESSAGE_HEADER.size + TAG_SIZE
+
+# Curve25519 (RFC 7748): field prime, (A - 2) / 4 and the base point u = 9
+P = 2 ** 255 - 19
+A24 = 121665
+BASE_POINT = (9).to_bytes(32, "little")
+
+# RFC 7748 section 5.2 and 6.1 vectors: (scalar, u, result)
+X25519_VECTORS = [
+    ("a546e36bf0527c9d3b16154b82465edd62144c0ac1fc5a18506a2244ba449ac4",
+     "e6db6867583030db3594c1a424b15f7c726624ec26b3353b10a903a6d0ab1c4c",
+     "c3da55379de9c6908e94ea4df28d084f32eccf03491c71f754b4075577a28552"),
+    ("77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a",
+     "0900000000000000000000000000000000000000000000000000000000000000",
+     "8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a"),
+    ("5dab087e624a8a4b79e17f8b83800ee66f3bb1292618b6fd1c2f8b27ff88e0eb",
+     "8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a",
+     "4a5d9d5ba4ce2de1728e3bf480350f25e07e21c947d19e3376f09b3c1e161742"),
+]
+
+
+def x25519(scalar, u):
+    # Montgomery ladder on Python integers (RFC 7748 section 5). Python's big integers do not run in
+    # constant time, which is acceptable for ephemeral keys used once per connection
+    k = int.from_bytes(scalar, "little")
+    k = (k & ~7 & ~(1 << 255)) | (1 << 254)
+    x1 = int.from_bytes(u, "little") & ((1 << 255) - 1)
+    x2, z2, x3, z3 = 1, 0, x1, 1
+    swap = 0
+    for t in range(254, -1, -1):
+        bit = (k >> t) & 1
+        if swap ^ bit:
+            x2, x3, z2, z3 = x3, x2, z3, z2
+        swap = bit
+        a = x2 + z2
+        aa = a * a % P
+        b = x2 - z2
+        bb = b * b % P
+        e = aa - bb
+        da = (x3 - z3) * a % P
+        cb = (x3 + z3) * b % P
+        x3 = (da + cb) ** 2 % P
+        z3 = x1 * (da - cb) ** 2 % P
+        x2 = aa * bb % P
+        z2 = e * (aa + A24 * e) % P
+    if swap:
+        x2, z2 = x3, z3
+    return (x2 * pow(z2, P - 2, P) % P).to_bytes(32, "little")
+
+
+def self_test():
+    for scalar, u, result in X25519_VECTORS:
+        assert x25519(bytes.fromhex(scalar), bytes.fromhex(u)).hex() == result, "X25519 failed an RFC 7748 vector."
+    return True
+
+
+def session_keys(passwd, salt, shared, transcript):
+    # Client-to-server and server-to-client (AES key, HMAC key) pairs and the two confirmation keys
+    if not any(shared):
+        raise ValueError("Handshake failed: low-order public key")
+    password_key = SessionKey(passwd, salt).master_key  # The connection's one scrypt run
+    okm = hkdf_sha256(shared, SESSION_KEY_INFO + hashlib.sha256(transcript).digest(), 6 * 32, salt=password_key)
+    keys = [okm[i:i + 32] for i in range(0, len(okm), 32)]
+    return (keys[0], keys[1]), (keys[2], keys[3]), keys[4], keys[5]
+
+
+class SecureChannel:
+    """Per-direction ciphers and message counters of one established connection"""
+
+    def __init__(self, send_keys, receive_keys):
+        from aes import AES
+        from ctr import CTR
+
+        self.CTR = CTR
+        self.send_cipher = AES.from_key(send_keys[0], hmac_key=send_keys[1])
+        self.receive_cipher = AES.from_key(receive_keys[0], hmac_key=receive_keys[1])
+        self.send_counter = 0
+        self.receive_counter = 0  # Lowest counter the next message may carry
+
+    def tag(self, cipher, header, ciphertext):
+        return hmac.new(cipher.hmac_key, header + ciphertext, hashlib.sha256).digest()[:TAG_SIZE]
+
+    def seal(self, plaintext):
+        # Every message gets the next counter; it is the CTR nonce and keys are per direction,
+        # so a (key, nonce) pair is never used twice
+        counter = self.send_counter
+        self.send_counter += 1
+        header = MESSAGE_HEADER.pack(counter)
+        ciphertext = self.CTR(self.send_cipher, counter.to_bytes(10, "big")).encrypt_buffer(plaintext, 0)
+        return header + ciphertext + self.tag(self.send_cipher, header, ciphertext)
+
+    def open(self, message):
+        # Raises ValueError for a forged, truncated, replayed or reordered message
+        if len(message) < MESSAGE_OVERHEAD:
+            raise ValueError("Truncated message")
+        message = memoryview(message)
+        header = bytes(message[:MESSAGE_HEADER.size])
+        ciphertext = bytes(message[MESSAGE_HEADER.size:-TAG_SIZE])
+        if not hmac.compare_digest(message[-TAG_SIZE:], self.tag(self.receive_cipher, header, ciphertext)):
+            raise ValueError("HMAC check failed.")
+        (counter,) = MESSAGE_HEADER.unpack(header)
+        if counter < self.receive_counter:
+            raise ValueError("Replayed or reordered message")
+        self.receive_counter = counter + 1
+        return self.CTR(self.receive_cipher, counter.to_bytes(10, "big")).decrypt_buffer(ciphertext, 0)
+
+
+class ClientHandshake:
+    """Initiator side, without I/O: send hello(), pass the REPLY to finish(), send the returned FINISH"""
+
+    def __init__(self, passwd, salt=None):
+        # A fresh salt per connection unless one is given: simulated clients of a load test share one,
+        # so the process runs scrypt once (session keys still differ, they depend on the X25519 secret)
+        self.passwd = passwd
+        self.salt = salt or secrets.token_bytes(SALT_SIZE)
+        self.private = secrets.token_bytes(KEY_SIZE)
+        self.hello_message = bytes([VERSION]) + self.salt + x25519(self.private, BASE_POINT)
+
+    def hello(self):
+        return self.hello_message
+
+    def finish(self, reply):
+        """Returns (FINISH message, SecureChannel), raises ValueError if the server does not know the password"""
+        if len(reply) != REPLY_SIZE:
+            raise ValueError("Handshake failed: malformed reply")
+        server_public, server_confirm = bytes(reply[:KEY_SIZE]), bytes(reply[KEY_SIZE:])
+        transcript = self.hello_message + server_public
+        to_server, to_client, server_key, client_key = session_keys(
+            self.passwd, self.salt, x25519(self.private, server_public), transcript
+        )
+        if not hmac.compare_digest(server_confirm, hmac.digest(server_key, transcript, hashlib.sha256)):
+            raise ValueError("Handshake failed: wrong password or tampered handshake")
+        return hmac.digest(client_key, transcript, hashlib.sha256), SecureChannel(to_server, to_client)
+
+
+class ServerHandshake:
+    """Responder side, without I/O: answer the HELLO with reply(), then pass the FINISH to finish()"""
+
+    def __init__(self, passwd):
+        self.passwd = passwd
+        self.private = secrets.token_bytes(KEY_SIZE)
+        self.keys = None
+        self.transcript = None
+
+    def reply(self, hello):
+        if len(hello) != HELLO_SIZE or hello[0] != VERSION:
+            raise ValueError("Handshake failed: unsupported hello")
+        hello = bytes(hello)
+        salt, client_public = hello[1:1 + SALT_SIZE], hello[1 + SALT_SIZE:]
+        server_public = x25519(self.private, BASE_POINT)
+        self.transcript = hello + server_public
+        self.keys = session_keys(self.passwd, salt, x25519(self.private, client_public), self.transcript)
+        return server_public + hmac.digest(self.keys[2], self.transcript, hashlib.sha256)
+
+    def finish(self, finish):
+        """Returns the SecureChannel, raises ValueError if the client does not know the password"""
+        to_server, to_client, _, client_key = self.keys
+        if not hmac.compare_digest(bytes(finish), hmac.digest(client_key, self.transcript, hashlib.sha256)):
+            raise ValueError("Handshake failed: wrong password or tampered handshake")
+        return SecureChannel(to_client, to_server)
+
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed during the handshake")
+        data += chunk
+    return data
+
+
+def connect_session(sock, passwd):
+    """Client side of the handshake over a connected socket, returns the SecureChannel"""
+    handshake = ClientHandshake(passwd)
+    sock.sendall(handshake.hello())
+    finish, channel = handshake.finish(recv_exact(sock, REPLY_SIZE))
+    sock.sendall(finish)
+    return channel
+
+
+def accept_session(sock, passwd):
+    """Server side of the handshake over an accepted socket, returns the SecureChannel"""
+    handshake = ServerHandshake(passwd)
+    sock.sendall(handshake.reply(recv_exact(sock, HELLO_SIZE)))
+    return handshake.finish(recv_exact(sock, FINISH_SIZE))
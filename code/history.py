@@ -0,0 +1,249 @@
+import bisect
+import sqlite3
+import time
+from collections import OrderedDict, deque
+
+
+def conversation_key(user_a, user_b):
+    """Both directions of a conversation share one key"""
+    return "\x00".join(sorted((user_a, user_b)))
+
+
+class Conversation:
+    """Ring buffer of one conversation's messages, ordered by id so pages are found by bisection"""
+
+    def __init__(self, max_messages, max_age):
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.ids = []
+        self.items = []
+        self.start = 0  # Entries before 'start' are evicted and compacted away lazily
+
+    def __len__(self):
+        return len(self.ids) - self.start
+
+    def append(self, message):
+        self.ids.append(message["id"])
+        self.items.append(message)
+        self.evict()
+
+    def evict(self):
+        if len(self) > self.max_messages:
+            self.start = len(self.ids) - self.max_messages
+        if self.max_age is not None:
+            cutoff = time.time() - self.max_age
+            while self.start < len(self.ids) and self.items[self.start]["timestamp"] < cutoff:
+                self.start += 1
+        # Compact once at least half of the lists are evicted entries, amortised O(1) per message
+        if self.start and self.start * 2 >= len(self.ids):
+            del self.ids[:self.start]
+            del self.items[:self.start]
+            self.start = 0
+
+    def page(self, before_id, limit):
+        """Up to 'limit' messages with id < before_id, oldest first"""
+        self.evict()
+        end = len(self.ids) if before_id is None else bisect.bisect_left(self.ids, before_id, lo=self.start)
+        begin = max(self.start, end - limit)
+        return self.items[begin:end]
+
+
+class SQLiteLog:
+    """Append-only on-disk message log in SQLite (WAL mode), holding the opaque encrypted payloads"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL only syncs at checkpoints, appends stay cheap enough to run on the event loop
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY, conversation TEXT NOT NULL, sender TEXT NOT NULL, "
+            "recipient TEXT NOT NULL, content TEXT NOT NULL, timestamp REAL NOT NULL, delivered INTEGER NOT NULL, "
+            "counter INTEGER NOT NULL DEFAULT 0)"
+        )
+        # Logs written before messages carried their CTR counter
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(messages)")]
+        if "counter" not in columns:
+            self.db.execute("ALTER TABLE messages ADD COLUMN counter INTEGER NOT NULL DEFAULT 0")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation, id)")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS messages_pending ON messages (recipient, id) WHERE delivered = 0"
+        )
+        self.db.commit()
+
+    def last_id(self):
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+    def append(self, message, delivered):
+        self.db.execute(
+            "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (message["id"], conversation_key(message["from"], message["to"]), message["from"], message["to"],
+             message["content"], message["timestamp"], int(delivered), message["counter"]),
+        )
+        self.db.commit()
+
+    def page(self, key, before_id, limit):
+        rows = self.db.execute(
+            "SELECT id, sender, recipient, content, timestamp, counter FROM messages "
+            "WHERE conversation = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (key, before_id if before_id is not None else 2 ** 63 - 1, limit),
+        ).fetchall()
+        return [self.row_to_message(row) for row in reversed(rows)]
+
+    def pending(self, recipient):
+        rows = self.db.execute(
+            "SELECT id, sender, recipient, content, timestamp, counter FROM messages "
+            "WHERE recipient = ? AND delivered = 0 ORDER BY id",
+            (recipient,),
+        ).fetchall()
+        return [self.row_to_message(row) for row in rows]
+
+    def mark_delivered(self, ids):
+        self.db.executemany("UPDATE messages SET delivered = 1 WHERE id = ?", [(i,) for i in ids])
+        self.db.commit()
+
+    @staticmethod
+    def row_to_message(row):
+        return {"id": row[0], "from": row[1], "to": row[2], "content": row[3], "timestamp": row[4], "counter": row[5]}
+
+    def close(self):
+        self.db.close()
+
+
+class MessageHistory:
+    """Per-conversation history with size/age eviction, store-and-forward for offline users,
+    and an optional SQLite log behind the in-memory buffers"""
+
+    def __init__(self, max_messages=1000, max_age=None, max_pending=1000, path=None, max_conversations=10000,
+                 sweep_interval=60.0, max_pending_bytes=64 * 1024 * 1024):
+        # At most max_conversations are kept in memory, the least recently used one goes first (with a log
+        # its history is still paged from there). With max_age, every sweep_interval seconds an append
+        # also evicts expired messages from idle conversations and drops the ones left empty
+        self.max_messages = max_messages
+        self.max_age = max_age
+        # Undelivered messages (without a log): at most max_pending per recipient and max_pending_bytes of
+        # content across all of them, since clients choose the recipient names
+        self.max_pending = max_pending
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.max_conversations = max_conversations
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.monotonic()
+        self.conversations = OrderedDict()  # {conversation key: Conversation}, least recently used first
+        self.offline = OrderedDict()  # {recipient: deque of undelivered messages}, least recently stored first
+        self.log = SQLiteLog(path) if path else None
+        self.last_id = self.log.last_id() if self.log else 0
+
+    def append(self, sender, recipient, content, delivered, counter=0):
+        # 'content' is the ciphertext as received: base64 text (JSON) or bytes (binary frames)
+        self.last_id += 1
+        message = {
+            "id": self.last_id,
+            "from": sender,
+            "to": recipient,
+            "content": content,
+            "counter": counter,
+            "timestamp": time.time(),
+        }
+        key = conversation_key(sender, recipient)
+        conversation = self.conversations.get(key)
+        if conversation is None:
+            conversation = self.conversations[key] = Conversation(self.max_messages, self.max_age)
+            if len(self.conversations) > self.max_conversations:
+                self.conversations.popitem(last=False)
+        else:
+            self.conversations.move_to_end(key)
+        conversation.append(message)
+        if self.max_age is not None and time.monotonic() - self.last_sweep >= self.sweep_interval:
+            self.sweep()
+
+        if self.log is not None:
+            self.log.append(message, delivered)
+        elif not delivered:
+            self.store_pending(recipient, message)
+        return message
+
+    def page(self, user, peer, before_id=None, limit=50):
+        """Messages between user and peer older than before_id, oldest first, and whether there are more"""
+        key = conversation_key(user, peer)
+        conversation = self.conversations.get(key)
+        if conversation is not None:
+            self.conversations.move_to_end(key)
+        messages = conversation.page(before_id, limit + 1) if conversation is not None else []
+
+        # The ring buffer ran out (evicted, or not seen since a restart): continue from the log
+        if len(messages) <= limit and self.log is not None:
+            below = messages[0]["id"] if messages else before_id
+            messages = self.log.page(key, below, limit + 1 - len(messages)) + messages
+
+        has_more = len(messages) > limit
+        return messages[len(messages) - limit:] if has_more else messages, has_more
+
+    def store_pending(self, recipient, message):
+        # Over the limits the oldest message of the recipient goes first, then the oldest messages of the
+        # recipients stored to least recently. Content is base64 text or bytes, so len() is its size
+        queue = self.offline.get(recipient)
+        if queue is None:
+            queue = self.offline[recipient] = deque()
+        else:
+            self.offline.move_to_end(recipient)
+        if len(queue) >= self.max_pending:
+            self.pending_bytes -= len(queue.popleft()["content"])
+        queue.append(message)
+        self.pending_bytes += len(message["content"])
+        while self.pending_bytes > self.max_pending_bytes:
+            oldest_recipient, oldest = next(iter(self.offline.items()))
+            self.pending_bytes -= len(oldest.popleft()["content"])
+            if not oldest:
+                del self.offline[oldest_recipient]
+
+    def sweep(self):
+        """Evict expired messages from every conversation and drop the empty ones, returns how many were dropped"""
+        self.last_sweep = time.monotonic()
+        empty = []
+        for key, conversation in self.conversations.items():
+            conversation.evict()
+            if not conversation:
+                empty.append(key)
+        for key in empty:
+            del self.conversations[key]
+        return len(empty)
+
+    def take_pending(self, recipient):
+        """Messages stored while the recipient was offline, marked delivered as they are taken"""
+        if self.log is not None:
+            messages = self.log.pending(recipient)
+            self.log.mark_delivered([m["id"] for m in messages])
+        else:
+            messages = list(self.offline.pop(recipient, ()))
+            self.pending_bytes -= sum(len(m["content"]) for m in messages)
+        return messages
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+
+def self_test():
+    # Memory bounds of the in-memory history against clients inventing recipient names; raises explicitly,
+    # so it also checks under python -O
+    history = MessageHistory(max_pending=3, max_pending_bytes=100, max_conversations=5)
+    for i in range(50):
+        history.append("sender", f"invented-{i}", "x" * 10, delivered=False)
+    if history.pending_bytes > 100 or len(history.offline) != 10 or len(history.conversations) != 5:
+        raise AssertionError("Pending messages or conversations are not bounded.")
+    if [m["to"] for m in history.take_pending("invented-49")] != ["invented-49"]:
+        raise AssertionError("The most recent pending message was evicted.")
+    if history.take_pending("invented-0"):
+        raise AssertionError("The least recently stored recipient was not evicted.")
+
+    for _ in range(10):
+        history.append("sender", "bob", "y", delivered=False)
+    if len(history.offline["bob"]) != 3:
+        raise AssertionError("Pending messages of one recipient are not bounded.")
+    for recipient in list(history.offline):
+        history.take_pending(recipient)
+    if history.pending_bytes or history.offline:
+        raise AssertionError("Pending byte count is off after delivery.")
+    return True
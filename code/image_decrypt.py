@@ -1,7 +1,15 @@
 import os
+import mmap
+import hmac
+import hashlib
+import concurrent.futures
 import binascii
 from PIL import Image
 import io
+import numpy as np
+from ctr import CTR
+from session import cached_cipher
+from image_encrypt import MMAP_CHUNK_SIZE
 
 
 def binary_to_png(binary_file_path, output_path):
@@ -30,19 +38,74 @@ def binary_to_png(binary_file_path, output_path):
         print(f"Error converting file: {str(e)}")
 
 
-def convert_directory(input_dir, output_dir):
+def decrypt_image(passwd, input_path, output_path, block_size=16):
+    # Reverse of image_encrypt.encrypt_image: the encrypted file is mmap'd, its HMAC checked in place,
+    # and the plaintext XORed straight into a pre-sized, memory-mapped output file
+    # Like decrypt_file_chunks, the padding of the last block is kept in the output
+    try:
+        with open(input_path, 'rb') as file_in, \
+                mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ) as src_map:
+            if len(src_map) < 4 * block_size:
+                raise ValueError("Ciphertext is truncated.")
+            header = src_map[:2 * block_size]
+            salt = header[:block_size]
+            nonce = header[block_size: block_size + 10]
+            counter = int.from_bytes(header[block_size + 10:], "big")
+
+            cipher = cached_cipher(passwd, salt)
+            with memoryview(src_map) as view:
+                expected = hmac.digest(cipher.hmac_key, view[:-2 * block_size], hashlib.sha256)
+            if not hmac.compare_digest(src_map[-2 * block_size:], expected):
+                raise ValueError("HMAC check failed.")
+
+            mode = CTR(cipher, nonce)
+            body_len = len(src_map) - 4 * block_size
+
+            with open(output_path, 'w+b') as file_out:
+                file_out.truncate(body_len)
+                if body_len:
+                    with mmap.mmap(file_out.fileno(), body_len) as out:
+                        src = np.frombuffer(src_map, dtype=np.uint8, count=body_len, offset=2 * block_size)
+                        body = np.frombuffer(out, dtype=np.uint8)
+                        for start in range(0, body_len, MMAP_CHUNK_SIZE):
+                            stop = min(start + MMAP_CHUNK_SIZE, body_len)
+                            nblocks = -(-(stop - start) // block_size)
+                            keystream = mode.keystream(counter + start // block_size, nblocks)
+                            np.bitwise_xor(src[start:stop], keystream[:stop - start], out=body[start:stop])
+                        # Views into the maps have to be gone before the maps can be closed
+                        del src, body
+
+        print(f"Successfully decrypted {input_path} to {output_path}")
+        return output_path
+
+    except FileNotFoundError:
+        print(f"Error: File '{input_path}' not found")
+        return None
+    except Exception as e:
+        print(f"Error decrypting file: {str(e)}")
+        return None
+
+
+def _decrypt_image_job(job):
+    return decrypt_image(*job)
+
+
+def convert_directory(input_dir, output_dir, passwd, workers=None):
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Process all binary files in the directory
+    # Decrypt all encrypted files in the directory, spread across worker processes
+    # ('.bin' debug exports can still be turned back with binary_to_png)
+    jobs = []
     for filename in os.listdir(input_dir):
-        if filename.lower().endswith('.bin'):
+        if filename.lower().endswith('.enc'):
             input_path = os.path.join(input_dir, filename)
             output_path = os.path.join(output_dir, filename.rsplit('.', 1)[0] + '.png')
+            jobs.append((passwd, input_path, output_path))
 
-            print(f"Converting {filename}...")
-            binary_to_png(input_path, output_path)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_decrypt_image_job, jobs))
 
 
 # Example usage
@@ -52,9 +115,12 @@ if __name__ == "__main__":
     output_png = "restored_example.png"
 
     # Convert single file
+    decrypt_image("password", "example.enc", output_png)
+
+    # Optional: restore from the '0'/'1' debug export
     binary_to_png(binary_file, output_png)
 
-    # Convert all binary files in a directory
-    input_directory = "binary_files"
+    # Convert all encrypted files in a directory
+    input_directory = "encrypted_files"
     output_directory = "restored_pngs"
-    convert_directory(input_directory, output_directory)
\ No newline at end of file
+    convert_directory(input_directory, output_directory, "password")
\ No newline at end of file
@@ -1,12 +1,20 @@
-import concurrent
 import os
+import mmap
+import concurrent.futures
 from PIL import Image
 import binascii
+import numpy as np
 from aes import AES
 from ctr import CTR
 import secrets
 import hmac
 import hashlib
+from client import parallel
+
+# Keystream is generated and XORed this many bytes at a time, so memory use does not grow with the image size
+MMAP_CHUNK_SIZE = 1024 * 1024
+
+
 def png_to_binary(png_file_path, output_path=None):
     try:
         # Open the PNG file in binary mode
@@ -35,19 +43,88 @@ def png_to_binary(png_file_path, output_path=None):
         print(f"Error converting file: {str(e)}")
         return None
 
-def convert_directory(input_dir, output_dir):
+def encrypt_image(passwd, input_path, output_path, block_size=16):
+    # Encrypts a file from disk to disk without reading it into Python objects:
+    # the input is mmap'd read-only and the ciphertext is XORed straight into a pre-sized,
+    # memory-mapped output file laid out as salt | IV | ciphertext | HMAC (same format as encrypt_file)
+    try:
+        salt = secrets.token_bytes(block_size)
+        nonce = secrets.token_bytes(10)
+        counter = 0
+
+        cipher = AES(password_str=passwd, salt=salt, key_len=256)
+        mode = CTR(cipher, nonce)
+
+        size = os.path.getsize(input_path)
+        pad_len = -size % block_size
+        body_len = size + pad_len
+        out_size = 2 * block_size + body_len + 2 * block_size
+
+        with open(input_path, 'rb') as file_in, open(output_path, 'w+b') as file_out:
+            file_out.truncate(out_size)
+            with mmap.mmap(file_out.fileno(), out_size) as out:
+                out[:2 * block_size] = salt + nonce + counter.to_bytes(6, "big")
+
+                # mmap refuses empty files
+                src_map = mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+                try:
+                    src = np.frombuffer(src_map, dtype=np.uint8) if size else np.empty(0, dtype=np.uint8)
+                    body = np.frombuffer(out, dtype=np.uint8, count=body_len, offset=2 * block_size)
+
+                    for start in range(0, body_len, MMAP_CHUNK_SIZE):
+                        stop = min(start + MMAP_CHUNK_SIZE, body_len)
+                        plain_stop = min(stop, size)
+                        keystream = mode.keystream(counter + start // block_size, (stop - start) // block_size)
+
+                        np.bitwise_xor(src[start:plain_stop], keystream[:plain_stop - start], out=body[start:plain_stop])
+                        # The last partial block is padded with the number of padding bytes
+                        np.bitwise_xor(np.uint8(pad_len), keystream[plain_stop - start:], out=body[plain_stop:stop])
+
+                    # Views into the maps have to be gone before the maps can be closed
+                    del src, body
+                finally:
+                    if src_map is not None:
+                        src_map.close()
+
+                # HMAC over salt | IV | ciphertext, read straight from the mapped output
+                with memoryview(out) as view:
+                    mac = hmac.new(cipher.hmac_key, view[:out_size - 2 * block_size], hashlib.sha256)
+                out[out_size - 2 * block_size:] = mac.digest()
+
+        return output_path
+
+    except FileNotFoundError:
+        print(f"Error: File '{input_path}' not found")
+        return None
+    except Exception as e:
+        print(f"Error encrypting file: {str(e)}")
+        return None
+
+
+def _encrypt_image_job(job):
+    return encrypt_image(*job)
+
+
+def convert_directory(input_dir, output_dir, passwd, workers=None, export_bits=False):
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Process all PNG files in the directory
+    # Encrypt all PNG files in the directory, one file per worker process at a time
+    jobs = []
     for filename in os.listdir(input_dir):
         if filename.lower().endswith('.png'):
             input_path = os.path.join(input_dir, filename)
-            output_path = os.path.join(output_dir, filename.rsplit('.', 1)[0] + '.bin')
+            output_path = os.path.join(output_dir, filename.rsplit('.', 1)[0] + '.enc')
+            jobs.append((passwd, input_path, output_path))
+
+            # The '0'/'1' text form is only a debug export now
+            if export_bits:
+                png_to_binary(input_path, os.path.join(output_dir, filename.rsplit('.', 1)[0] + '.bin'))
 
-            print(f"Converting {filename}...")
-            png_to_binary(input_path, output_path)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for (_, input_path, _), result in zip(jobs, executor.map(_encrypt_image_job, jobs)):
+            print(f"Encrypted {input_path} -> {result}")
 
 def encrypt_file(passwd, block_size, file_in):
         try:
@@ -67,22 +144,15 @@ def encrypt_file(passwd, block_size, file_in):
             cipher = AES(password_str=passwd, salt=salt, key_len=256)
             mode = CTR(cipher, nonce)
 
-            # Prepare chunks
-            chunks = []
-            for i in range(0, len(file_in), block_size):
-                chunk = file_in[i:i + block_size]
-                if len(chunk) < block_size:
-                    padding = bytes([block_size - len(chunk)] * (block_size - len(chunk)))
-                    chunk = chunk + padding
-                chunks.append(chunk)
-
-            # print(f"Debug - Number of chunks: {len(chunks)}")
+            # Pad the last partial block with the number of padding bytes
+            pad_len = -len(file_in) % block_size
+            file_in = file_in + bytes([pad_len] * pad_len)
 
             try:
-                file_out = parallel(mode.encrypt, chunks, salt, IV, counter)
-                # print(f"Debug - Parallel encryption complete, output length: {len(file_out)}")
+                file_out = salt + IV + parallel(mode, file_in, counter)
+                # print(f"Debug - Encryption complete, output length: {len(file_out)}")
             except Exception as e:
-                # print(f"Debug - Parallel encryption failed: {str(e)}")
+                # print(f"Debug - Batched encryption failed: {str(e)}")
                 import traceback
                 print(traceback.format_exc())
                 return None
@@ -103,11 +173,6 @@ def encrypt_file(passwd, block_size, file_in):
             print(traceback.format_exc())
             return None
 
-def parallel(func, chunks, salt, IV, count_start):
-    counters = range(count_start, len(chunks) + count_start)
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        results = executor.map(func, chunks, counters)
-        return salt + IV + b"".join(results)
 # Example usage
 if __name__ == "__main__":
     # Convert a single file
@@ -115,12 +180,14 @@ if __name__ == "__main__":
     output_file = "example.bin"
 
     # Convert single file
-    result = png_to_binary(png_file, output_file)
-    result =  encrypt_file("password", 16, result)
+    result = encrypt_image("password", png_file, "example.enc")
+
+    # Optional debug export of the '0'/'1' text form
+    png_to_binary(png_file, output_file)
 
     # Convert all PNGs in a directory
     input_directory = "png_files"
-    output_directory = "binary_files"
-    convert_directory(input_directory, output_directory)
+    output_directory = "encrypted_files"
+    convert_directory(input_directory, output_directory, "password")
 
 
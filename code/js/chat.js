@@ -23,6 +23,8 @@ class ChatApp {
 
         // Initialize contacts
         this.contacts = [];
+        // Server-assigned user ids, used to address binary chat frames
+        this.usernamesById = {};
 
         this.ws = null;
         this.connectToServer();
@@ -201,15 +203,18 @@ class ChatApp {
 
             // Encrypt the message
             const encryptedBytes = this.ctr.encrypt(messageBytes, this.messageCounter++);
-            const encryptedMessage = btoa(String.fromCharCode.apply(null, encryptedBytes));
-
-            // Send encrypted message to server
-            this.sendToServer({
-                type: 'chat_message',
-                recipient: this.activeContact.name,
-                encrypted_content: encryptedMessage,
-                counter: this.messageCounter - 1 // Send counter for decryption
-            });
+
+            // Send encrypted message to server, as a binary frame once the recipient's id is known
+            if (this.activeContact.serverId !== undefined) {
+                this.sendFrame(this.activeContact.serverId, encryptedBytes, this.messageCounter - 1);
+            } else {
+                this.sendToServer({
+                    type: 'chat_message',
+                    recipient: this.activeContact.name,
+                    encrypted_content: btoa(String.fromCharCode.apply(null, encryptedBytes)),
+                    counter: this.messageCounter - 1 // Send counter for decryption
+                });
+            }
 
             // Add message to UI and storage
             this.addMessageToChat(message, 'sent', timestamp);
@@ -245,8 +250,10 @@ class ChatApp {
             const encryptedContent = message.content;
             const counter = message.counter;
 
-            // Decrypt the message
-            const encryptedBytes = Uint8Array.from(atob(encryptedContent), c => c.charCodeAt(0));
+            // Decrypt the message (binary frames carry raw bytes, JSON messages base64)
+            const encryptedBytes = encryptedContent instanceof Uint8Array
+                ? encryptedContent
+                : Uint8Array.from(atob(encryptedContent), c => c.charCodeAt(0));
             const decryptedBytes = this.ctr.decrypt(encryptedBytes, counter);
             const decryptedContent = new TextDecoder().decode(decryptedBytes);
 
@@ -375,6 +382,7 @@ class ChatApp {
     async connectToServer() {
         try {
             this.ws = new WebSocket('ws://localhost:5555');
+            this.ws.binaryType = 'arraybuffer';
 
             this.ws.onopen = () => {
                 console.log('Connected to server');
@@ -386,11 +394,16 @@ class ChatApp {
                 this.sendToServer({
                     type: 'register',
                     username: this.currentUser.username,
-                    encryption_key: derivedKey
+                    encryption_key: derivedKey,
+                    binary: true // Receive chat messages as binary frames
                 });
             };
 
             this.ws.onmessage = (event) => {
+                if (event.data instanceof ArrayBuffer) {
+                    this.handleFrame(event.data);
+                    return;
+                }
                 const message = JSON.parse(event.data);
                 this.handleServerMessage(message);
             };
@@ -408,8 +421,13 @@ class ChatApp {
     handleServerMessage(message) {
         switch (message.type) {
             case 'user_list':
+                this.presenceVersion = message.version;
                 this.updateContactsList(message.users);
                 break;
+            case 'user_joined':
+            case 'user_left':
+                this.handlePresenceDelta(message);
+                break;
             case 'chat_message':
                 this.handleIncomingMessage(message);
                 break;
@@ -422,21 +440,84 @@ class ChatApp {
     }
 
     updateContactsList(users) {
+        users.forEach(user => { this.usernamesById[user.id] = user.username; });
         // Filter out current user from the users list
         this.contacts = users
             .filter(user => user.username !== this.currentUser.username)
-            .map(user => ({
-                id: user.username, // Use username as ID
-                name: user.username,
-                avatar: '../assets/images/default-avatar.png',
-                online: true,
-                messages: [],
-                lastMessage: '',
-                lastMessageTime: ''
-            }));
+            .map(user => this.createContact(user.username, user.id));
         this.loadContacts();
     }
 
+    // Binary chat frame header (see frames.py), big-endian:
+    // type (1) | flags (1) | reserved (2) | peer id (4) | length (4) | counter (8)
+    sendFrame(recipientId, ciphertext, counter) {
+        if (!this.ws || this.ws.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        const frame = new Uint8Array(ChatApp.FRAME_HEADER_SIZE + ciphertext.length);
+        const header = new DataView(frame.buffer);
+        header.setUint8(0, ChatApp.FRAME_CHAT);
+        header.setUint32(4, recipientId);
+        header.setUint32(8, ciphertext.length);
+        header.setUint32(12, Math.floor(counter / 2 ** 32));
+        header.setUint32(16, counter % 2 ** 32);
+        frame.set(ciphertext, ChatApp.FRAME_HEADER_SIZE);
+        this.ws.send(frame);
+    }
+
+    handleFrame(buffer) {
+        const header = new DataView(buffer);
+        if (buffer.byteLength < ChatApp.FRAME_HEADER_SIZE || header.getUint8(0) !== ChatApp.FRAME_CHAT) {
+            return; // Acknowledgements are not used by the UI
+        }
+        const length = header.getUint32(8);
+        this.handleIncomingMessage({
+            from: this.usernamesById[header.getUint32(4)],
+            content: new Uint8Array(buffer, ChatApp.FRAME_HEADER_SIZE, length),
+            counter: header.getUint32(12) * 2 ** 32 + header.getUint32(16)
+        });
+    }
+
+    handlePresenceDelta(message) {
+        // Deltas must be applied in order; after a gap, ask the server for a fresh snapshot
+        if (this.presenceVersion === undefined || message.version <= this.presenceVersion) {
+            return;
+        }
+        if (message.version !== this.presenceVersion + 1) {
+            this.sendToServer({ type: 'get_user_list' });
+            return;
+        }
+        this.presenceVersion = message.version;
+
+        message.users.forEach(user => { this.usernamesById[user.id] = user.username; });
+        const usernames = message.users
+            .map(user => user.username)
+            .filter(username => username !== this.currentUser.username);
+        if (message.type === 'user_joined') {
+            usernames
+                .filter(username => !this.contacts.some(c => c.name === username))
+                .forEach(username => this.contacts.push(
+                    this.createContact(username, message.users.find(user => user.username === username).id)
+                ));
+        } else {
+            this.contacts = this.contacts.filter(c => !usernames.includes(c.name));
+        }
+        this.loadContacts();
+    }
+
+    createContact(username, serverId) {
+        return {
+            id: username, // Use username as ID
+            serverId: serverId, // Numeric id for binary frames
+            name: username,
+            avatar: '../assets/images/default-avatar.png',
+            online: true,
+            messages: [],
+            lastMessage: '',
+            lastMessageTime: ''
+        };
+    }
+
     sendToServer(message) {
         if (this.ws && this.ws.readyState === WebSocket.OPEN) {
             this.ws.send(JSON.stringify(message));
@@ -445,6 +526,10 @@ class ChatApp {
 
 }
 
+// Binary frame format shared with the server's frames.py
+ChatApp.FRAME_CHAT = 1;
+ChatApp.FRAME_HEADER_SIZE = 20;
+
 // Initialize the chat app
 document.addEventListener('DOMContentLoaded', () => {
     new ChatApp();
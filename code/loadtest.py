@@ -0,0 +1,394 @@
+# Load generator for SecureChatServer: starts a server (or connects to a running one) and drives N simulated
+# WebSocket clients speaking the register / chat_message JSON protocol from one process.
+#
+#   python loadtest.py --clients 1000 --pattern steady --duration 20
+#   python loadtest.py --url ws://127.0.0.1:5555 --metrics-url http://127.0.0.1:9100 --pattern bursty
+#   python loadtest.py --pattern reconnect --max-p99-ms 500 --max-loss 0.01   (exits 1 over the limits)
+#
+# Client i sends to client i + 1 (a ring, so every client receives as much as it sends). The message
+# counter carries a sequence number, which gives the end-to-end delivery latency when the recipient gets it.
+# Server RSS and event-loop lag come from the server's /metrics endpoint, lag as the histogram's change
+# over the run. Generator and server share the machine: the generator's own loop lag is reported too,
+# a generator that falls behind measures itself rather than the server.
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+from client import percentile
+from metrics import Metrics
+
+PATTERNS = ("steady", "bursty", "reconnect", "large")
+
+# Default payload size (bytes of ciphertext before base64) per pattern
+PAYLOAD_SIZE = {"steady": 256, "bursty": 256, "reconnect": 256, "large": 256 * 1024}
+
+# Handshakes (TCP + WebSocket + register) in progress at once while clients connect
+CONNECT_CONCURRENCY = 100
+
+# Seconds to wait after the traffic stops for messages still in flight
+DRAIN_TIMEOUT = 10.0
+
+
+class LoadStats:
+    def __init__(self):
+        self.sequence = itertools.count(1)
+        self.sent_at = {}  # {counter: send time} of messages not received yet
+        self.sent = 0
+        self.sent_bytes = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.latencies = []
+        self.connect_times = []
+        self.connect_failures = 0
+        self.errors = {}  # {error message: count}, e.g. rate limiting
+
+    def error(self, message):
+        self.errors[message] = self.errors.get(message, 0) + 1
+
+
+class SimClient:
+    """One simulated user: a WebSocket connection, registered, with a task reading what the server sends"""
+
+    def __init__(self, index, url, stats):
+        self.username = f"load{index}"
+        self.url = url
+        self.stats = stats
+        self.websocket = None
+        self.receiver = None
+
+    async def connect(self):
+        start = time.perf_counter()
+        try:
+            self.websocket = await websockets.connect(self.url, max_size=None, open_timeout=30)
+            await self.websocket.send(json.dumps({"type": "register", "username": self.username}))
+            # Presence messages may arrive first, the register response is the one that matters
+            while json.loads(await self.websocket.recv()).get("type") != "register_response":
+                pass
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+            self.stats.connect_failures += 1
+            self.websocket = None
+            return False
+        self.stats.connect_times.append(time.perf_counter() - start)
+        self.receiver = asyncio.create_task(self.receive())
+        return True
+
+    async def receive(self):
+        try:
+            async for data in self.websocket:
+                now = time.perf_counter()
+                message = json.loads(data)
+                message_type = message.get("type")
+                if message_type == "chat_message":
+                    sent_at = self.stats.sent_at.pop(message.get("counter"), None)
+                    if sent_at is not None:
+                        self.stats.received += 1
+                        self.stats.received_bytes += len(data)
+                        self.stats.latencies.append(now - sent_at)
+                elif message_type == "error":
+                    self.stats.error(message.get("message", "error"))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send_chat(self, recipient, content):
+        counter = next(self.stats.sequence)
+        data = json.dumps({"type": "chat_message", "recipient": recipient, "encrypted_content": content,
+                           "counter": counter})
+        self.stats.sent_at[counter] = time.perf_counter()
+        try:
+            await self.websocket.send(data)
+        except (websockets.ConnectionClosed, AttributeError):
+            # Not connected (a reconnect in progress): the message was never sent
+            del self.stats.sent_at[counter]
+            return
+        self.stats.sent += 1
+        self.stats.sent_bytes += len(data)
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.receiver is not None:
+            await self.receiver
+        self.websocket = self.receiver = None
+
+
+async def connect_all(clients):
+    connecting = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(client):
+        async with connecting:
+            return await client.connect()
+
+    return sum(await asyncio.gather(*(connect(c) for c in clients)))
+
+
+async def run_traffic(clients, pattern, duration, rate, size, burst, burst_interval, reconnect_interval):
+    """Every client sends to the next one until 'duration' seconds have passed"""
+    content = base64.b64encode(os.urandom(size)).decode("ascii")
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + duration
+
+    async def steady(client, recipient):
+        # Randomly phased so the clients do not all send at the same instant
+        await asyncio.sleep(random.random() / rate)
+        while loop.time() < stop_at:
+            await client.send_chat(recipient, content)
+            await asyncio.sleep(1 / rate)
+
+    async def bursty(client, recipient):
+        # Every client sends 'burst' messages back to back at the same instant, every burst_interval seconds
+        while loop.time() < stop_at:
+            for _ in range(burst):
+                await client.send_chat(recipient, content)
+            await asyncio.sleep(burst_interval)
+
+    async def storms():
+        # Every reconnect_interval seconds all clients drop their connection and reconnect at once
+        while True:
+            await asyncio.sleep(reconnect_interval)
+            if loop.time() >= stop_at:
+                return
+            await asyncio.gather(*(c.close() for c in clients))
+            await connect_all(clients)
+
+    send = bursty if pattern == "bursty" else steady
+    storm = asyncio.create_task(storms()) if pattern == "reconnect" else None
+    await asyncio.gather(*(send(c, clients[(i + 1) % len(clients)].username) for i, c in enumerate(clients)))
+    if storm is not None:
+        await storm
+
+
+async def http_get(url):
+    # Minimal HTTP/1.1 GET for the server's metrics endpoint (it closes the connection after the response)
+    host_port, _, path = url.split("://", 1)[-1].partition("/")
+    host, _, port = host_port.partition(":")
+    reader, writer = await asyncio.open_connection(host, int(port or 80))
+    writer.write(f"GET /{path} HTTP/1.1\r\nHost: {host_port}\r\nConnection: close\r\n\r\n".encode("ascii"))
+    response = await reader.read()
+    writer.close()
+    return response.partition(b"\r\n\r\n")[2].decode("utf-8")
+
+
+def parse_histogram(text, name):
+    """Cumulative bucket counts of one histogram in Prometheus text format: [(upper bound, count)]"""
+    buckets = []
+    prefix = f"{name}_bucket{{le=\""
+    for line in text.splitlines():
+        if line.startswith(prefix):
+            bound, _, count = line[len(prefix):].partition("\"} ")
+            buckets.append((float(bound), int(count)))
+    return buckets
+
+
+def histogram_delta_quantiles(before, after, quantiles=(0.5, 0.99, 1.0)):
+    """Bucket upper bounds of the quantiles of what was observed between two scrapes"""
+    counts = [(bound, count - old) for (bound, count), (_, old) in zip(after, before)]
+    total = counts[-1][1] if counts else 0
+    result = {}
+    for q in quantiles:
+        result[q] = next((bound for bound, count in counts if total and count >= q * total), 0.0)
+    return result
+
+
+class ServerProbe:
+    """RSS and event-loop lag of the server under test, read from its metrics endpoint"""
+
+    def __init__(self, metrics_url, prefix="securechat"):
+        self.metrics_url = metrics_url.rstrip("/")
+        self.prefix = prefix
+        self.rss = []
+        self.lag_before = None
+        self.lag_after = None
+
+    async def sample(self, interval=0.5):
+        while True:
+            try:
+                snapshot = json.loads(await http_get(self.metrics_url + "/metrics.json"))
+                self.rss.append(snapshot["gauges"].get("process_rss_bytes", 0))
+            except (OSError, ValueError, KeyError):
+                pass
+            await asyncio.sleep(interval)
+
+    async def lag_histogram(self):
+        try:
+            return parse_histogram(await http_get(self.metrics_url + "/metrics"), f"{self.prefix}_loop_lag_seconds")
+        except (OSError, ValueError):
+            return []
+
+    def summary(self):
+        result = {}
+        if self.rss:
+            result["server_rss_mb_start"] = self.rss[0] / 2 ** 20
+            result["server_rss_mb_peak"] = max(self.rss) / 2 ** 20
+            result["server_rss_mb_end"] = self.rss[-1] / 2 ** 20
+        if self.lag_before and self.lag_after:
+            lag = histogram_delta_quantiles(self.lag_before, self.lag_after)
+            # Upper bounds of the histogram buckets holding the quantiles, in ms
+            result["server_loop_lag_ms_p50"] = lag[0.5] * 1e3
+            result["server_loop_lag_ms_p99"] = lag[0.99] * 1e3
+            result["server_loop_lag_ms_max"] = lag[1.0] * 1e3
+        return result
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_server_process(max_connections, max_frame_size):
+    """SecureChatServer in a child process on free ports, rate limits out of the way; returns (process, url, metrics url)"""
+    port, metrics_port = free_port(), free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+        "--host", "127.0.0.1", "--port", str(port), "--metrics-port", str(metrics_port),
+        "--log-level", "WARNING", "--max-connections", str(max_connections),
+        "--max-frame-size", str(max_frame_size), "--rate-limit", "1e9", "--byte-rate-limit", "1e12",
+    ], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            break
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("The server exited during startup")
+            await asyncio.sleep(0.1)
+    else:
+        process.terminate()
+        raise RuntimeError("The server did not start listening")
+    return process, f"ws://127.0.0.1:{port}", f"http://127.0.0.1:{metrics_port}"
+
+
+async def run(args):
+    process = None
+    url, metrics_url = args.url, args.metrics_url
+    size = args.size or PAYLOAD_SIZE[args.pattern]
+    if url is None:
+        process, url, metrics_url = await start_server_process(args.clients + 100, max(1024 * 1024, 2 * size))
+    probe = ServerProbe(metrics_url) if metrics_url else None
+    generator = Metrics()  # Only for this process's loop lag
+    lag_monitor = asyncio.create_task(generator.monitor_loop_lag())
+    sampler = asyncio.create_task(probe.sample()) if probe else None
+
+    stats = LoadStats()
+    clients = [SimClient(i, url, stats) for i in range(args.clients)]
+    try:
+        start = time.perf_counter()
+        connected = await connect_all(clients)
+        connect_seconds = time.perf_counter() - start
+        if probe:
+            probe.lag_before = await probe.lag_histogram()
+
+        start = time.perf_counter()
+        await run_traffic(clients, args.pattern, args.duration, args.rate, size, args.burst, args.burst_interval,
+                          args.reconnect_interval)
+        deadline = time.perf_counter() + DRAIN_TIMEOUT
+        while stats.sent_at and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - start
+
+        if probe:
+            probe.lag_after = await probe.lag_histogram()
+        await asyncio.gather(*(c.close() for c in clients))
+    finally:
+        lag_monitor.cancel()
+        if sampler:
+            sampler.cancel()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    generator_lag = generator.histograms.get("loop_lag_seconds")
+    report = {
+        "pattern": args.pattern,
+        "clients": args.clients,
+        "connected": connected,
+        "connect_failures": stats.connect_failures,
+        "connect_seconds": connect_seconds,
+        "connect_ms_p50": percentile(stats.connect_times, 50) * 1e3,
+        "connect_ms_p99": percentile(stats.connect_times, 99) * 1e3,
+        "payload_bytes": size,
+        "seconds": elapsed,
+        "sent": stats.sent,
+        "received": stats.received,
+        "loss": 1 - stats.received / stats.sent if stats.sent else 0.0,
+        "messages_per_s": stats.received / elapsed,
+        "mb_per_s": stats.received_bytes / 2 ** 20 / elapsed,
+        "latency_ms_p50": percentile(stats.latencies, 50) * 1e3,
+        "latency_ms_p90": percentile(stats.latencies, 90) * 1e3,
+        "latency_ms_p99": percentile(stats.latencies, 99) * 1e3,
+        "latency_ms_max": max(stats.latencies, default=0.0) * 1e3,
+        "errors": stats.errors,
+        "generator_loop_lag_ms_max": generator_lag.max * 1e3 if generator_lag else 0.0,
+    }
+    if probe:
+        report.update(probe.summary())
+    return report
+
+
+def check(report, args):
+    """Regression gate: the limits given on the command line that the run broke"""
+    limits = [
+        ("latency_ms_p99", args.max_p99_ms, "above"),
+        ("loss", args.max_loss, "above"),
+        ("server_rss_mb_peak", args.max_rss_mb, "above"),
+        ("server_loop_lag_ms_p99", args.max_loop_lag_ms, "above"),
+        ("messages_per_s", args.min_throughput, "below"),
+    ]
+    failures = []
+    for key, limit, direction in limits:
+        if limit is None:
+            continue
+        value = report.get(key)
+        if value is None:
+            failures.append(f"{key} was not measured (limit {limit})")
+        elif (value > limit) if direction == "above" else (value < limit):
+            failures.append(f"{key} = {value:.4g}, limit {limit}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the secure chat server")
+    parser.add_argument("--url", default=None, help="WebSocket URL of a running server (default: start one)")
+    parser.add_argument("--metrics-url", default=None,
+                        help="metrics endpoint of the running server, e.g. http://127.0.0.1:9100")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--pattern", default="steady", choices=PATTERNS)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of traffic")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages/s per client (steady, reconnect, large)")
+    parser.add_argument("--size", type=int, default=None, help="payload bytes (default: 256, 256 KB for 'large')")
+    parser.add_argument("--burst", type=int, default=20, help="messages per client per burst (bursty)")
+    parser.add_argument("--burst-interval", type=float, default=2.0, help="seconds between bursts (bursty)")
+    parser.add_argument("--reconnect-interval", type=float, default=3.0,
+                        help="seconds between reconnect storms (reconnect)")
+    parser.add_argument("--output", default=None, help="write the report as JSON to this file")
+    parser.add_argument("--max-p99-ms", type=float, default=None, help="fail if the p99 delivery latency is above")
+    parser.add_argument("--max-loss", type=float, default=None, help="fail if the fraction of lost messages is above")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="fail if the server's peak RSS is above")
+    parser.add_argument("--max-loop-lag-ms", type=float, default=None, help="fail if the server's p99 loop lag is above")
+    parser.add_argument("--min-throughput", type=float, default=None, help="fail if delivered messages/s are below")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    failures = check(report, args)
+    if failures:
+        sys.exit("Load test limits exceeded:\n  " + "\n  ".join(failures))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# Server metrics: counters, latency histograms, gauges read at scrape time and event-loop lag,
+# served as text (Prometheus exposition format) or JSON from a small local HTTP endpoint
+import asyncio
+import bisect
+import json
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger("securechat.metrics")
+
+# Histogram bucket upper bounds in seconds: 1 us .. about 16 s, powers of two
+LATENCY_BUCKETS = [2 ** i * 1e-6 for i in range(25)]
+
+
+def process_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # No /proc: the peak RSS instead, which getrusage reports in KB on Linux and in bytes on macOS
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+class Histogram:
+    """Fixed-bucket histogram, observing is a bisection over 25 bounds and two additions"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket is everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    def __init__(self, prefix="securechat"):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}  # {name: callable returning a number}, evaluated when the metrics are read
+        self.details = {}  # {name: callable returning JSON data}, only in snapshots
+        self.started = time.time()
+        self.gauge("process_rss_bytes", process_rss)
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def detail(self, name, func):
+        self.details[name] = func
+
+    def snapshot(self):
+        return {
+            "uptime": time.time() - self.started,
+            "counters": dict(self.counters),
+            "gauges": {name: func() for name, func in self.gauges.items()},
+            "histograms": {name: h.summary() for name, h in self.histograms.items()},
+            **{name: func() for name, func in self.details.items()},
+        }
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} counter")
+            lines.append(f"{self.prefix}_{name} {value}")
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name} {func()}")
+        for name, h in sorted(self.histograms.items()):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(h.bounds, h.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+            lines.append(f"{metric}_sum {h.sum}")
+            lines.append(f"{metric}_count {h.count}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host="127.0.0.1", port=9100):
+        """HTTP endpoint: /metrics (text) and /metrics.json, meant to be bound to localhost"""
+        async def handle(reader, writer):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()).strip():
+                    pass  # Headers are not used
+                parts = request.split()
+                path = parts[1].decode("ascii", "replace") if len(parts) > 1 else ""
+                if path == "/metrics":
+                    status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.render()
+                elif path == "/metrics.json":
+                    status, content_type, body = "200 OK", "application/json", json.dumps(self.snapshot())
+                else:
+                    status, content_type, body = "404 Not Found", "text/plain", "Not found\n"
+                data = body.encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("ascii") + data
+                )
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+    async def monitor_loop_lag(self, interval=0.1):
+        """Event-loop lag: how late a sleep of 'interval' seconds wakes up"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.observe("loop_lag_seconds", max(0.0, loop.time() - start - interval))
+
+    async def report(self, interval):
+        """Log a JSON snapshot every 'interval' seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            logger.info("metrics %s", json.dumps(self.snapshot()))
@@ -0,0 +1,181 @@
+# AES from the system's libcrypto (OpenSSL) through ctypes, used by the "openssl" engine of aes.AES.
+# OpenSSL picks AES-NI / ARMv8 crypto instructions when the CPU has them.
+import ctypes
+import threading
+
+# Tried in order before asking ctypes.util.find_library, which is slow to import and spawns ldconfig
+LIBCRYPTO_NAMES = ("libcrypto.so.3", "libcrypto.so.1.1", "libcrypto.so", "libcrypto.dylib")
+
+# EVP_EncryptUpdate takes an int length, larger inputs are fed in pieces
+MAX_UPDATE = 1 << 30
+
+# EVP_CIPHER_CTX_ctrl commands for GCM
+EVP_CTRL_GCM_SET_IVLEN = 0x9
+EVP_CTRL_GCM_GET_TAG = 0x10
+EVP_CTRL_GCM_SET_TAG = 0x11
+
+_libcrypto = None
+
+
+def libcrypto():
+    # Loads and prototypes libcrypto once, raises OSError when it is not available
+    global _libcrypto
+    if _libcrypto is not None:
+        return _libcrypto
+
+    lib = None
+    for name in LIBCRYPTO_NAMES:
+        try:
+            lib = ctypes.CDLL(name)
+            break
+        except OSError:
+            continue
+    if lib is None:
+        from ctypes.util import find_library
+        name = find_library("crypto")
+        if name is None:
+            raise OSError("libcrypto not found")
+        lib = ctypes.CDLL(name)
+
+    lib.EVP_CIPHER_CTX_new.restype = ctypes.c_void_p
+    lib.EVP_CIPHER_CTX_new.argtypes = []
+    lib.EVP_CIPHER_CTX_free.restype = None
+    lib.EVP_CIPHER_CTX_free.argtypes = [ctypes.c_void_p]
+    lib.EVP_CIPHER_CTX_set_padding.restype = ctypes.c_int
+    lib.EVP_CIPHER_CTX_set_padding.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.EVP_EncryptInit_ex.restype = ctypes.c_int
+    lib.EVP_EncryptInit_ex.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p,
+                                       ctypes.c_char_p]
+    lib.EVP_EncryptUpdate.restype = ctypes.c_int
+    lib.EVP_EncryptUpdate.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int),
+                                      ctypes.c_void_p, ctypes.c_int]
+    lib.EVP_DecryptInit_ex.restype = ctypes.c_int
+    lib.EVP_DecryptInit_ex.argtypes = lib.EVP_EncryptInit_ex.argtypes
+    lib.EVP_DecryptUpdate.restype = ctypes.c_int
+    lib.EVP_DecryptUpdate.argtypes = lib.EVP_EncryptUpdate.argtypes
+    for name in ("EVP_EncryptFinal_ex", "EVP_DecryptFinal_ex"):
+        getattr(lib, name).restype = ctypes.c_int
+        getattr(lib, name).argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+    lib.EVP_CIPHER_CTX_ctrl.restype = ctypes.c_int
+    lib.EVP_CIPHER_CTX_ctrl.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+    for bits in (128, 192, 256):
+        for mode in ("ecb", "ctr", "gcm"):
+            getattr(lib, f"EVP_aes_{bits}_{mode}").restype = ctypes.c_void_p
+    _libcrypto = lib
+    return lib
+
+
+class _Context:
+    # One EVP_CIPHER_CTX with the key schedule done once; CTR contexts are re-initialised with a new IV per call
+    def __init__(self, key, mode):
+        self.lib = libcrypto()
+        self.ctx = self.lib.EVP_CIPHER_CTX_new()
+        if not self.ctx:
+            raise MemoryError("EVP_CIPHER_CTX_new failed")
+        cipher = getattr(self.lib, f"EVP_aes_{len(key) * 8}_{mode}")()
+        if not self.lib.EVP_EncryptInit_ex(self.ctx, cipher, None, key, None):
+            raise ValueError("EVP_EncryptInit_ex failed")
+        self.lib.EVP_CIPHER_CTX_set_padding(self.ctx, 0)
+        self.outl = ctypes.c_int()
+
+    def update(self, src, dst, length):
+        # src and dst are addresses, dst may equal src
+        for start in range(0, length, MAX_UPDATE):
+            n = min(MAX_UPDATE, length - start)
+            if not self.lib.EVP_EncryptUpdate(self.ctx, dst + start, ctypes.byref(self.outl), src + start, n):
+                raise ValueError("EVP_EncryptUpdate failed")
+
+    def __del__(self):
+        if getattr(self, "ctx", None):
+            self.lib.EVP_CIPHER_CTX_free(self.ctx)
+            self.ctx = None
+
+
+class GCMStream:
+    """One GCM encryption or decryption in OpenSSL, same interface as gcm.GCMStream"""
+
+    def __init__(self, key, iv, aad=b"", decrypt=False):
+        self.lib = libcrypto()
+        self.decrypt = decrypt
+        self.ctx = self.lib.EVP_CIPHER_CTX_new()
+        if not self.ctx:
+            raise MemoryError("EVP_CIPHER_CTX_new failed")
+        init = self.lib.EVP_DecryptInit_ex if decrypt else self.lib.EVP_EncryptInit_ex
+        self.update_func = self.lib.EVP_DecryptUpdate if decrypt else self.lib.EVP_EncryptUpdate
+        self.outl = ctypes.c_int()
+        cipher = getattr(self.lib, f"EVP_aes_{len(key) * 8}_gcm")()
+        if not (init(self.ctx, cipher, None, None, None)
+                and self.lib.EVP_CIPHER_CTX_ctrl(self.ctx, EVP_CTRL_GCM_SET_IVLEN, len(iv), None)
+                and init(self.ctx, None, None, bytes(key), bytes(iv))):
+            raise ValueError("GCM initialisation failed")
+        if aad:
+            aad = bytes(aad)
+            if not self.update_func(self.ctx, None, ctypes.byref(self.outl), aad, len(aad)):
+                raise ValueError("GCM AAD update failed")
+
+    def update_into(self, src, dst, length):
+        # src and dst are addresses, dst may equal src
+        for start in range(0, length, MAX_UPDATE):
+            n = min(MAX_UPDATE, length - start)
+            if not self.update_func(self.ctx, dst + start, ctypes.byref(self.outl), src + start, n):
+                raise ValueError("GCM update failed")
+
+    def finalize(self, tag=None):
+        # Encryption returns the 16-byte tag, decryption checks 'tag' and raises ValueError on a mismatch
+        tail = ctypes.create_string_buffer(16)
+        if self.decrypt:
+            tag = ctypes.create_string_buffer(bytes(tag), len(tag))
+            if not self.lib.EVP_CIPHER_CTX_ctrl(self.ctx, EVP_CTRL_GCM_SET_TAG, len(tag), tag):
+                raise ValueError("GCM tag check failed.")
+            if self.lib.EVP_DecryptFinal_ex(self.ctx, tail, ctypes.byref(self.outl)) <= 0:
+                raise ValueError("GCM tag check failed.")
+            return None
+        out = ctypes.create_string_buffer(16)
+        if not (self.lib.EVP_EncryptFinal_ex(self.ctx, tail, ctypes.byref(self.outl))
+                and self.lib.EVP_CIPHER_CTX_ctrl(self.ctx, EVP_CTRL_GCM_GET_TAG, 16, out)):
+            raise ValueError("GCM finalisation failed")
+        return out.raw
+
+    def __del__(self):
+        if getattr(self, "ctx", None):
+            self.lib.EVP_CIPHER_CTX_free(self.ctx)
+            self.ctx = None
+
+
+class OpenSSLAES:
+    # One cipher may be shared between threads (session.cached_cipher hands out the same object, and ctypes
+    # releases the GIL during the calls), so the EVP contexts, which hold the CTR IV and counter, are per thread
+    def __init__(self, key):
+        if len(key) not in (16, 24, 32):
+            raise ValueError("AES key must be 16, 24 or 32 bytes.")
+        self.key = bytes(key)
+        self.contexts = threading.local()  # .ecb and .ctr, each created on first use in a thread
+
+    def context(self, mode):
+        context = getattr(self.contexts, mode, None)
+        if context is None:
+            context = _Context(self.key, mode)
+            setattr(self.contexts, mode, context)
+        return context
+
+    def encrypt_blocks(self, blocks, out):
+        # blocks and out are C-contiguous uint8 arrays of the same whole-block size
+        self.context("ecb").update(blocks.ctypes.data, out.ctypes.data, blocks.size)
+        return out
+
+    def ctr_xor(self, iv, src, dst):
+        # dst = src XOR keystream of AES-CTR from 'iv', the 16-byte first counter block (incremented as a
+        # 128-bit big-endian number). src and dst are flat uint8 arrays, dst may be src
+        ctr = self.context("ctr")
+        if not ctr.lib.EVP_EncryptInit_ex(ctr.ctx, None, None, None, bytes(iv)):
+            raise ValueError("EVP_EncryptInit_ex failed")
+        ctr.update(src.ctypes.data, dst.ctypes.data, len(src))
+        return dst
+
+
+def available():
+    try:
+        libcrypto()
+        return True
+    except OSError:
+        return False
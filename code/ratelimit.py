@@ -0,0 +1,76 @@
+# Token-bucket rate limits for the chat server, per connection and per user, in messages/s and bytes/s.
+# Buckets refill lazily when checked, so a check is a few arithmetic operations and dict lookups
+import time
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until 'amount' tokens are available, 0 if they are now"""
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """A message bucket and a byte bucket per connection, and the same per user (all their connections)"""
+
+    def __init__(self, messages_per_s=50, bytes_per_s=1024 * 1024, user_messages_per_s=100,
+                 user_bytes_per_s=2 * 1024 * 1024, burst=2.0, max_frame_size=1024 * 1024):
+        # Bursts of up to 'burst' seconds worth of traffic are let through; a byte bucket always
+        # holds at least one maximum-size frame, or such a frame could never pass
+        self.connection_limits = (messages_per_s, bytes_per_s)
+        self.user_limits = (user_messages_per_s, user_bytes_per_s)
+        self.burst = burst
+        self.max_frame_size = max_frame_size
+        self.connections = {}  # {websocket: (message bucket, byte bucket)}
+        self.users = {}  # {username: (message bucket, byte bucket)}
+
+    def buckets(self, limits, now):
+        messages_per_s, bytes_per_s = limits
+        return (
+            TokenBucket(messages_per_s, messages_per_s * self.burst, now),
+            TokenBucket(bytes_per_s, max(bytes_per_s * self.burst, self.max_frame_size), now),
+        )
+
+    def check(self, websocket, username, nbytes):
+        """Take one message and 'nbytes' from the buckets, returns 0 if allowed,
+        otherwise the seconds to wait before retrying (nothing is taken then)"""
+        now = time.monotonic()
+        connection = self.connections.get(websocket)
+        if connection is None:
+            connection = self.connections[websocket] = self.buckets(self.connection_limits, now)
+        pairs = [connection]
+        # Connections that have not registered yet are only limited per connection
+        if username is not None:
+            user = self.users.get(username)
+            if user is None:
+                user = self.users[username] = self.buckets(self.user_limits, now)
+            pairs.append(user)
+
+        wait = 0.0
+        for messages, data in pairs:
+            messages.refill(now)
+            data.refill(now)
+            wait = max(wait, messages.wait_time(1), data.wait_time(nbytes))
+        if wait:
+            return wait
+        for messages, data in pairs:
+            messages.tokens -= 1
+            data.tokens -= nbytes
+        return 0.0
+
+    def forget(self, websocket):
+        self.connections.pop(websocket, None)
+
+    def forget_user(self, username):
+        self.users.pop(username, None)
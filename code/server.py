@@ -1,91 +1,382 @@
+import argparse
 import asyncio
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import signal
+import sys
+import tempfile
+import time
+from collections import OrderedDict
 import websockets
 import json
-from datetime import datetime
 import ssl
+from bus import UnixSocketBus
+from fanout import FanOut
+from frames import FRAME_CHAT, ack_frame, as_bytes, as_text, pack_header, parse_frame, wire_size
+from history import MessageHistory
+from metrics import Metrics
+from ratelimit import RateLimiter
+
+logger = logging.getLogger("securechat.server")
+
+# Usernames are non-empty strings up to this many characters, checked before any state changes
+MAX_USERNAME_LENGTH = 64
+
+
+def valid_username(username):
+    return isinstance(username, str) and 0 < len(username) <= MAX_USERNAME_LENGTH
 
 
 class SecureChatServer:
-    def __init__(self):
+    def __init__(self, max_queue=256, overflow_policy="coalesce", presence_window=0.25, history=None,
+                 shard_id=0, bus=None, metrics=None, max_connections=10000, max_frame_size=1024 * 1024,
+                 rate_limiter=None, max_user_ids=100000):
         self.clients = {}  # {websocket: {"username": username, "key": encryption_key}}
-        self.messages = []  # Store message history
+        self.sessions = {}  # {username: set of websockets}, a user may be connected more than once
+        # Binary frames address users by number, ids are handed out on first sight and never reused
+        # At most max_user_ids names keep an id, least recently used first to go, see evict_user_ids
+        self.user_ids = OrderedDict()  # {username: id}, least recently used first
+        self.usernames = {}  # {id: username}
+        self.next_user_id = 1
+        self.max_user_ids = max_user_ids
+        # With several shards, users connected elsewhere are reached over the message bus
+        self.shard_id = shard_id
+        self.bus = bus
+        self.remote_sessions = {}  # {username: set of shard ids}, replicated from the other shards' announcements
+        self.bus_tasks = set()  # Background bus sends, referenced until done so they are not garbage-collected
+        # Message history: bounded per conversation, store-and-forward for offline recipients
+        self.history = history if history is not None else MessageHistory()
+        # Counters, latency histograms and gauges, see metrics.py
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.open_connections = 0
+        # Admission control: connections over max_connections are refused, frames over max_frame_size
+        # close the connection (1009), and messages over the rate limits are answered with an error
+        self.max_connections = max_connections
+        self.max_frame_size = max_frame_size
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(max_frame_size=max_frame_size)
+        # Outgoing messages go through a bounded queue and a writer task per connection
+        self.fanout = FanOut(max_queue, overflow_policy, on_disconnect=self.unregister_many, metrics=self.metrics)
+        self.register_gauges()
 
-    async def register(self, websocket, username, encryption_key):
+        # Presence is sent as versioned user_joined / user_left deltas, coalesced over presence_window seconds
+        self.presence_window = presence_window
+        self.presence_version = 0
+        self.published_users = set()  # Online users as of presence_version
+        self.presence_dirty = set()  # Users whose online state may have changed since
+        self.presence_flush = None
+
+    def register_gauges(self):
+        self.metrics.gauge("connections_open", lambda: self.open_connections)
+        self.metrics.gauge("clients_registered", lambda: len(self.clients))
+        self.metrics.gauge("users_online", lambda: len(self.sessions))
+        self.metrics.gauge("history_conversations", lambda: len(self.history.conversations))
+        self.metrics.gauge("history_pending_bytes", lambda: self.history.pending_bytes)
+        self.metrics.gauge("queue_depth_total", lambda: sum(self.fanout.queue_depths().values()))
+        self.metrics.gauge("queue_depth_max", lambda: max(self.fanout.queue_depths().values(), default=0))
+        # Per-connection queue depths, the deepest ones only (a snapshot with every connection would be huge)
+        self.metrics.detail("deepest_queues", lambda: [
+            {"username": self.clients.get(ws, {}).get("username"), "address": str(ws.remote_address), "depth": depth}
+            for ws, depth in sorted(self.fanout.queue_depths().items(), key=lambda item: -item[1])[:10] if depth
+        ])
+
+    async def register(self, websocket, username, encryption_key, binary=False):
         """Register a new client"""
+        # A connection registering again under another name leaves its old session
+        if websocket in self.clients:
+            old_username = self.clients[websocket]["username"]
+            self.remove_session(websocket, old_username)
+            self.presence_changed(old_username)
         self.clients[websocket] = {
             "username": username,
-            "key": encryption_key
+            "key": encryption_key,
+            "binary": binary  # Whether chat messages are sent to this client as binary frames
         }
-        await self.notify_user_list()
+        if username not in self.sessions:
+            self.sessions[username] = set()
+            self.announce(username, True)
+        self.sessions[username].add(websocket)
+        self.fanout.add(websocket)
+        # The new client gets a snapshot, everyone else a delta once the window closes
+        self.send_user_list(websocket)
+        self.presence_changed(username)
+        # Messages that arrived while the user was offline
+        for stored in self.history.take_pending(username):
+            self.fanout.send(websocket, self.chat_payload(stored, binary))
         self.log_message(f"New client registered: {username}")
 
     async def unregister(self, websocket):
         """Unregister a client"""
-        if websocket in self.clients:
-            username = self.clients[websocket]["username"]
-            del self.clients[websocket]
-            await self.notify_user_list()
+        await self.unregister_many([websocket])
+
+    async def unregister_many(self, websockets_list):
+        """Unregister several clients with a single presence update"""
+        usernames = []
+        for websocket in websockets_list:
+            self.fanout.remove(websocket)
+            if websocket in self.clients:
+                username = self.clients[websocket]["username"]
+                del self.clients[websocket]
+                self.remove_session(websocket, username)
+                usernames.append(username)
+        for username in usernames:
+            self.presence_changed(username)
             self.log_message(f"Client unregistered: {username}")
 
-    async def notify_user_list(self):
-        """Send updated user list to all clients"""
-        if self.clients:
-            user_list = [{"username": client_info["username"]}
-                         for client_info in self.clients.values()]
-            user_list_message = json.dumps({
-                "type": "user_list",
-                "users": user_list
+    def remove_session(self, websocket, username):
+        """Drop a connection from the username index"""
+        sessions = self.sessions.get(username)
+        if sessions is not None:
+            sessions.discard(websocket)
+            if not sessions:
+                del self.sessions[username]
+                self.rate_limiter.forget_user(username)
+                self.announce(username, False)
+
+    def user_id(self, username):
+        user_id = self.user_ids.get(username)
+        if user_id is None:
+            user_id = self.user_ids[username] = self.next_user_id
+            self.next_user_id += 1
+            self.usernames[user_id] = username
+            if len(self.user_ids) > self.max_user_ids:
+                self.evict_user_ids()
+        else:
+            self.user_ids.move_to_end(username)
+        return user_id
+
+    def evict_user_ids(self):
+        """Drop ids down to 90% of max_user_ids, least recently used first. Online users keep theirs
+        (clients have them from the user lists), and a dropped name gets a new id if it comes back"""
+        target = self.max_user_ids * 9 // 10
+        for username in list(self.user_ids):
+            if len(self.user_ids) <= target:
+                break
+            if self.is_online(username):
+                self.user_ids.move_to_end(username)
+            else:
+                del self.usernames[self.user_ids.pop(username)]
+
+    def is_online(self, username):
+        return username in self.sessions or username in self.remote_sessions
+
+    def announce(self, username, online):
+        """Tell the other shards that a user's first session opened or last session closed here"""
+        if self.bus is not None:
+            self.bus_task(self.bus.broadcast({
+                "kind": "presence", "shard": self.shard_id, "username": username, "online": online
+            }))
+
+    def bus_task(self, coroutine):
+        """Run a bus send in the background; failures are logged and counted instead of lost"""
+        task = asyncio.create_task(coroutine)
+        self.bus_tasks.add(task)
+        task.add_done_callback(self.bus_task_done)
+
+    def bus_task_done(self, task):
+        self.bus_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.metrics.inc("bus_send_errors")
+            logger.error(f"Bus send failed: {task.exception()!r}")
+
+    def remote_presence(self, shard, username, online):
+        shards = self.remote_sessions.get(username)
+        if online:
+            self.remote_sessions.setdefault(username, set()).add(shard)
+            # Messages stored here while the user was offline everywhere go to the shard they are on now
+            for stored in self.history.take_pending(username):
+                self.bus_task(self.bus.send(shard, self.forward_payload(stored)))
+        elif shards is not None:
+            shards.discard(shard)
+            if not shards:
+                del self.remote_sessions[username]
+        self.presence_changed(username)
+
+    def forward_payload(self, message):
+        """Bus message carrying a chat message to the shard its recipient is connected to"""
+        return {"kind": "chat", "from": message["from"], "to": message["to"],
+                "content": as_text(message["content"]), "counter": message["counter"]}
+
+    async def handle_bus_message(self, message):
+        """Handle a message from another shard"""
+        kind = message.get("kind")
+        if kind == "presence":
+            self.remote_presence(message["shard"], message["username"], message["online"])
+        elif kind == "hello":
+            # A shard (re)started: whatever it announced before is stale, and it learns who is connected here
+            restarted = message["shard"]
+            for username in [u for u, shards in self.remote_sessions.items() if restarted in shards]:
+                self.remote_presence(restarted, username, False)
+            await self.bus.send(message["shard"], {
+                "kind": "presence_sync", "shard": self.shard_id, "usernames": list(self.sessions)
             })
-            await self.broadcast(user_list_message)
+        elif kind == "presence_sync":
+            for username in message["usernames"]:
+                self.remote_presence(message["shard"], username, True)
+        elif kind == "chat":
+            recipients = self.sessions.get(message["to"])
+            stored = self.history.append(message["from"], message["to"], message["content"],
+                                         delivered=bool(recipients), counter=message.get("counter", 0))
+            self.deliver(recipients or (), stored)
+
+    def presence_changed(self, username):
+        """Mark a user's online state as changed, deltas are sent when the coalescing window closes"""
+        self.presence_dirty.add(username)
+        if self.presence_flush is None:
+            loop = asyncio.get_running_loop()
+            self.presence_flush = loop.call_later(self.presence_window, self.flush_presence)
+
+    def flush_presence(self):
+        """Broadcast the net presence changes of the window, one message per kind"""
+        self.presence_flush = None
+        joined = [u for u in self.presence_dirty if self.is_online(u) and u not in self.published_users]
+        left = [u for u in self.presence_dirty if not self.is_online(u) and u in self.published_users]
+        self.presence_dirty.clear()
+
+        # A user who joined and left within the window produces no message at all
+        for message_type, users in (("user_joined", joined), ("user_left", left)):
+            if users:
+                self.presence_version += 1
+                if message_type == "user_joined":
+                    self.published_users.update(users)
+                else:
+                    self.published_users.difference_update(users)
+                self.fanout.broadcast(json.dumps({
+                    "type": message_type,
+                    "version": self.presence_version,
+                    "users": [{"username": u, "id": self.user_id(u)} for u in users]
+                }).encode("utf-8"))
+
+    def send_user_list(self, websocket):
+        """Send the full user list (as of the current presence version) to one client"""
+        self.fanout.send(websocket, json.dumps({
+            "type": "user_list",
+            "version": self.presence_version,
+            "users": [{"username": u, "id": self.user_id(u)} for u in self.published_users]
+        }).encode("utf-8"), key="user_list")
+
+    def chat_payload(self, message, binary=False):
+        """Encoded chat_message forward for a stored history entry"""
+        if binary:
+            # Header and ciphertext go out as two fragments of one binary message, the ciphertext
+            # received in a binary frame is never copied
+            body = as_bytes(message["content"])
+            header = pack_header(FRAME_CHAT, self.user_id(message["from"]), len(body), message["counter"])
+            return header, body
+        return json.dumps({
+            "type": "chat_message",
+            "id": message["id"],
+            "from": message["from"],
+            "content": as_text(message["content"]),
+            "counter": message["counter"],
+            "timestamp": message["timestamp"]
+        }).encode("utf-8")
+
+    def deliver(self, recipients, message):
+        """Queue a chat message for local connections, returns whether any of them took it"""
+        payloads = {}  # Encoded once per format, shared by the recipients using it
+        queued = False
+        for client_ws in recipients:
+            binary = self.clients[client_ws]["binary"]
+            if binary not in payloads:
+                payloads[binary] = self.chat_payload(message, binary)
+            queued = self.fanout.send(client_ws, payloads[binary]) or queued
+        return queued
 
-    async def broadcast(self, message, exclude=None):
+    async def route_chat(self, sender, recipient, content, counter=0):
+        """Store a chat message and forward it to the recipient's sessions, returns (status, stored message)"""
+        recipients = self.sessions.get(recipient)
+        remote_shards = self.remote_sessions.get(recipient)
+        # The opaque encrypted payload is kept, offline recipients get it when they register
+        stored = self.history.append(sender, recipient, content, delivered=bool(recipients or remote_shards),
+                                     counter=counter)
+        if not recipients and not remote_shards:
+            return "stored", stored
+
+        # Recipient websockets come from the username index, O(1) whatever the number of users
+        queued = self.deliver(recipients or (), stored)
+        # Sessions on other shards are reached through the bus
+        for shard in list(remote_shards or ()):
+            await self.bus.send(shard, self.forward_payload(stored))
+            queued = True
+        return ("delivered" if queued else "dropped"), stored
+
+    async def timed_route_chat(self, sender, recipient, content, counter=0):
+        start = time.perf_counter()
+        status, stored = await self.route_chat(sender, recipient, content, counter)
+        self.metrics.observe("route_seconds", time.perf_counter() - start)
+        self.metrics.inc(f"messages_{status}")
+        return status, stored
+
+    async def broadcast(self, message, exclude=None, key=None):
         """Broadcast message to all clients except excluded one"""
-        disconnected = set()
-        for websocket in self.clients:
-            if websocket != exclude:
-                try:
-                    await websocket.send(message)
-                except websockets.ConnectionClosed:
-                    disconnected.add(websocket)
-
-        # Clean up disconnected clients
-        for websocket in disconnected:
-            await self.unregister(websocket)
+        # Encoded once and shared by every connection's queue; the writer tasks do the sending,
+        # and connections found closed are cleaned up in one batch by the fan-out
+        payload = message.encode("utf-8") if isinstance(message, str) else message
+        self.fanout.broadcast(payload, exclude=exclude, key=key)
 
     def log_message(self, message, message_type="INFO"):
         """Log server messages with timestamp"""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print(f"[{timestamp}] [{message_type}] {message}")
+        logger.log(getattr(logging, message_type, logging.INFO), message)
 
     async def handle_message(self, websocket, message_data):
         """Handle incoming messages"""
         try:
-            print(f"Received message: {message_data}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received message: %s", message_data)
+            start = time.perf_counter()
             message = json.loads(message_data)
+            self.metrics.observe("parse_seconds", time.perf_counter() - start)
             message_type = message.get("type", "")
 
             if message_type == "register":
+                if not valid_username(message.get("username")):
+                    return {"type": "error", "message": "Invalid username"}
+                # Clients sending "binary": true get chat messages as binary frames (see frames.py)
+                binary = bool(message.get("binary", False))
                 await self.register(
                     websocket,
                     message["username"],
-                    message["encryption_key"]
+                    message.get("encryption_key"),  # No longer required, key material need not reach the server
+                    binary
+                )
+                return {"type": "register_response", "status": "success",
+                        "user_id": self.user_id(message["username"]), "binary": binary}
+
+            elif message_type == "get_user_list":
+                # Clients ask for a snapshot when they notice a gap in the presence versions
+                if websocket not in self.clients:
+                    return {"type": "error", "message": "Not registered"}
+                self.send_user_list(websocket)
+                return None
+
+            elif message_type == "history":
+                # Paginated history of one conversation: {"peer", "before_id" (optional), "limit"}
+                if websocket not in self.clients or "peer" not in message:
+                    return {"type": "error", "message": "Not registered or missing peer"}
+                limit = max(1, min(int(message.get("limit", 50)), 200))
+                messages, has_more = self.history.page(
+                    self.clients[websocket]["username"], message["peer"], message.get("before_id"), limit
                 )
-                return {"type": "register_response", "status": "success"}
+                messages = [dict(m, content=as_text(m["content"])) for m in messages]
+                return {"type": "history", "peer": message["peer"], "messages": messages, "has_more": has_more}
 
             elif message_type == "chat_message":
                 # Forward encrypted message to recipient
                 if "recipient" in message and "encrypted_content" in message:
-                    forward_message = json.dumps({
-                        "type": "chat_message",
-                        "from": self.clients[websocket]["username"],
-                        "content": message["encrypted_content"]
-                    })
-                    # Find recipient websocket
-                    for client_ws, client_info in self.clients.items():
-                        if client_info["username"] == message["recipient"]:
-                            await client_ws.send(forward_message)
-                            break
-                return {"type": "message_response", "status": "delivered"}
+                    if websocket not in self.clients:
+                        return {"type": "error", "message": "Not registered"}
+                    if not valid_username(message["recipient"]):
+                        return {"type": "error", "message": "Invalid recipient"}
+                    status, stored = await self.timed_route_chat(
+                        self.clients[websocket]["username"],
+                        message["recipient"],
+                        message["encrypted_content"],
+                        int(message.get("counter", 0))
+                    )
+                    return {"type": "message_response", "status": status, "id": stored["id"]}
+                return {"type": "error", "message": "Missing recipient or encrypted_content"}
 
             else:
                 return {"type": "error", "message": "Unknown message type"}
@@ -95,37 +386,199 @@ class SecureChatServer:
         except Exception as e:
             return {"type": "error", "message": str(e)}
 
-    async def start_server(self, host='0.0.0.0', port=5555):
+    async def handle_frame(self, websocket, data):
+        """Handle a binary frame, the ciphertext is forwarded as a slice of 'data' without being decoded"""
+        start = time.perf_counter()
+        try:
+            frame_type, _, peer_id, counter, body = parse_frame(data)
+        except ValueError as e:
+            return {"type": "error", "message": str(e)}
+        self.metrics.observe("parse_seconds", time.perf_counter() - start)
+        if frame_type != FRAME_CHAT:
+            return {"type": "error", "message": "Unknown frame type"}
+        if websocket not in self.clients:
+            return {"type": "error", "message": "Not registered"}
+        recipient = self.usernames.get(peer_id)
+        if recipient is None:
+            return {"type": "error", "message": "Unknown recipient id"}
+
+        # As in handle_message, a failure while routing (e.g. a bus send) fails this frame, not the connection
+        try:
+            status, stored = await self.timed_route_chat(self.clients[websocket]["username"], recipient, body,
+                                                         counter)
+        except Exception as e:
+            self.metrics.inc("frames_failed")
+            logger.error(f"Routing a frame from {self.clients[websocket]['username']} failed: {e!r}")
+            return ack_frame("error", 0, counter)
+        return ack_frame(status, stored["id"], counter)
+
+    async def start_server(self, host='0.0.0.0', port=5555, reuse_port=False, metrics_port=None,
+                           metrics_interval=None):
         """Start the WebSocket server"""
         self.log_message(f"Starting server on {host}:{port}")
+        asyncio.create_task(self.metrics.monitor_loop_lag())
+        if metrics_port is not None:
+            # Local only: the endpoint shows usernames and addresses
+            await self.metrics.serve("127.0.0.1", metrics_port)
+            self.log_message(f"Metrics on http://127.0.0.1:{metrics_port}/metrics")
+        if metrics_interval:
+            asyncio.create_task(self.metrics.report(metrics_interval))
+        if self.bus is not None:
+            await self.bus.start(self.handle_bus_message)
+            await self.bus.broadcast({"kind": "hello", "shard": self.shard_id})
 
         async def serve(websocket):
+            if self.open_connections >= self.max_connections:
+                self.metrics.inc("connections_rejected")
+                # 1013: try again later
+                await websocket.close(code=1013, reason="Too many connections")
+                return
+            self.open_connections += 1
+            self.metrics.inc("connections_opened")
             try:
                 self.log_message(f"New connection from {websocket.remote_address}")
                 async for message in websocket:
-                    response = await self.handle_message(websocket, message)
-                    if response:
+                    self.metrics.inc("messages_received")
+                    client = self.clients.get(websocket)
+                    retry_after = self.rate_limiter.check(
+                        websocket, client["username"] if client else None, wire_size(message)
+                    )
+                    if retry_after:
+                        self.metrics.inc("messages_rate_limited")
+                        await websocket.send(json.dumps({
+                            "type": "error", "message": "Rate limit exceeded", "retry_after": round(retry_after, 3)
+                        }))
+                        continue
+                    # Binary WebSocket messages are chat frames, text messages JSON
+                    if isinstance(message, bytes):
+                        response = await self.handle_frame(websocket, message)
+                    else:
+                        response = await self.handle_message(websocket, message)
+                    if isinstance(response, bytes):
+                        await websocket.send(response)
+                    elif response:
                         await websocket.send(json.dumps(response))
             except websockets.ConnectionClosed:
                 self.log_message(f"Client disconnected: {websocket.remote_address}")
             finally:
+                self.rate_limiter.forget(websocket)
+                self.open_connections -= 1
+                self.metrics.inc("connections_closed")
                 await self.unregister(websocket)
 
-        async with websockets.serve(serve, host, port):
+        # With reuse_port (SO_REUSEPORT) several shard processes listen on the same port
+        # and the kernel spreads incoming connections over them
+        async with websockets.serve(serve, host, port, reuse_port=reuse_port or None, max_size=self.max_frame_size):
             self.log_message("Server is running...")
             await asyncio.Future()  # run forever
 
 
+def configure_logging(level="INFO"):
+    """Log records go through a queue to a listener thread, so the event loop never waits on output"""
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+    listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger("securechat")
+    root.setLevel(level)
+    root.handlers[:] = [logging.handlers.QueueHandler(records)]
+    listener.start()
+    return listener
+
+
+def run_shard(shard_id, shards, host, port, bus_dir, history_db, log_level="INFO", metrics_port=None,
+              metrics_interval=None, server_options=None):
+    """Entry point of one shard process"""
+    listener = configure_logging(log_level)
+    # Each shard keeps its own log, message ids are only unique within a shard
+    history = MessageHistory(path=f"{history_db}.{shard_id}" if history_db else None)
+    server = SecureChatServer(history=history, shard_id=shard_id, bus=UnixSocketBus(shard_id, shards, bus_dir),
+                              **(server_options or {}))
+    # Shard i serves its metrics on metrics_port + i
+    if metrics_port is not None:
+        metrics_port += shard_id
+    try:
+        asyncio.run(server.start_server(host, port, reuse_port=True, metrics_port=metrics_port,
+                                        metrics_interval=metrics_interval))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
+
+
+def run_cluster(shards, host, port, bus_dir=None, history_db=None, log_level="INFO", metrics_port=None,
+                metrics_interval=None, server_options=None):
+    """Run 'shards' server processes sharing one port, connected by a Unix socket bus"""
+    bus_dir = bus_dir or tempfile.mkdtemp(prefix="securechat-bus-")
+    processes = [
+        multiprocessing.Process(target=run_shard, args=(i, shards, host, port, bus_dir, history_db, log_level,
+                                                        metrics_port, metrics_interval, server_options))
+        for i in range(shards)
+    ]
+    for process in processes:
+        process.start()
+    # SIGTERM stops the whole cluster, not just the launcher
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Secure Chat Server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--history-db", default=None,
+                        help="SQLite file for the persistent message log (default: in-memory history only)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="number of server processes sharing the port (Linux SO_REUSEPORT)")
+    parser.add_argument("--bus-dir", default=None,
+                        help="directory for the shards' Unix sockets (default: a new temporary directory)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG also logs every received message")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve /metrics and /metrics.json on 127.0.0.1 at this port (shard i: port + i)")
+    parser.add_argument("--metrics-interval", type=float, default=None,
+                        help="log a metrics snapshot every this many seconds")
+    parser.add_argument("--max-connections", type=int, default=10000,
+                        help="concurrent connections accepted (per shard)")
+    parser.add_argument("--max-frame-size", type=int, default=1024 * 1024, help="largest message accepted, in bytes")
+    parser.add_argument("--rate-limit", type=float, default=50,
+                        help="messages/s per connection, users get twice as much over all their connections")
+    parser.add_argument("--byte-rate-limit", type=float, default=1024 * 1024,
+                        help="bytes/s per connection, users get twice as much over all their connections")
+    args = parser.parse_args()
+
+    server_options = {
+        "max_connections": args.max_connections,
+        "max_frame_size": args.max_frame_size,
+        "rate_limiter": RateLimiter(args.rate_limit, args.byte_rate_limit, 2 * args.rate_limit,
+                                    2 * args.byte_rate_limit, max_frame_size=args.max_frame_size),
+    }
+
     print("=== Secure Chat Server ===")
-    server = SecureChatServer()
+    if args.shards > 1:
+        run_cluster(args.shards, args.host, args.port, args.bus_dir, args.history_db, args.log_level,
+                    args.metrics_port, args.metrics_interval, server_options)
+        return
+    listener = configure_logging(args.log_level)
+    server = SecureChatServer(history=MessageHistory(path=args.history_db), **server_options)
     try:
-        asyncio.run(server.start_server())
+        asyncio.run(server.start_server(args.host, args.port, metrics_port=args.metrics_port,
+                                        metrics_interval=args.metrics_interval))
     except KeyboardInterrupt:
         print("\nServer shutting down...")
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
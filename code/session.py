@@ -0,0 +1,60 @@
+# Key derivation for chat sessions
+# scrypt runs once per (password, salt) and per-message keys come from HKDF-SHA256 keyed on the nonce
+import functools
+import hashlib
+import hmac
+import secrets
+
+from aes import AES
+
+# Number of (password, salt) -> cipher derivations kept in memory
+KEY_CACHE_SIZE = 256
+
+# HKDF 'info' prefix for per-message keys, the message nonce is appended to it
+MESSAGE_KEY_INFO = b"secure-chat message key"
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def cached_cipher(passwd, salt, key_len=256):
+    # AES with key, hmac_key and expanded round keys derived once per (password, salt)
+    # AES objects are not modified after __init__, and the OpenSSL engine keeps its EVP contexts per thread,
+    # so a cached one can be shared between threads
+    return AES(password_str=passwd, salt=salt, key_len=key_len)
+
+
+def hkdf_sha256(key, info, length, salt=b""):
+    # HKDF (RFC 5869) with SHA-256: extract a pseudorandom key, then expand it to 'length' bytes
+    prk = hmac.digest(salt or bytes(hashlib.sha256().digest_size), key, hashlib.sha256)
+    okm = b""
+    block = b""
+    counter = 1
+    while len(okm) < length:
+        block = hmac.digest(prk, block + info + bytes([counter]), hashlib.sha256)
+        okm += block
+        counter += 1
+    return okm[:length]
+
+
+class SessionKey:
+    def __init__(self, passwd, session_salt=None, key_len=256):
+        # The session salt travels in the salt field of every message, so receivers can derive the same master key
+        self.salt = session_salt or secrets.token_bytes(16)
+        self.key_len = key_len
+
+        # Master key: the scrypt output (encryption key + HMAC key) for password + session salt
+        master = cached_cipher(passwd, self.salt, key_len)
+        self.master_key = master.key.tobytes() + master.hmac_key
+
+    def cipher(self, nonce):
+        # Per-message AES key and HMAC key, derived from the master key with the nonce as HKDF info
+        n_bytes = self.key_len // 8
+        key_bytes = hkdf_sha256(self.master_key, MESSAGE_KEY_INFO + nonce, n_bytes * 2)
+        return AES.from_key(key_bytes[:n_bytes], hmac_key=key_bytes[n_bytes:])
+
+
+def message_cipher(passwd, salt, nonce, session=False, key_len=256):
+    # Cipher for a received message: the salt field holds either a per-message salt (scrypt per salt,
+    # cached) or a session salt (scrypt once per session, then HKDF per nonce)
+    if session:
+        return SessionKey(passwd, salt, key_len).cipher(nonce)
+    return cached_cipher(passwd, salt, key_len)
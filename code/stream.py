@@ -0,0 +1,260 @@
+# Streaming encryption in the same salt | IV | ciphertext | HMAC format as client.encrypt_file,
+# for payloads that should not be held in memory at once
+import hashlib
+import hmac
+import secrets
+
+from aes import AES
+from ctr import CTR
+from gcm import GCM, IV_SIZE, TAG_SIZE
+from session import message_cipher
+
+# Default size of the reads done by encrypt_stream / decrypt_stream
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Payloads starting with a mode byte that says how the rest is protected (client.encrypt_payload,
+# encrypt_stream with a mode); the salt | IV | ciphertext | HMAC format of Encryptor has no mode byte
+MODE_CTR_HMAC = 1  # mode | salt | IV | ciphertext | HMAC, the rest as Encryptor writes it
+MODE_GCM = 2  # mode | salt | nonce (12) | ciphertext | tag (16), the tag also covers mode, salt and nonce
+MODES = (MODE_CTR_HMAC, MODE_GCM)
+
+
+class Encryptor:
+    def __init__(self, passwd, block_size=16, session=None):
+        self.block_size = block_size
+        salt = session.salt if session is not None else secrets.token_bytes(block_size)
+        nonce = secrets.token_bytes(10)
+        self.counter = 0
+
+        if session is not None:
+            cipher = session.cipher(nonce)
+        else:
+            cipher = AES(password_str=passwd, salt=salt, key_len=256)
+        self.mode = CTR(cipher, nonce)
+
+        # The HMAC covers salt | IV | ciphertext and is updated as the ciphertext is produced
+        self.header = salt + nonce + self.counter.to_bytes(6, "big")
+        self.mac = hmac.new(cipher.hmac_key, self.header, hashlib.sha256)
+        self.header_sent = False
+
+        # Bytes of the last incomplete block, kept until more input arrives or finalize pads them
+        self.pending = b""
+
+    def _emit(self, out):
+        if not self.header_sent:
+            self.header_sent = True
+            return self.header + out
+        return out
+
+    def update(self, chunk):
+        data = self.pending + bytes(chunk)
+        n_full = len(data) - len(data) % self.block_size
+        self.pending = data[n_full:]
+
+        out = self.mode.encrypt_buffer(data[:n_full], self.counter)
+        self.counter += n_full // self.block_size
+        self.mac.update(out)
+        return self._emit(out)
+
+    def finalize(self):
+        # Pad the last partial block with the number of padding bytes, as encrypt_file does
+        pad_len = -len(self.pending) % self.block_size
+        out = self.mode.encrypt_buffer(self.pending + bytes([pad_len] * pad_len), self.counter)
+        self.pending = b""
+        self.mac.update(out)
+        return self._emit(out) + self.mac.digest()
+
+
+class Decryptor:
+    def __init__(self, passwd, block_size=16, session=False):
+        self.passwd = passwd
+        self.block_size = block_size
+        self.session = session
+        self.mode = None
+        self.mac = None
+        self.counter = 0
+
+        # Input not processed yet: the header until it is complete, then the trailing bytes that
+        # may still turn out to be the HMAC or part of an incomplete block
+        self.pending = b""
+
+    def _start(self, header):
+        salt = header[:self.block_size]
+        nonce = header[self.block_size: self.block_size + 10]
+        self.counter = int.from_bytes(header[self.block_size + 10: 2 * self.block_size], "big")
+        cipher = message_cipher(self.passwd, salt, nonce, session=self.session)
+        self.mode = CTR(cipher, nonce)
+        self.mac = hmac.new(cipher.hmac_key, header, hashlib.sha256)
+
+    def update(self, chunk):
+        # Returns plaintext as soon as it is known not to be part of the HMAC
+        # The output is unauthenticated until finalize() succeeds
+        self.pending += bytes(chunk)
+        if self.mode is None:
+            if len(self.pending) < 2 * self.block_size:
+                return b""
+            self._start(self.pending[:2 * self.block_size])
+            self.pending = self.pending[2 * self.block_size:]
+
+        # Hold back the last 2 blocks (the HMAC) and any incomplete block
+        available = max(0, len(self.pending) - 2 * self.block_size)
+        available -= available % self.block_size
+        data, self.pending = self.pending[:available], self.pending[available:]
+
+        self.mac.update(data)
+        out = self.mode.decrypt_buffer(data, self.counter)
+        self.counter += available // self.block_size
+        return out
+
+    def finalize(self):
+        # Raises ValueError if the payload was modified or is truncated
+        if self.mode is None or len(self.pending) < 2 * self.block_size:
+            raise ValueError("Ciphertext is truncated.")
+        data, hmac_val = self.pending[:-2 * self.block_size], self.pending[-2 * self.block_size:]
+        self.pending = b""
+        self.mac.update(data)
+        if not hmac.compare_digest(hmac_val, self.mac.digest()):
+            raise ValueError("HMAC check failed.")
+        return self.mode.decrypt_buffer(data, self.counter)
+
+
+class CTRHMACEncryptor(Encryptor):
+    # Encryptor output behind a MODE_CTR_HMAC byte
+    def _emit(self, out):
+        if not self.header_sent:
+            return bytes([MODE_CTR_HMAC]) + super()._emit(out)
+        return out
+
+
+class GCMEncryptor:
+    # Encrypts and authenticates in one pass over the data, nothing is padded
+    def __init__(self, passwd, block_size=16, session=None):
+        salt = session.salt if session is not None else secrets.token_bytes(block_size)
+        nonce = secrets.token_bytes(IV_SIZE)
+        if session is not None:
+            cipher = session.cipher(nonce)
+        else:
+            cipher = AES(password_str=passwd, salt=salt, key_len=256)
+        self.header = bytes([MODE_GCM]) + salt + nonce
+        self.stream = GCM(cipher).stream(nonce, aad=self.header)
+        self.header_sent = False
+
+    def _emit(self, out):
+        if not self.header_sent:
+            self.header_sent = True
+            return self.header + out
+        return out
+
+    def update(self, chunk):
+        return self._emit(self.stream.update(chunk))
+
+    def finalize(self):
+        return self._emit(b"") + self.stream.finalize()
+
+
+class GCMDecryptor:
+    # Input is a whole MODE_GCM payload, mode byte included
+    def __init__(self, passwd, block_size=16, session=False):
+        self.passwd = passwd
+        self.block_size = block_size
+        self.session = session
+        self.header_size = 1 + block_size + IV_SIZE
+        self.stream = None
+
+        # The header until it is complete, then the trailing bytes that may still be the tag
+        self.pending = b""
+
+    def _start(self, header):
+        if header[0] != MODE_GCM:
+            raise ValueError("Not a GCM payload")
+        salt, nonce = header[1:1 + self.block_size], header[1 + self.block_size:]
+        cipher = message_cipher(self.passwd, salt, nonce, session=self.session)
+        self.stream = GCM(cipher).stream(nonce, aad=header, decrypt=True)
+
+    def update(self, chunk):
+        # Returns plaintext as soon as it is known not to be part of the tag
+        # The output is unauthenticated until finalize() succeeds
+        self.pending += bytes(chunk)
+        if self.stream is None:
+            if len(self.pending) < self.header_size:
+                return b""
+            self._start(self.pending[:self.header_size])
+            self.pending = self.pending[self.header_size:]
+        available = max(0, len(self.pending) - TAG_SIZE)
+        data, self.pending = self.pending[:available], self.pending[available:]
+        return self.stream.update(data)
+
+    def finalize(self):
+        # Raises ValueError if the payload was modified or is truncated
+        if self.stream is None or len(self.pending) != TAG_SIZE:
+            raise ValueError("Ciphertext is truncated.")
+        self.stream.finalize(self.pending)
+        self.pending = b""
+        return b""
+
+
+class PayloadDecryptor:
+    # Reads the mode byte, then hands the payload to the decryptor of that mode
+    def __init__(self, passwd, block_size=16, session=False):
+        self.passwd = passwd
+        self.block_size = block_size
+        self.session = session
+        self.decryptor = None
+
+    def update(self, chunk):
+        if self.decryptor is None:
+            chunk = bytes(chunk)
+            if not chunk:
+                return b""
+            if chunk[0] == MODE_GCM:
+                self.decryptor = GCMDecryptor(self.passwd, self.block_size, self.session)
+            elif chunk[0] == MODE_CTR_HMAC:
+                self.decryptor = Decryptor(self.passwd, self.block_size, self.session)
+                chunk = chunk[1:]
+            else:
+                raise ValueError(f"Unknown payload mode {chunk[0]}")
+        return self.decryptor.update(chunk)
+
+    def finalize(self):
+        if self.decryptor is None:
+            raise ValueError("Ciphertext is truncated.")
+        return self.decryptor.finalize()
+
+
+def payload_encryptor(passwd, mode=MODE_GCM, block_size=16, session=None):
+    if mode == MODE_GCM:
+        return GCMEncryptor(passwd, block_size, session)
+    if mode == MODE_CTR_HMAC:
+        return CTRHMACEncryptor(passwd, block_size, session)
+    raise ValueError(f"Unknown payload mode {mode}")
+
+
+def _pump(transform, file_in, file_out, chunk_size):
+    # Copies file_in to file_out through 'transform' using one reusable read buffer
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        n = file_in.readinto(buffer)
+        if not n:
+            break
+        file_out.write(transform.update(view[:n]))
+    file_out.write(transform.finalize())
+
+
+def encrypt_stream(passwd, file_in, file_out, block_size=16, chunk_size=STREAM_CHUNK_SIZE, session=None,
+                   mode=None):
+    # Encrypts binary file object file_in into file_out in constant memory
+    # mode: None for the salt | IV | ciphertext | HMAC format, MODE_CTR_HMAC or MODE_GCM for a payload with a mode byte
+    transform = Encryptor(passwd, block_size, session) if mode is None else payload_encryptor(
+        passwd, mode, block_size, session)
+    _pump(transform, file_in, file_out, chunk_size)
+
+
+def decrypt_stream(passwd, file_in, file_out, block_size=16, chunk_size=STREAM_CHUNK_SIZE, session=False,
+                   mode_byte=False):
+    # Decrypts into file_out in constant memory, mode_byte: the input starts with a mode byte
+    # Raises ValueError if the HMAC (or GCM tag) does not match or the input is truncated
+    # The HMAC (or GCM tag) is only checked at the end, so on failure file_out holds unauthenticated data
+    # and must be discarded
+    transform = PayloadDecryptor(passwd, block_size, session) if mode_byte else Decryptor(passwd, block_size, session)
+    _pump(transform, file_in, file_out, chunk_size)